@@ -56,6 +56,9 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'zeitgitterd=zeitgitter.server:run',
+            'zeitgitter-verify-proof=zeitgitter.merkle:main',
+            'zeitgitter-bench=zeitgitter.bench:main',
+            'zeitgitter-replay=zeitgitter.replay:main',
         ],
     },
     classifiers=[
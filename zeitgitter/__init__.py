@@ -19,6 +19,10 @@
 #
 
 import os
+import time
+
+# For `--print-startup-timings`
+load_start = time.perf_counter()
 
 
 def moddir(to=''):
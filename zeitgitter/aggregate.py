@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Aggregated signing (`stamp-aggregate-v1`)
+#
+# All commit IDs arriving within `--aggregation-window` of the first one (up
+# to `--aggregation-max-batch` of them) are collected into a Merkle tree (see
+# `zeitgitter.merkle`). Only a short
+# statement containing its root is signed, once for the whole batch; every
+# client receives that statement, the signature, and its inclusion path.
+# Like this, the request rate is no longer limited by the signing rate.
+
+import logging as _logging
+import threading
+import time
+
+import zeitgitter.commit
+import zeitgitter.config
+import zeitgitter.merkle
+import zeitgitter.trace
+
+logging = _logging.getLogger('aggregate')
+
+# The `Aggregator`, if enabled (see `--aggregation-window`)
+aggregator = None
+
+
+def statement(stamper, now, leaves):
+    return (zeitgitter.merkle.STATEMENT_HEADER + """signer %s
+url %s
+time %d
+leaves %d
+root sha256:%s
+""" % (stamper.fullid, stamper.url, now, len(leaves),
+       zeitgitter.merkle.root(leaves).hex()))
+
+
+class Batch:
+    def __init__(self):
+        self.commits = []
+        self.timer = None
+        self.flushed = False  # Protected by `Aggregator.lock`
+        self.done = threading.Event()
+        self.receipts = None  # `None` on signing failure
+        self.error = None  # Raised to all requests, e.g., logging failed
+
+
+class Aggregator:
+    def __init__(self, stamper, window, max_batch):
+        self.stamper = stamper
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def submit(self, commit):
+        """Add `commit` to the current batch, starting a new one if needed,
+        and wait for the batch to be signed. Returns the receipt (a dict)
+        or `None` if the signature could not be obtained in time. Raises
+        the `OSError` if the batch could not be logged."""
+        with self.lock:
+            if self.batch is None:
+                self.batch = Batch()
+                self.batch.timer = threading.Timer(self.window, self.flush,
+                                                   args=(self.batch,))
+                self.batch.timer.daemon = True
+                self.batch.timer.start()
+            batch = self.batch
+            index = len(batch.commits)
+            batch.commits.append(commit)
+            full = len(batch.commits) >= self.max_batch
+        if full:
+            # Do not wait for the window to end
+            batch.timer.cancel()
+            self.flush(batch)
+        with zeitgitter.trace.span('aggregate-wait'):
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        if batch.receipts is None:
+            return None
+        return batch.receipts[index]
+
+    def flush(self, batch):
+        """Sign `batch`, unless already done (when it filled up before the
+        end of its window)"""
+        with self.lock:
+            if batch.flushed:
+                return
+            batch.flushed = True
+            if self.batch is batch:
+                self.batch = None
+        try:
+            batch.receipts = self.sign(batch.commits)
+        except OSError as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def sign(self, commits):
+        with zeitgitter.commit.serialize:
+            now = int(self.stamper.sig_time())
+            self.stamper.log_commits(commits, now)
+        leaves = [bytes(c, 'ASCII') for c in commits]
+        text = statement(self.stamper, now, leaves)
+        start = time.time()
+        sig = self.stamper.limited_sign(now, None, text)
+        if sig is None:
+            logging.warning("Signing batch of %d failed" % len(commits))
+            return None
+        logging.debug("Signed batch of %d in %.3fs"
+                      % (len(commits), time.time() - start))
+        tree = zeitgitter.merkle.levels(leaves)
+
+        def node(level, position):
+            if level < len(tree) and position < len(tree[level]):
+                return tree[level][position]
+            return None
+        return [{'commit': c,
+                 'index': i,
+                 'path': zeitgitter.merkle.path(node, i),
+                 'statement': text,
+                 'signature': str(sig)}
+                for (i, c) in enumerate(commits)]
+
+
+def submit(commit):
+    return aggregator.submit(commit)
+
+
+def setup(stamper):
+    global aggregator
+    window = zeitgitter.config.arg.aggregation_window
+    if window is not None and aggregator is None:
+        aggregator = Aggregator(stamper, window,
+                                zeitgitter.config.arg.aggregation_max_batch)
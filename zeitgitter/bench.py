@@ -0,0 +1,504 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Load generator and stamping benchmark
+#
+# Starts the real `zeitgitterd` against a throwaway GnuPG home and
+# repository and drives it with `stamp-tag-v1`, `stamp-branch-v1`, and
+# `get-public-key-v1` requests, either
+# - closed-loop: each of `--connections` clients sends its next request as
+#   soon as the previous one was answered, or
+# - open-loop: requests are started at a fixed `--rate`, independent of how
+#   fast they are answered. Latency is measured from the time the request
+#   was due, so queueing in an overloaded client is not hidden ("coordinated
+#   omission").
+# Throughput, latency percentiles, and the share of 429 responses are
+# reported, optionally for every combination of `--max-parallel-signatures`
+# and `--number-of-gpg-agents` given.
+#
+# Usage: zeitgitter-bench --help
+
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import logging as _logging
+import os
+import queue
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+logging = _logging.getLogger('bench')
+
+KEYID = 'Bench Timestamping Service <bench@bench.localhost>'
+KINDS = ('tag', 'branch', 'pubkey', 'aggregate')
+PERCENTILES = (50, 90, 99, 99.9)
+
+METRIC_LINE = re.compile(r'^([a-z_]+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-z_]+)="((?:[^"\\]|\\.)*)"')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def parse_metrics(text):
+    """Parse the Prometheus text format (as produced by `zeitgitter.metrics`)
+    into a list of (name, labels, value), where labels is a dict"""
+    ret = []
+    for line in text.splitlines():
+        m = METRIC_LINE.match(line)
+        if m:
+            ret.append((m.group(1), dict(LABEL.findall(m.group(2) or '')),
+                        float(m.group(3))))
+    return ret
+
+
+@contextlib.contextmanager
+def throwaway_gnupg_home():
+    """Path of an empty GnuPG home for `BenchServer`, removed when done"""
+    tmp = tempfile.mkdtemp(prefix='zeitgitter-bench-gnupg-')
+    try:
+        home = Path(tmp, 'gnupg')
+        home.mkdir(mode=0o700)
+        yield home.as_posix()
+    finally:
+        # Agents were started for the original and its copies
+        for home in Path(tmp).iterdir():
+            subprocess.run(['gpgconf', '--homedir', home.as_posix(),
+                            '--kill', 'gpg-agent'],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+class BenchServer:
+    """`zeitgitterd` in a subprocess, with its own repository. The GnuPG
+    home `gnupg_home` (with the key `KEYID`, created on first start) can be
+    shared between several servers run one after the other."""
+
+    def __init__(self, gnupg_home, args=()):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='zeitgitter-bench-')
+        self.port = free_port()
+        self.log = Path(self.tmpdir.name, 'zeitgitterd.log')
+        cmd = [sys.executable, '-c',
+               'import zeitgitter.server; zeitgitter.server.run()',
+               '--keyid', KEYID,
+               '--gnupg-home', gnupg_home,
+               '--repository', Path(self.tmpdir.name, 'repo').as_posix(),
+               '--own-url', 'https://bench.localhost',
+               '--owner', '?', '--contact', '?', '--country', '?',
+               '--listen-address', '127.0.0.1',
+               '--listen-port', str(self.port),
+               '--upstream-timestamp', '',
+               '--commit-interval', '1h',
+               '--lookup-index', 'none',
+               '--debug-level', 'WARN'] + list(args)
+        with self.log.open('w') as log:
+            self.proc = subprocess.Popen(cmd, stdout=log,
+                                         stderr=subprocess.STDOUT)
+        try:
+            self.wait_ready()
+        except Exception:
+            self.stop()
+            raise
+
+    def wait_ready(self, timeout=60):
+        end = time.time() + timeout
+        while time.time() < end:
+            if self.proc.poll() is not None:
+                raise RuntimeError("zeitgitterd exited with %d:\n%s"
+                                   % (self.proc.returncode, self.log_tail()))
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                  timeout=1)
+                conn.request('GET', '/healthz/live')
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return
+                conn.close()
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("zeitgitterd not ready after %ds:\n%s"
+                           % (timeout, self.log_tail()))
+
+    def metrics(self):
+        """The server's metrics, see `parse_metrics()`"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request('GET', '/metrics')
+            text = conn.getresponse().read().decode('UTF-8')
+        finally:
+            conn.close()
+        return parse_metrics(text)
+
+    def log_tail(self, lines=20):
+        with self.log.open() as f:
+            return ''.join(f.readlines()[-lines:])
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.tmpdir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class Client:
+    """One keep-alive connection, by default sending requests of the given
+    kinds in turn"""
+
+    def __init__(self, host, port, kinds, number):
+        self.host = host
+        self.port = port
+        self.kinds = kinds
+        self.number = number
+        self.sent = 0
+        self.conn = None
+
+    def next_kind(self):
+        return self.kinds[self.sent % len(self.kinds)]
+
+    def request(self, kind, commit=None):
+        """(method, path, body) of a request of `kind`, for `commit`
+        (default: random)"""
+        self.sent += 1
+        if kind == 'pubkey':
+            return ('GET', '/?request=get-public-key-v1', None)
+        params = {'commit': commit or os.urandom(20).hex()}
+        if kind == 'tag':
+            params['request'] = 'stamp-tag-v1'
+            params['tagname'] = 'bench-%d-%d' % (self.number, self.sent)
+        elif kind == 'branch':
+            params['request'] = 'stamp-branch-v1'
+            params['tree'] = os.urandom(20).hex()
+            params['parent'] = os.urandom(20).hex()
+        else:
+            params['request'] = 'stamp-aggregate-v1'
+        return ('POST', '/', urllib.parse.urlencode(params))
+
+    def send(self, kind=None, commit=None):
+        """Send a request (default: the next kind in turn); returns its kind
+        and the HTTP status (or `'error'`)"""
+        if kind is None:
+            kind = self.next_kind()
+        (method, path, body) = self.request(kind, commit)
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port,
+                                                       timeout=60)
+            headers = {}
+            if body is not None:
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            self.conn.request(method, path, body, headers)
+            resp = self.conn.getresponse()
+            resp.read()
+            return (kind, resp.status)
+        except (OSError, http.client.HTTPException) as e:
+            logging.debug("Request failed: %r" % e)
+            self.close()
+            return (kind, 'error')
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def closed_loop(clients, begin, end, samples):
+    def work(client):
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            (kind, status) = client.send()
+            samples.append((start, time.perf_counter() - start, kind, status))
+    return [threading.Thread(target=work, args=(c,), daemon=True)
+            for c in clients]
+
+
+def open_loop(clients, begin, end, samples, schedule):
+    """Send requests when due according to `schedule`, which yields
+    (seconds after `begin`, kind or `None` for the next in turn, commit or
+    `None` for a random one) in ascending order"""
+    due = queue.Queue()
+
+    def work(client):
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            (start, kind, commit) = item
+            if time.perf_counter() >= end:
+                # Overloaded: due, but not even sent when time was up
+                samples.append((start, time.perf_counter() - start,
+                                kind or client.next_kind(), 'unsent'))
+                continue
+            (kind, status) = client.send(kind, commit)
+            samples.append((start, time.perf_counter() - start, kind, status))
+
+    def dispatch():
+        for (offset, kind, commit) in schedule:
+            t = begin + offset
+            if t >= end:
+                break
+            delay = t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            due.put((t, kind, commit))
+        for _ in clients:
+            due.put(None)
+    return ([threading.Thread(target=dispatch, daemon=True)]
+            + [threading.Thread(target=work, args=(c,), daemon=True)
+               for c in clients])
+
+
+def drive(host, port, kinds, connections, duration, warmup=0, rate=None,
+          schedule=None):
+    """Drive the server for `warmup` + `duration` seconds: closed-loop,
+    at a fixed `rate`, or following `schedule` (see `open_loop()`).
+    Returns the samples started after the warmup as (start, latency, kind,
+    status)"""
+    clients = [Client(host, port, kinds, i) for i in range(connections)]
+    samples = []  # `list.append()` is atomic
+    begin = time.perf_counter()
+    end = begin + warmup + duration
+    if rate is not None:
+        schedule = ((n / rate, None, None) for n in itertools.count())
+    if schedule is None:
+        threads = closed_loop(clients, begin, end, samples)
+    else:
+        threads = open_loop(clients, begin, end, samples, schedule)
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(max(0, end - time.perf_counter()) + 60)
+    for c in clients:
+        c.close()
+    return [s for s in samples if s[0] >= begin + warmup]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the sorted `values`"""
+    if len(values) == 0:
+        return None
+    rank = max(1, -int(-p * len(values) // 100))  # Rounding up
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(samples, duration):
+    latencies = sorted(s[1] for s in samples)
+    statuses = [s[3] for s in samples]
+    ret = {'requests': len(samples),
+           'throughput': statuses.count(200) / duration,
+           'rate-429': (statuses.count(429) / len(samples)
+                        if len(samples) else 0),
+           'unsent': statuses.count('unsent'),
+           'errors': (len(samples) - statuses.count(200)
+                      - statuses.count(429) - statuses.count('unsent'))}
+    for p in PERCENTILES:
+        ret['p%g' % p] = percentile(latencies, p)
+    return ret
+
+
+def report(samples, duration, kinds):
+    ret = {'all': summarize(samples, duration)}
+    if len(kinds) > 1:
+        for kind in kinds:
+            ret[kind] = summarize([s for s in samples if s[2] == kind],
+                                  duration)
+    return ret
+
+
+def format_ms(value):
+    return '-' if value is None else '%.1f' % (value * 1000)
+
+
+def print_table(results):
+    print('%4s %6s %-7s %8s %8s %8s %8s %8s %8s %7s %6s %6s'
+          % ('sigs', 'agents', 'kind', 'requests', 'req/s', 'p50 ms',
+             'p90 ms', 'p99 ms', 'p99.9 ms', '429 %', 'unsent', 'errors'))
+    for r in results:
+        if r.get('fault-injection'):
+            print("Fault injection: %s" % r['fault-injection'])
+        for (kind, s) in r['summary'].items():
+            print('%4s %6s %-7s %8d %8.1f %8s %8s %8s %8s %7.2f %6d %6d'
+                  % (r['max-parallel-signatures'] or '-',
+                     r['number-of-gpg-agents'] or '-', kind,
+                     s['requests'], s['throughput'],
+                     format_ms(s['p50']), format_ms(s['p90']),
+                     format_ms(s['p99']), format_ms(s['p99.9']),
+                     s['rate-429'] * 100, s['unsent'], s['errors']))
+        if r.get('server'):
+            print("Server: %s" % ', '.join(
+                '%s %s' % (k, v) for (k, v) in r['server'].items()))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v.strip() != '']
+
+
+def kind_list(value):
+    kinds = [v.strip() for v in value.split(',') if v.strip() != '']
+    for k in kinds:
+        if k not in KINDS:
+            raise argparse.ArgumentTypeError("unknown request kind %r" % k)
+    return kinds
+
+
+def run_once(args, host, port):
+    samples = drive(host, port, args.requests, args.connections,
+                    args.duration, args.warmup, args.rate)
+    return report(samples, args.duration, args.requests)
+
+
+def server_summary(metrics):
+    """Commit rounds, signing timeouts, and faults injected, from the
+    server's metrics"""
+    ret = {'sign-timeouts': 0, 'round-overruns': 0}
+    rounds = {}
+    for (name, labels, value) in metrics:
+        if name == 'zeitgitter_sign_timeouts_total':
+            ret['sign-timeouts'] = int(value)
+        elif name == 'zeitgitter_round_overruns_total':
+            ret['round-overruns'] = int(value)
+        elif name == 'zeitgitter_faults_injected_total':
+            ret['faults-' + labels['point']] = int(value)
+        elif name.startswith('zeitgitter_round_phase_seconds_'):
+            r = rounds.setdefault(labels['kind'], {'count': 0, 'sum': 0.0})
+            if name.endswith('_count') and labels['phase'] == 'rotate':
+                r['count'] = int(value)
+            elif name.endswith('_sum'):
+                r['sum'] += value
+    for (kind, r) in sorted(rounds.items()):
+        ret['rounds-' + kind] = r['count']
+        if r['count'] > 0:
+            ret['round-seconds-' + kind] = round(r['sum'] / r['count'], 3)
+    return ret
+
+
+def bench(args):
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        return [{'max-parallel-signatures': None,
+                 'number-of-gpg-agents': None,
+                 'summary': run_once(args, url.hostname, url.port or 80)}]
+    results = []
+    with throwaway_gnupg_home() as gnupg_home:
+        for (faults, sigs, agents) in itertools.product(
+                args.fault_injection or [None], args.sweep_signatures,
+                args.sweep_agents):
+            server_args = ['--max-parallel-signatures', str(sigs),
+                           '--number-of-gpg-agents', str(agents)]
+            if args.max_parallel_timeout is not None:
+                server_args += ['--max-parallel-timeout',
+                                str(args.max_parallel_timeout)]
+            if faults is not None:
+                server_args += ['--fault-injection', faults]
+            logging.info("Starting zeitgitterd with %s"
+                         % ' '.join(server_args))
+            with BenchServer(gnupg_home, server_args + args.server_arg) \
+                    as server:
+                summary = run_once(args, '127.0.0.1', server.port)
+                metrics = server.metrics()
+            results.append({'max-parallel-signatures': sigs,
+                            'number-of-gpg-agents': agents,
+                            'fault-injection': faults,
+                            'summary': summary,
+                            'server': server_summary(metrics)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Benchmark zeitgitterd with a throwaway key and repository")
+    parser.add_argument('--requests', type=kind_list, default=['tag', 'branch'],
+                        help="comma-separated request kinds to send in turn:"
+                        " tag, branch, pubkey, aggregate (needs"
+                        " `--aggregation-window`)")
+    parser.add_argument('--connections', type=int, default=4,
+                        help="number of concurrent keep-alive connections")
+    parser.add_argument('--rate', type=float,
+                        help="open loop: start this many requests per second,"
+                        " independent of the responses (default: closed loop,"
+                        " every connection sends the next request when the"
+                        " previous one was answered)")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to measure for each configuration")
+    parser.add_argument('--warmup', type=float, default=1,
+                        help="seconds of load before measuring")
+    parser.add_argument('--sweep-signatures', type=int_list, default=[2],
+                        metavar='N,...',
+                        help="values of `--max-parallel-signatures` to run")
+    parser.add_argument('--sweep-agents', type=int_list, default=[1],
+                        metavar='N,...',
+                        help="values of `--number-of-gpg-agents` to run")
+    parser.add_argument('--max-parallel-timeout', type=float,
+                        help="passed to zeitgitterd; needed to see any"
+                        " 429 responses")
+    parser.add_argument('--fault-injection', action='append',
+                        metavar='SPEC',
+                        help="run with this `--fault-injection` of"
+                        " zeitgitterd (repeat to compare several)")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="additional zeitgitterd option (repeat for"
+                        " every word, e.g. `--server-arg=--aggregation-window"
+                        " --server-arg=0.1s`)")
+    parser.add_argument('--url',
+                        help="benchmark this already running server instead"
+                        " (no sweeps)")
+    parser.add_argument('--json', action='store_true',
+                        help="output the results as JSON")
+    parser.add_argument('--debug-level', default='WARN',
+                        help="log level")
+    args = parser.parse_args()
+    _logging.basicConfig(level=_logging.getLevelName(args.debug_level.upper()))
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    results = bench(args)
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Calibration of signing concurrency (`--calibrate-signing`)
+#
+# On startup, test signatures with the configured key are timed at
+# increasing concurrency (1, 2, 4, ... parallel signatures, on as many GnuPG
+# agents, up to the configured `--max-parallel-signatures` and
+# `--number-of-gpg-agents`). The level after which throughput no longer
+# grows noticeably (or latency grows too much) is the knee; its concurrency
+# becomes the new setting. The result is stored in the repository and
+# reused as long as hardware, GnuPG version, key, and bounds are the same.
+
+import json
+import logging as _logging
+import os
+import platform
+import threading
+import time
+from pathlib import Path
+
+import zeitgitter.config
+
+logging = _logging.getLogger('calibrate')
+
+# Stored in the repository's `.git`
+RESULT = 'zeitgitter-calibration.json'
+# Time to sign at each level
+LEVEL_DURATION = 1.0
+# A level must increase throughput by this fraction over the previous one
+MIN_GAIN = 0.1
+# ... and may increase the median latency at most this many times over
+# a single signature at a time
+MAX_SLOWDOWN = 2.0
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def environment(stamper, max_agents, max_parallel):
+    """What the calibration result depends on"""
+    return {'cpus': os.cpu_count(),
+            'cpu-model': cpu_model(),
+            'machine': platform.machine(),
+            'gnupg': '.'.join(map(str, stamper.gpg().version or ())),
+            'keyid': stamper.keyid,
+            'max-agents': max_agents,
+            'max-parallel': max_parallel}
+
+
+def levels(max_agents, max_parallel):
+    """The (parallel signatures, agents) to measure, in order"""
+    ret = []
+    parallel = 1
+    while parallel < max_parallel:
+        ret.append((parallel, min(parallel, max_agents)))
+        parallel *= 2
+    ret.append((max_parallel, min(max_parallel, max_agents)))
+    return ret
+
+
+def measure(stamper, parallel, agents, duration):
+    """Sign with `parallel` threads on `agents` GnuPG agents for about
+    `duration` seconds (at least twice per thread). Returns throughput
+    (signatures per second) and median latency."""
+    zeitgitter.config.arg.number_of_gpg_agents = agents
+    stamper.reconfigure()
+    stamper.warm_up()  # Do not measure starting the agents
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def sign():
+        count = 0
+        while count < 2 or time.perf_counter() - start < duration:
+            gpg = stamper.gpg()
+            t = time.perf_counter()
+            ok = gpg.sign('calibration', keyid=stamper.keyid, binary=False,
+                          detach=True)
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - t)
+                else:
+                    failures.append(gpg.agent)
+            count += 1
+    threads = [threading.Thread(target=sign) for _ in range(parallel)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if failures:
+        raise RuntimeError("GnuPG agent(s) %s failed to sign"
+                           % ', '.join(map(str, sorted(set(failures)))))
+    latencies.sort()
+    return (len(latencies) / elapsed, latencies[len(latencies) // 2])
+
+
+def knee(results):
+    """The index into `results` (dicts with `throughput` and `latency`, by
+    increasing concurrency) of the last level worth its concurrency"""
+    best = 0
+    for i in range(1, len(results)):
+        if (results[i]['throughput']
+                < results[best]['throughput'] * (1 + MIN_GAIN)
+                or results[i]['latency']
+                > results[0]['latency'] * MAX_SLOWDOWN):
+            break
+        best = i
+    return best
+
+
+def run(stamper, max_agents, max_parallel, duration=LEVEL_DURATION):
+    """Measure the levels up to the knee (and one beyond); returns the
+    results and the index of the knee"""
+    results = []
+    for (parallel, agents) in levels(max_agents, max_parallel):
+        (throughput, latency) = measure(stamper, parallel, agents, duration)
+        logging.info("%2d parallel signatures on %2d agent(s): %7.1f/s,"
+                     " median %6.1f ms" % (parallel, agents, throughput,
+                                           latency * 1000))
+        results.append({'parallel': parallel, 'agents': agents,
+                        'throughput': round(throughput, 3),
+                        'latency': round(latency, 6)})
+        if knee(results) < len(results) - 1:
+            break  # Past the knee
+    return (results, knee(results))
+
+
+def load(path, env):
+    """The stored result, if it was obtained in the same environment"""
+    try:
+        with path.open() as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stored, dict) or stored.get('environment') != env:
+        return None
+    return stored
+
+
+def save(path, stored):
+    tmp = path.with_suffix('.tmp')
+    try:
+        with tmp.open('w') as f:
+            json.dump(stored, f, indent=1)
+        tmp.replace(path)
+    except OSError as e:
+        logging.warning("Cannot store calibration in %s: %s" % (path, e))
+
+
+def setup(stamper, duration=LEVEL_DURATION):
+    """Calibrate (or reuse the stored calibration), if enabled, and apply
+    the result to the configuration and `stamper`"""
+    arg = zeitgitter.config.arg
+    if not arg.calibrate_signing:
+        return
+    (max_agents, max_parallel) = (arg.number_of_gpg_agents,
+                                  arg.max_parallel_signatures)
+    path = Path(arg.repository, '.git', RESULT)
+    env = environment(stamper, max_agents, max_parallel)
+    stored = load(path, env)
+    if stored is None:
+        logging.info("Calibrating signing concurrency (at most %d parallel"
+                     " signatures on %d agent(s))" % (max_parallel,
+                                                      max_agents))
+        try:
+            (results, best) = run(stamper, max_agents, max_parallel,
+                                  duration)
+        except RuntimeError as e:
+            logging.error("Calibration failed, using the configured"
+                          " values: %s" % e)
+            arg.number_of_gpg_agents = max_agents
+            stamper.reconfigure()
+            return
+        stored = {'environment': env, 'levels': results,
+                  'parallel': results[best]['parallel'],
+                  'agents': results[best]['agents']}
+        save(path, stored)
+    else:
+        logging.info("Using the calibration stored in %s" % path)
+    zeitgitter.config.calibrated = (stored['agents'], stored['parallel'])
+    arg.number_of_gpg_agents = stored['agents']
+    arg.max_parallel_signatures = stored['parallel']
+    stamper.reconfigure()
+    logging.info("Calibrated: %d parallel signatures on %d agent(s)"
+                 % (arg.max_parallel_signatures, arg.number_of_gpg_agents))
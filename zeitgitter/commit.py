@@ -22,6 +22,8 @@
 #
 # The state machine used is described in ../doc/StateMachine.md
 
+import collections
+import contextlib
 import datetime
 import logging as _logging
 import os
@@ -33,7 +35,11 @@ import traceback
 from pathlib import Path
 
 import zeitgitter.config
-import zeitgitter.mail
+import zeitgitter.faults
+import zeitgitter.health
+import zeitgitter.index
+import zeitgitter.merkle
+import zeitgitter.metrics
 import zeitgitter.stamper
 
 logging = _logging.getLogger('commit')
@@ -44,8 +50,87 @@ logging = _logging.getLogger('commit')
 # - performing other operations in the repository
 serialize = threading.Lock()
 
+# Entries appended to `hashes.work` since the last rotation (protected by
+# `serialize`; see `note_logged()`), to rotate early when it grows too large
+# or old
+work_entries = 0
+work_bytes = 0
+work_oldest = None
+zeitgitter.metrics.Gauge('zeitgitter_pending_entries',
+                         "Commit IDs in `hashes.work`, not yet committed",
+                         fn=lambda: work_entries)
+zeitgitter.metrics.Gauge('zeitgitter_pending_bytes',
+                         "Size of `hashes.work`",
+                         fn=lambda: work_bytes)
+# Set when `wait_until()` should check for early rotation
+rotate_wakeup = threading.Event()
+# Whether commits have been made since the last full round (upstream
+# timestamping, pushing, mail)
+rotated_since_round = False
+
+# Scheduling of rounds (see `schedule()`), protected by `schedule_lock`
+schedule_lock = threading.Lock()
+current_round = None
+missed_slots = 0
+last_missed_slot = None
+# The most recent rounds, oldest first
+rounds = collections.deque(maxlen=100)
+# Set by `pause()` before a graceful restart: no further rounds are started
+paused = False
+# The thread running `wait_until()`
+waiter = None
+
+
+class Round:
+    """Timing information of one commit round (`kind` `scheduled`) or early
+    rotation (`kind` `early`)"""
+
+    def __init__(self, kind='scheduled', slot=None, coalesced=0):
+        self.kind = kind
+        self.slot = slot
+        self.coalesced = coalesced  # Number of missed slots included
+        self.start = time.time()
+        self.end = None
+        self.overrun = False
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0)
+                                 + time.time() - start)
+
+    def finish(self):
+        """Record the end; the caller adds the round to `rounds` (holding
+        `schedule_lock`)"""
+        self.end = time.time()
+        for (name, duration) in self.phases.items():
+            zeitgitter.metrics.round_phase.child(
+                self.kind, name).observe(duration)
+        logging.info("%s round took %.3fs (%s)%s"
+                     % (self.kind.capitalize(), self.end - self.start,
+                        ', '.join("%s %.3fs" % p for p in self.phases.items()),
+                        ", overran its slot" if self.overrun else ""))
+
+    def as_dict(self):
+        return {'kind': self.kind,
+                'slot': self.slot,
+                'start': self.start,
+                'duration': None if self.end is None else self.end - self.start,
+                'overrun': self.overrun,
+                'coalesced': self.coalesced,
+                'phases': dict(self.phases)}
+
 
 def commit_to_git(repo, log, preserve=None, msg="Newly timestamped commits"):
+    # Record the root of the Merkle tree over the entries, to allow
+    # inclusion proofs for single entries (see `zeitgitter.merkle`)
+    with log.open('rb') as f:
+        leaves = zeitgitter.merkle.entries(f.read())
+    msg = msg + '\n\n' + zeitgitter.merkle.root_trailer(leaves)
     subprocess.run(['git', 'add', log.as_posix()],
                    cwd=repo, check=True)
     env = os.environ.copy()
@@ -86,12 +171,107 @@ def rotate_log_file(tmp, log):
     tmp.rename(log)
 
 
+def note_logged(entries, size):
+    """Account for `entries` lines (`size` bytes) just appended to
+    `hashes.work`. Call only while holding `serialize`."""
+    global work_entries, work_bytes, work_oldest
+    first = work_oldest is None
+    if first:
+        work_oldest = time.time()
+    work_entries += entries
+    work_bytes += size
+    if rotation_due() or (first and
+                          zeitgitter.config.arg.rotate_max_age is not None):
+        rotate_wakeup.set()
+
+
+def reset_logged(entries=0, size=0):
+    global work_entries, work_bytes, work_oldest
+    work_entries = entries
+    work_bytes = size
+    work_oldest = time.time() if entries > 0 else None
+
+
+def rotation_deadline():
+    """When `hashes.work` reaches `--rotate-max-age`, or `None`"""
+    max_age = zeitgitter.config.arg.rotate_max_age
+    oldest = work_oldest
+    if max_age is None or oldest is None:
+        return None
+    return oldest + max_age
+
+
+def rotation_due():
+    """Should `hashes.work` be rotated before the next interval?"""
+    arg = zeitgitter.config.arg
+    if arg.rotate_max_entries is not None and work_entries >= arg.rotate_max_entries:
+        return True
+    if arg.rotate_max_size is not None and work_bytes >= arg.rotate_max_size:
+        return True
+    deadline = rotation_deadline()
+    return deadline is not None and time.time() >= deadline
+
+
+def rotate(repo, tmp, log, preserve, rnd):
+    """Rotate `hashes.work` and commit it, accounting the time to `rnd`.
+    Returns whether a commit was made. Call only while holding
+    `serialize`."""
+    global rotated_since_round
+    with rnd.phase('commit'):
+        commit_dangling(repo, log)
+    # See comment in `commit_dangling`
+    stat = None
+    try:
+        stat = tmp.stat()
+    except FileNotFoundError:
+        logging.info("Nothing to rotate")
+    if stat is None:
+        return False
+    if stat.st_size == 0 and zeitgitter.config.arg.skip_empty_intervals:
+        logging.info("No new entries, skipping commit")
+        return False
+    with rnd.phase('rotate'):
+        rotate_log_file(tmp, log)
+        reset_logged()
+    zeitgitter.health.success('rotation')
+    d = datetime.datetime.utcfromtimestamp(stat.st_mtime)
+    dstr = d.strftime('%Y-%m-%d %H:%M:%S UTC')
+    with rnd.phase('commit'):
+        commit_to_git(repo, log, preserve,
+                      "Newly timestamped commits up to " + dstr)
+    zeitgitter.health.success('commit')
+    with tmp.open(mode='ab'):
+        pass  # Recreate hashes.work
+    rotated_since_round = True
+    return True
+
+
+def rotate_early():
+    """Rotate and commit only, leaving upstream timestamping, pushing, and
+    mail to the next regular round (they cover all earlier commits)"""
+    repo = zeitgitter.config.arg.repository
+    rnd = Round('early')
+    with serialize:
+        if not rotation_due():
+            return  # Somebody else was faster
+        logging.info("Rotating early (%d entries, %d bytes)"
+                     % (work_entries, work_bytes))
+        rotate(repo, Path(repo, 'hashes.work'), Path(repo, 'hashes.log'),
+               Path(repo, 'hashes.stamp'), rnd)
+    with rnd.phase('commit'):
+        zeitgitter.index.update()
+    rnd.finish()
+    with schedule_lock:
+        rounds.append(rnd)
+
+
 def push_upstream(repo, to, branches):
     logging.info("Pushing to %s" % (['git', 'push', to] + branches))
     ret = subprocess.run(['git', 'push', to] + branches,
                          cwd=repo)
     if ret.returncode != 0:
         logging.error("'git push %s %s' failed" % (to, ' '.join(branches)))
+    return ret.returncode == 0
 
 
 def cross_timestamp(repo, options, delete_fake_time=False):
@@ -107,13 +287,19 @@ def cross_timestamp(repo, options, delete_fake_time=False):
         del env['ZEITGITTER_FAKE_TIME']
     else:
         env = os.environ
+    if zeitgitter.faults.inject('upstream'):
+        logging.error("Injected failure of git timestamp %s"
+                      % ' '.join(options))
+        return False
     ret = subprocess.run(['git', 'timestamp'] + options, cwd=repo, env=env)
     if ret.returncode != 0:
         sys.stderr.write("git timestamp " + ' '.join(options) + " failed")
+    return ret.returncode == 0
 
 
-def do_commit():
-    """To be called in a non-daemon thread to reduce possibilities of
+def do_commit(rnd=None):
+    """Perform one round, accounting the time of each phase to `rnd`.
+    To be called in a non-daemon thread to reduce possibilities of
     early termination.
 
     0. Check if there is anything uncommitted
@@ -122,63 +308,169 @@ def do_commit():
     3. (Optionally) cross-timestamp using HTTPS (synchronous)
     4. (Optionally) push
     5. (Optionally) cross-timestamp using email (asynchronous)"""
+    global rotated_since_round
+    if rnd is None:
+        rnd = Round()
     try:
         repo = zeitgitter.config.arg.repository
         tmp = Path(repo, 'hashes.work')
         log = Path(repo, 'hashes.log')
         preserve = Path(repo, 'hashes.stamp')
         with serialize:
-            commit_dangling(repo, log)
-            # See comment in `commit_dangling`
-            stat = None
-            try:
-                stat = tmp.stat()
-            except FileNotFoundError:
-                logging.info("Nothing to rotate")
-            if stat is not None:
-                rotate_log_file(tmp, log)
-                d = datetime.datetime.utcfromtimestamp(stat.st_mtime)
-                dstr = d.strftime('%Y-%m-%d %H:%M:%S UTC')
-                commit_to_git(repo, log, preserve,
-                              "Newly timestamped commits up to " + dstr)
-                with tmp.open(mode='ab'):
-                    pass  # Recreate hashes.work
+            rotate(repo, tmp, log, preserve, rnd)
+            if (not rotated_since_round
+                    and zeitgitter.config.arg.skip_empty_intervals):
+                logging.info("Nothing new, skipping interval")
+                zeitgitter.health.success('round')
+                return
+            rotated_since_round = False
+        with rnd.phase('commit'):
+            zeitgitter.index.update()
         repositories = zeitgitter.config.arg.push_repository
         branches = zeitgitter.config.arg.push_branch
-        for r in zeitgitter.config.arg.upstream_timestamp:
-            logging.info("Cross-timestamping %s" % r)
-            if '=' in r:
-                (branch, server) = r.split('=', 1)
-                cross_timestamp(repo, ['--branch', branch, '--server', server])
-            else:
-                cross_timestamp(repo, ['--server', r], delete_fake_time=True)
-            time.sleep(zeitgitter.config.arg.upstream_sleep.total_seconds())
-        for r in repositories:
-            logging.info("Pushing upstream to %s" % r)
-            push_upstream(repo, r, branches)
+        with rnd.phase('cross-timestamp'):
+            for r in zeitgitter.config.arg.upstream_timestamp:
+                logging.info("Cross-timestamping %s" % r)
+                if '=' in r:
+                    (branch, server) = r.split('=', 1)
+                    ok = cross_timestamp(repo, ['--branch', branch, '--server', server])
+                else:
+                    ok = cross_timestamp(repo, ['--server', r], delete_fake_time=True)
+                if ok:
+                    zeitgitter.health.success('cross-timestamp:' + r)
+                else:
+                    zeitgitter.health.failure('cross-timestamp:' + r)
+                time.sleep(zeitgitter.config.arg.upstream_sleep.total_seconds())
+        with rnd.phase('push'):
+            for r in repositories:
+                logging.info("Pushing upstream to %s" % r)
+                if push_upstream(repo, r, branches):
+                    zeitgitter.health.success('push:' + r)
+                else:
+                    zeitgitter.health.failure('push:' + r)
 
         if zeitgitter.config.arg.stamper_own_address:
             logging.info("cross-timestamping by mail")
-            zeitgitter.mail.async_email_timestamp(preserve)
+            with rnd.phase('mail'):
+                from zeitgitter import mail  # Only loaded if needed
+                mail.async_email_timestamp(preserve)
         logging.info("do_commit done")
+        zeitgitter.health.success('round')
     except Exception as e:
+        zeitgitter.health.failure('round')
         logging.error("Unhandled exception in do_commit() thread: %s: %s" %
                       (e, ''.join(traceback.format_tb(sys.exc_info()[2]))))
 
 
+def run_rounds(rnd):
+    """Run `rnd` and, if slots were missed meanwhile, a single catch-up
+    round for all of them (and so on)"""
+    global current_round, missed_slots
+    while True:
+        do_commit(rnd)
+        rnd.finish()
+        with schedule_lock:
+            # Together, so that it is never listed twice or not at all
+            rounds.append(rnd)
+            if missed_slots == 0:
+                current_round = None
+                return
+            rnd = Round('scheduled', last_missed_slot, missed_slots)
+            current_round = rnd
+            missed_slots = 0
+
+
+def schedule(slot):
+    """Start a round for `slot`, unless one is still running. Then, record
+    the overrun and coalesce the slot into the round following it."""
+    global current_round, missed_slots, last_missed_slot
+    with schedule_lock:
+        if paused:
+            logging.warning("Restarting, skipping the round for %s (its"
+                            " entries will be committed in the next one)"
+                            % time.strftime('%H:%M:%S', time.gmtime(slot)))
+            return
+        if current_round is not None:
+            current_round.overrun = True
+            zeitgitter.metrics.round_overruns.inc()
+            missed_slots += 1
+            last_missed_slot = slot
+            logging.warning("Round for %s still running, %d slot(s) missed"
+                            % (time.strftime('%H:%M:%S',
+                                             time.gmtime(current_round.slot)),
+                               missed_slots))
+            return
+        current_round = Round('scheduled', slot)
+        rnd = current_round
+    threading.Thread(target=run_rounds, args=(rnd,), daemon=False).start()
+
+
+def pause(timeout):
+    """Do not start any further rounds and wait up to `timeout` seconds for
+    the running one (including catch-up rounds), if any, to finish. Returns
+    whether no round is running anymore."""
+    global paused
+    end = time.time() + timeout
+    with schedule_lock:
+        paused = True
+    while True:
+        with schedule_lock:
+            if current_round is None:
+                return True
+        if time.time() >= end:
+            return False
+        time.sleep(0.1)
+
+
+def recent_rounds():
+    """The most recent rounds (as dicts), oldest first, including the one
+    currently running, if any"""
+    with schedule_lock:
+        ret = [r.as_dict() for r in rounds]
+        if current_round is not None:
+            ret.append(current_round.as_dict())
+    return ret
+
+
 def wait_until():
-    """Run at given interval and offset"""
-    interval = zeitgitter.config.arg.commit_interval.total_seconds()
-    offset = zeitgitter.config.arg.commit_offset.total_seconds()
+    """Run at given interval and offset (re-read after every slot, to pick
+    up a reloaded configuration)"""
     while True:
+        interval = zeitgitter.config.arg.commit_interval.total_seconds()
+        offset = zeitgitter.config.arg.commit_offset.total_seconds()
         now = time.time()
         until = now - (now % interval) + offset
         if until <= now:
             until += interval
-        time.sleep(until - now)
-        threading.Thread(target=do_commit, daemon=False).start()
+        while now < until:
+            timeout = until - now
+            deadline = rotation_deadline()
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - now))
+            rotate_wakeup.wait(timeout)
+            rotate_wakeup.clear()
+            if rotation_due():
+                try:
+                    rotate_early()
+                except Exception as e:
+                    logging.error("Early rotation failed: %s" % e)
+            now = time.time()
+        schedule(until)
+
+
+def count_logged():
+    """Initialize the counters from an existing `hashes.work`"""
+    try:
+        with Path(zeitgitter.config.arg.repository, 'hashes.work').open('rb') as f:
+            contents = f.read()
+        reset_logged(contents.count(b'\n'), len(contents))
+    except FileNotFoundError:
+        pass
 
 
 def run():
     """Start background thread to wait for given time"""
-    threading.Thread(target=wait_until, daemon=True).start()
+    global waiter
+    count_logged()
+    waiter = threading.Thread(target=wait_until, daemon=True)
+    waiter.start()
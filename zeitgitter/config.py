@@ -22,14 +22,18 @@
 
 import argparse
 import datetime
+import ipaddress
 import logging as _logging
 import os
 import random
+import re
 import sys
+import tempfile
 
 import configargparse
 
 import zeitgitter.deltat
+import zeitgitter.faults
 import zeitgitter.version
 
 logging = _logging.getLogger('config')
@@ -47,8 +51,132 @@ def print_sample_config():
     sys.exit(0)
 
 
+# Settings applied by `reload()` to the running server (see also
+# `zeitgitter.server.reload_config()`); all others need a restart. Those
+# derived from others unless set (`health_max_age`, `health_max_mail_wait`,
+# `number_of_gpg_agents_secondary`) are derived again by `parse_args()`.
+RELOADABLE = ('debug_level', 'max_parallel_signatures', 'max_parallel_timeout',
+              'number_of_gpg_agents', 'number_of_gpg_agents_secondary',
+              'commit_interval', 'commit_offset',
+              'upstream_timestamp', 'upstream_sleep', 'push_repository',
+              'push_branch', 'keep_alive_timeout', 'keep_alive_max_requests',
+              'dedup_window', 'health_max_age', 'health_max_mail_wait')
+# Modified while starting up (key selection) or chosen randomly
+DERIVED = ('keyid', 'commit_offset_random')
+
+# The arguments to `get_args()`, for `reload()`
+original = (None, None)
+# (number-of-gpg-agents, max-parallel-signatures) determined by
+# `--calibrate-signing`, if any (see `zeitgitter.calibrate`)
+calibrated = None
+
+
 def get_args(args=None, config_file_contents=None):
-    global arg
+    global arg, original
+    original = (args, config_file_contents)
+    arg = parse_args(args, config_file_contents)
+    _logging.basicConfig()
+    set_log_levels(arg.debug_level)
+    return arg
+
+
+def log_levels(setting):
+    """Parse a `--debug-level` value into a dict logger name (`None` for
+    the root logger) → level. Raises `ValueError` on unknown levels."""
+    levels = {}
+    for level in str(setting).split(','):
+        if '=' in level:
+            (logger, lvl) = level.split('=', 1)
+        else:
+            logger = None  # Root logger
+            lvl = level
+        try:
+            lvl = int(lvl)
+            lvl = _logging.WARN - lvl * (_logging.WARN - _logging.INFO)
+        except ValueError:
+            # Does not work in Python 3.4.0 and 3.4.1
+            # See note in https://docs.python.org/3/library/logging.html#logging.getLevelName
+            lvl = _logging.getLevelName(lvl.upper())
+            if not isinstance(lvl, int):
+                raise ValueError("Unknown level %r" % level)
+        levels[logger] = lvl
+    return levels
+
+
+# The loggers whose level was set by `set_log_levels()`
+leveled = set()
+
+
+def set_log_levels(setting):
+    """Apply a `--debug-level` value; loggers no longer mentioned are
+    reset (the root logger to WARNING, the others to their parent's)"""
+    global leveled
+    levels = log_levels(setting)
+    for logger in leveled - set(levels):
+        _logging.getLogger(logger).setLevel(
+            _logging.WARNING if logger is None else _logging.NOTSET)
+    for (logger, lvl) in levels.items():
+        _logging.getLogger(logger).setLevel(lvl)
+    leveled = set(levels)
+
+
+def reload():
+    """Parse the configuration (file, environment, and command line) again
+    and apply the `RELOADABLE` settings to `arg`. Returns the names of the
+    settings changed and of those ignored (needing a restart). Raises
+    `ValueError` if the new configuration is invalid; `arg` is unchanged
+    then."""
+    try:
+        new = parse_args(*original)
+    except SystemExit as e:
+        raise ValueError("Invalid configuration: %s" % e)
+    if new.commit_offset_random and new.commit_interval == arg.commit_interval:
+        new.commit_offset = arg.commit_offset  # Keep the one chosen
+    if new.calibrate_signing and calibrated is not None:
+        # The configured values are only the upper bounds
+        new.number_of_gpg_agents = min(calibrated[0],
+                                       new.number_of_gpg_agents)
+        new.max_parallel_signatures = min(calibrated[1],
+                                          new.max_parallel_signatures)
+    changed = [n for n in RELOADABLE if getattr(new, n) != getattr(arg, n)]
+    ignored = [n for n in sorted(vars(new))
+               if n not in RELOADABLE and n not in DERIVED
+               and getattr(new, n) != getattr(arg, n, None)]
+    for n in changed:
+        setattr(arg, n, getattr(new, n))
+    if 'debug_level' in changed:
+        set_log_levels(arg.debug_level)
+    return (changed, ignored)
+
+
+def parse_trusted(spec, option):
+    """The IP address prefixes (and `unix`) in the comma-separated `spec`,
+    as for `--trusted-proxies`"""
+    if spec.strip() == 'none':
+        return []
+    proxies = re.split(r'\s*,\s*', spec.strip())
+    try:
+        for net in proxies:
+            if net != 'unix':
+                ipaddress.ip_network(net)
+    except ValueError as e:
+        sys.exit("%s: %s" % (option, e))
+    return proxies
+
+
+def split_listener(spec, option):
+    """`address[;trusted=<proxies>]` as `(address, proxies)`; `proxies` is
+    `None` for the `--trusted-proxies` default"""
+    (address, sep, policy) = spec.partition(';')
+    if not sep:
+        return (address, None)
+    if not policy.startswith('trusted='):
+        sys.exit("%s: Unknown listener option %r in %r"
+                 % (option, policy, spec))
+    return (address, parse_trusted(policy[len('trusted='):], option))
+
+
+def parse_args(args=None, config_file_contents=None):
     writeback = {}
     # Config file in /etc or the program directory
     parser = configargparse.ArgumentParser(
@@ -66,6 +194,10 @@ def get_args(args=None, config_file_contents=None):
                         action='store_true',
                         help="""output sample configuration file from package
                             and exit""")
+    parser.add_argument('--print-startup-timings',
+                        action='store_true',
+                        help="""output how long each phase of starting up
+                            took, before starting to serve""")
     parser.add_argument('--debug-level',
                         default='INFO',
                         help="""amount of debug output: WARN, INFO, or DEBUG.
@@ -73,9 +205,39 @@ def get_args(args=None, config_file_contents=None):
                             specified using 'name=level'. Valid logger names:
                             `config`, `server`, `stamper`, `commit` (incl.
                             requesting cross-timestamps), `gnupg`, `mail`
-                            (interfacing with PGP Timestamping Server).
+                            (interfacing with PGP Timestamping Server),
+                            `index`, `aggregate`, `trace`, `profiler`, `calibrate`.
                             Example: `DEBUG,gnupg=INFO` sets the default
                             debug level to DEBUG, except for `gnupg`.""")
+    parser.add_argument('--trace-sample-rate',
+                        default=0.0, type=float,
+                        help="""fraction of requests (0…1) for which the
+                            time spent in each stage is logged as a JSON
+                            line by the `trace` logger""")
+    parser.add_argument('--trace-slow-threshold',
+                        help="""also log the stages of every request taking
+                            at least this long (e.g., `0.5s`). Default:
+                            disabled""")
+    parser.add_argument('--profile-dir',
+                        default=tempfile.gettempdir(),
+                        help="""directory to write profiles (on SIGUSR1)
+                            and thread stack dumps (on SIGQUIT) to""")
+    parser.add_argument('--profile-duration',
+                        default='30s',
+                        help="how long to profile on SIGUSR1")
+    parser.add_argument('--record-traffic',
+                        help="""append one JSON line per request (arrival
+                            time, type, sizes, status; client addresses and
+                            commit IDs pseudonymized) to this file, for
+                            `zeitgitter-replay`. Default: disabled""")
+    parser.add_argument('--fault-injection',
+                        default='',
+                        help="""FOR TESTING ONLY: delay and/or fail
+                            operations, e.g. `fsync=0.2s@0.01, agent0=10s,
+                            upstream=5m+fail`. Points: fsync, sign,
+                            agent<n>, upstream; actions: a duration, `fail`,
+                            or both joined by `+`; optionally followed by
+                            `@probability`""")
     parser.add_argument('--version',
                         action='version', version=zeitgitter.version.VERSION)
 
@@ -83,6 +245,15 @@ def get_args(args=None, config_file_contents=None):
     parser.add_argument('--keyid',
                         help="""the PGP key ID to timestamp with, creating
                             this key first if necessary.""")
+    parser.add_argument('--keyid-secondary',
+                        help="""a second PGP key ID (which must exist),
+                            ideally of a different algorithm (e.g., RSA
+                            besides Ed25519): tags and commits are then
+                            signed with both keys in parallel, and the two
+                            signatures combined into one signature block.
+                            Note that `git verify-tag`/`verify-commit`
+                            reject objects with more than one signature;
+                            `gpg --verify` checks both""")
     parser.add_argument('--own-url',
                         help="the URL of this service (REQUIRED)")
     parser.add_argument('--domain',
@@ -103,10 +274,37 @@ def get_args(args=None, config_file_contents=None):
                         help="path to the webroot (fallback: in-module files)")
     parser.add_argument('--listen-address',
                         default='127.0.0.1',  # Still not all machines support ::1
-                        help="IP address to listen on")
+                        help="""space-separated IP addresses to listen on
+                            (may be empty, to only listen on
+                            `--listen-unix`). `addr;trusted=<prefixes>`
+                            overrides `--trusted-proxies` for this listener
+                            (comma-separated, without spaces, or `none`)""")
     parser.add_argument('--listen-port',
                         default=15177, type=int,
                         help="port number to listen on")
+    parser.add_argument('--listen-unix',
+                        help="""also listen on a Unix domain socket at this
+                            path, e.g., for a reverse proxy on the same
+                            machine; `path;trusted=<prefixes>` as for
+                            `--listen-address`. Default: none""")
+    parser.add_argument('--listen-unix-mode',
+                        default='660',
+                        help="permissions (octal) of the `--listen-unix`"
+                        " socket")
+    parser.add_argument('--keep-alive-timeout',
+                        default='60s',
+                        help="""close persistent (keep-alive) connections
+                            idle for this long; 0 for no limit""")
+    parser.add_argument('--keep-alive-max-requests',
+                        type=int,
+                        default=1000,
+                        help="""close persistent connections after this
+                            many requests; 0 for no limit""")
+    parser.add_argument('--restart-drain-timeout',
+                        default='30s',
+                        help="""on a graceful restart (SIGUSR2), wait at
+                            most this long for requests and a commit round
+                            in progress to finish""")
     parser.add_argument('--cache-control-static',
                         default="max-age=86400,"
                         " stale-while-revalidate=86400,"
@@ -122,11 +320,37 @@ def get_args(args=None, config_file_contents=None):
                         # Unique Local Unicast
                         'fc00::/7',
                         # Localhost
-                        '127.0.0.0/8', '::1/128')),
+                        '127.0.0.0/8', '::1/128',
+                        # Peers on `--listen-unix` (or a passed Unix socket)
+                        'unix')),
                         help="A comma-separated list of IP address prefixes"
                         " which are trusted for providing `X-Forwarded-For`"
                         " headers (i.e., they are allowed to override the"
-                        " source IP address). Disable by setting to `none`.")
+                        " source IP address). `unix` trusts the peers of Unix"
+                        " domain sockets. Disable by setting to `none`."
+                        " The default for listeners without their own"
+                        " `;trusted=`.")
+    parser.add_argument('--admin-networks',
+                        default='127.0.0.0/8,::1/128',
+                        help="A comma-separated list of IP address prefixes"
+                        " allowed to access administrative information, such"
+                        " as `/metrics`. Only direct connections qualify,"
+                        " i.e., requests with `X-Forwarded-For` never do."
+                        " Disable by setting to `none`.")
+    parser.add_argument('--health-max-age',
+                        help="""`/healthz/ready` fails if the last
+                            successful commit round, cross-timestamp (per
+                            upstream), or push (per repository) is older, or
+                            an entry has not been committed for this long.
+                            Default: `--commit-interval` plus 5 minutes""")
+    parser.add_argument('--health-max-mail-wait',
+                        help="""`/healthz/ready` fails if the PGP
+                            Timestamper has not replied for this long.
+                            Default: `--commit-interval` plus 30 minutes""")
+    parser.add_argument('--health-max-backlog',
+                        type=int,
+                        help="""`/healthz/ready` fails if more entries are
+                            waiting to be committed. Default: no limit""")
 
     # GnuPG
     parser.add_argument('--max-parallel-signatures',
@@ -141,11 +365,46 @@ def get_args(args=None, config_file_contents=None):
     parser.add_argument('--number-of-gpg-agents',
                         default=1, type=int,
                         help="number of gpg-agents to run")
+    parser.add_argument('--number-of-gpg-agents-secondary',
+                        type=int,
+                        help="""number of gpg-agents to run for
+                            `--keyid-secondary` (default: as many as
+                            `--number-of-gpg-agents`)""")
+    parser.add_argument('--calibrate-signing',
+                        action='store_true',
+                        help="""on startup, time test signatures at
+                            increasing concurrency and set
+                            `--number-of-gpg-agents` and
+                            `--max-parallel-signatures` (then upper bounds)
+                            from the knee of the throughput curve. The
+                            result is stored in the repository and reused
+                            on the same hardware""")
     parser.add_argument('--gnupg-home',
                         default=os.getenv('GNUPGHOME',
                                           os.getenv('HOME', '/var/lib/zeitgitter') + '/.gnupg'),
                         help="""GnuPG Home Dir to use (default from $GNUPGHOME
                             or $HOME/.gnupg or /var/lib/zeitgitter/.gnupg)""")
+    parser.add_argument('--aggregation-window',
+                        help="""enables `stamp-aggregate-v1` requests: all
+                            requests arriving within this time (e.g., `0.1s`)
+                            of the first are signed together with a single
+                            signature. Default: disabled""")
+    parser.add_argument('--aggregation-max-batch',
+                        type=int,
+                        default=1000,
+                        help="""sign a batch of `stamp-aggregate-v1`
+                            requests as soon as it has this many, without
+                            waiting for the end of `--aggregation-window`,
+                            to bound the batch's logging and signing
+                            time""")
+
+    parser.add_argument('--dedup-window',
+                        help="""identical `stamp-tag-v1` or `stamp-branch-v1`
+                            requests arriving while the first is being
+                            signed share its result; within this time
+                            (e.g., `30s`) after it, they are answered from a
+                            cache. `0s`: only share concurrent requests.
+                            Default: disabled""")
 
     # Stamping
     parser.add_argument('--commit-interval',
@@ -157,11 +416,40 @@ def get_args(args=None, config_file_contents=None):
                             For a production server, please fix a value in
                             the config file to avoid it jumping after every
                             restart.""")
+    parser.add_argument('--rotate-max-entries',
+                        type=int,
+                        help="""also rotate and commit as soon as this many
+                            commit IDs have been logged since the last
+                            rotation. Default: no limit""")
+    parser.add_argument('--rotate-max-size',
+                        type=int,
+                        help="""also rotate and commit as soon as the log
+                            reaches this many bytes. Default: no limit""")
+    parser.add_argument('--rotate-max-age',
+                        help="""also rotate and commit when the oldest
+                            logged commit ID reaches this age (e.g., `5m`).
+                            Default: no limit""")
+    parser.add_argument('--skip-empty-intervals',
+                        action='store_true',
+                        help="""do not create empty commits (and do not
+                            cross-timestamp or push) when nothing has been
+                            timestamped since the last interval""")
     parser.add_argument('--repository',
                         default=os.path.join(
                             os.getenv('HOME', '/var/lib/zeitgitter'), 'repo'),
                         help="""path to the GIT repository (default from
                             $HOME/repo or /var/lib/zeitgitter/repo)""")
+    parser.add_argument('--lookup-index',
+                        default='none',
+                        help="""path to the index of timestamped commit IDs
+                            (and Merkle tree nodes), enabling `lookup-v1`
+                            and `proof-v1` requests, e.g.,
+                            `<repository>/.git/zeitgitter-index.sqlite`.
+                            When missing, it is built from the whole history
+                            in the background after starting (proportional
+                            to the number of commits timestamped), and takes
+                            about 170 bytes per timestamped commit ID on
+                            disk. Default: `none` (disabled)""")
     parser.add_argument('--upstream-timestamp',
                         default='diversity gitta',
                         help="""any number of space-separated upstream
@@ -210,6 +498,12 @@ def get_args(args=None, config_file_contents=None):
                             (default from `--stamper-own-address`)""")
     parser.add_argument('--stamper-password', '--mail-password',
                         help="password to use for IMAP and SMTP")
+    parser.add_argument('--stamper-gpg',
+                        default='gpg1 --pgp2',
+                        help="""command (and options) used to verify the
+                            PGP Timestamper's replies. The PGP Timestamper
+                            key needs to be in the keyring used by this
+                            command""")
     parser.add_argument('--no-dovecot-bug-workaround', action='store_true',
                         help="""Some Dovecot mail server seem unable to match
                             the last char of an email address in an IMAP
@@ -239,21 +533,31 @@ def get_args(args=None, config_file_contents=None):
         parser.print_help()
         sys.exit("Required arguments missing: " + ", ".join(missing))
 
-    _logging.basicConfig()
-    for level in str(arg.debug_level).split(','):
-        if '=' in level:
-            (logger, lvl) = level.split('=', 1)
-        else:
-            logger = None  # Root logger
-            lvl = level
-        try:
-            lvl = int(lvl)
-            lvl = _logging.WARN - lvl * (_logging.WARN - _logging.INFO)
-        except ValueError:
-            # Does not work in Python 3.4.0 and 3.4.1
-            # See note in https://docs.python.org/3/library/logging.html#logging.getLevelName
-            lvl = _logging.getLevelName(lvl.upper())
-        _logging.getLogger(logger).setLevel(lvl)
+    try:
+        log_levels(arg.debug_level)
+    except ValueError as e:
+        sys.exit("--debug-level: %s" % e)
+
+    if arg.trace_sample_rate < 0 or arg.trace_sample_rate > 1:
+        sys.exit("--trace-sample-rate must be between 0 and 1")
+    if arg.trace_slow_threshold is not None:
+        arg.trace_slow_threshold = zeitgitter.deltat.parse_time(
+            arg.trace_slow_threshold).total_seconds()
+
+    arg.profile_duration = zeitgitter.deltat.parse_time(
+        arg.profile_duration).total_seconds()
+    arg.keep_alive_timeout = zeitgitter.deltat.parse_time(
+        arg.keep_alive_timeout).total_seconds() or None
+    arg.restart_drain_timeout = zeitgitter.deltat.parse_time(
+        arg.restart_drain_timeout).total_seconds()
+
+    try:
+        arg.fault_injection = zeitgitter.faults.parse(arg.fault_injection)
+    except ValueError as e:
+        sys.exit("--fault-injection: %s" % e)
+    if arg.fault_injection:
+        logging.warning("Fault injection active, for testing only: %s"
+                        % ', '.join(sorted(arg.fault_injection)))
 
     if arg.stamper_username is None:
         arg.stamper_username = arg.stamper_own_address
@@ -271,9 +575,11 @@ def get_args(args=None, config_file_contents=None):
         # Avoid the seconds around the full interval, to avoid clustering
         # with other system activity.
         arg.commit_offset = arg.commit_interval * random.uniform(0.05, 0.95)
+        arg.commit_offset_random = True
         logging.info("Chose --commit-offset %s" % arg.commit_offset)
     else:
         arg.commit_offset = zeitgitter.deltat.parse_time(arg.commit_offset)
+        arg.commit_offset_random = False
     if arg.commit_offset < datetime.timedelta(seconds=0):
         sys.exit("--commit-offset must be positive")
     if arg.commit_offset >= arg.commit_interval:
@@ -281,11 +587,81 @@ def get_args(args=None, config_file_contents=None):
 
     arg.upstream_sleep = zeitgitter.deltat.parse_time(arg.upstream_sleep)
 
+    if arg.health_max_age is None:
+        arg.health_max_age = arg.commit_interval + datetime.timedelta(minutes=5)
+    else:
+        arg.health_max_age = zeitgitter.deltat.parse_time(arg.health_max_age)
+    arg.health_max_age = arg.health_max_age.total_seconds()
+    if arg.health_max_mail_wait is None:
+        arg.health_max_mail_wait = (arg.commit_interval
+                                    + datetime.timedelta(minutes=30))
+    else:
+        arg.health_max_mail_wait = zeitgitter.deltat.parse_time(
+            arg.health_max_mail_wait)
+    arg.health_max_mail_wait = arg.health_max_mail_wait.total_seconds()
+
+    if arg.rotate_max_age is not None:
+        arg.rotate_max_age = zeitgitter.deltat.parse_time(
+            arg.rotate_max_age).total_seconds()
+    for (name, value) in (('--rotate-max-entries', arg.rotate_max_entries),
+                          ('--rotate-max-size', arg.rotate_max_size),
+                          ('--rotate-max-age', arg.rotate_max_age)):
+        if value is not None and value <= 0:
+            sys.exit("%s must be positive" % name)
+
+    try:
+        int(arg.listen_unix_mode, 8)
+    except ValueError:
+        sys.exit("--listen-unix-mode must be octal")
+
+    if arg.keep_alive_max_requests < 0:
+        sys.exit("--keep-alive-max-requests must not be negative")
+    if arg.max_parallel_signatures < 1:
+        sys.exit("--max-parallel-signatures must be positive")
+    if arg.number_of_gpg_agents < 1:
+        sys.exit("--number-of-gpg-agents must be positive")
+    if arg.number_of_gpg_agents_secondary is None:
+        arg.number_of_gpg_agents_secondary = arg.number_of_gpg_agents
+    elif arg.number_of_gpg_agents_secondary < 1:
+        sys.exit("--number-of-gpg-agents-secondary must be positive")
+    if arg.keyid_secondary is not None and arg.keyid_secondary == arg.keyid:
+        sys.exit("--keyid-secondary must differ from --keyid")
+
+    if arg.aggregation_window is not None:
+        arg.aggregation_window = zeitgitter.deltat.parse_time(
+            arg.aggregation_window).total_seconds()
+        if arg.aggregation_window <= 0:
+            sys.exit("--aggregation-window must be positive")
+    if arg.aggregation_max_batch < 1:
+        sys.exit("--aggregation-max-batch must be positive")
+
+    if arg.dedup_window is not None:
+        arg.dedup_window = zeitgitter.deltat.parse_time(
+            arg.dedup_window).total_seconds()
+
+    if arg.lookup_index == 'none':
+        arg.lookup_index = None
+
+    arg.trusted_proxies = parse_trusted(arg.trusted_proxies,
+                                        '--trusted-proxies')
+
+    if arg.admin_networks == 'none':
+        arg.admin_networks = []
+    else:
+        arg.admin_networks = re.split(r'\s*,\s*', arg.admin_networks)
+
     if arg.domain is None:
         arg.domain = arg.own_url.replace('https://', '')
 
     # Work around ConfigArgParse list bugs by implementing lists ourselves
     # and working around the problem that values cannot start with `-`.
+    arg.listen_address = [split_listener(a, '--listen-address')
+                          for a in arg.listen_address.split()]
+    if arg.listen_unix is not None:
+        (arg.listen_unix, arg.listen_unix_trusted) = split_listener(
+            arg.listen_unix, '--listen-unix')
+    else:
+        arg.listen_unix_trusted = None
     arg.upstream_timestamp = arg.upstream_timestamp.split()
     arg.push_repository = arg.push_repository.split()
     if arg.push_branch == '*':
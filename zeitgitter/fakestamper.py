@@ -0,0 +1,674 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Local stand-in for the PGP Digital Timestamping Service
+#
+# Consists of an SMTP sink accepting stamping requests, a signer using a
+# throwaway OpenPGP key, and an IMAP server (including IDLE) from which the
+# signed replies can be fetched. This allows to exercise and benchmark
+# `zeitgitter.mail` offline, including injected delays and disconnects.
+#
+# Usage: python3 -m zeitgitter.fakestamper --help
+
+import argparse
+import email
+import logging as _logging
+import re
+import select
+import shutil
+import socketserver
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from time import gmtime, strftime
+
+import gnupg
+
+logging = _logging.getLogger('fakestamper')
+
+STAMPER_TO = 'clear@stamper.localhost'
+STAMPER_FROM = 'mailer@stamper.localhost'
+OWN_ADDRESS = 'zeitgitter@localhost'
+
+PREAMBLE = """Stamper is a service provided free of charge to Internet users.
+
+This is a local stand-in used for testing and benchmarking only.
+
+"""
+
+
+class Mailbox:
+    """A single, thread-safe IMAP INBOX"""
+
+    def __init__(self):
+        self.messages = []
+        self.changed = threading.Condition()
+
+    def deliver(self, raw):
+        """Add an RFC 822 message (`bytes`, CRLF line endings)"""
+        msg = email.message_from_bytes(raw)
+        header, sep, text = raw.partition(b'\r\n\r\n')
+        with self.changed:
+            self.messages.append({'raw': raw,
+                                  'text': text,
+                                  'from': msg.get('From', ''),
+                                  'to': msg.get('To', ''),
+                                  'subject': msg.get('Subject', ''),
+                                  'flags': set()})
+            self.changed.notify_all()
+
+    def count(self):
+        with self.changed:
+            return len(self.messages)
+
+    def wait_for_more(self, known, timeout):
+        """Wait until there are more than `known` messages;
+        return the current number of messages"""
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.messages) > known,
+                                  timeout=timeout)
+            return len(self.messages)
+
+    def search(self, criteria):
+        """Return the sequence numbers matching the (upper-cased) `criteria`,
+        a list of IMAP SEARCH tokens"""
+        tests = []
+        it = iter(criteria)
+        for c in it:
+            key = c.upper()
+            if key == 'ALL':
+                continue
+            elif key in ('FROM', 'TO', 'SUBJECT'):
+                needle = next(it).lower()
+                field = key.lower()
+                tests.append(lambda m, f=field, n=needle: n in m[f].lower())
+            elif key == 'UNSEEN':
+                tests.append(lambda m: '\\Seen' not in m['flags'])
+            elif key == 'SEEN':
+                tests.append(lambda m: '\\Seen' in m['flags'])
+            elif key == 'UNDELETED':
+                tests.append(lambda m: '\\Deleted' not in m['flags'])
+            elif key == 'LARGER':
+                size = int(next(it))
+                tests.append(lambda m, s=size: len(m['raw']) > s)
+            elif key == 'SMALLER':
+                size = int(next(it))
+                tests.append(lambda m, s=size: len(m['raw']) < s)
+            else:
+                raise ValueError("Unsupported search key %s" % c)
+        with self.changed:
+            return [i + 1 for i, m in enumerate(self.messages)
+                    if all(t(m) for t in tests)]
+
+    def message(self, seqno):
+        with self.changed:
+            return self.messages[seqno - 1]
+
+    def expunge(self):
+        with self.changed:
+            self.messages = [m for m in self.messages
+                             if '\\Deleted' not in m['flags']]
+
+
+class Signer:
+    """Clear-signs messages with a throwaway key in a temporary GnuPG home"""
+
+    def __init__(self):
+        self.home = tempfile.mkdtemp(prefix='fakestamper-gnupg-')
+        Path(self.home).chmod(0o700)
+        self.gpg = gnupg.GPG(gnupghome=self.home)
+        gki = self.gpg.gen_key_input(name_real='Fake Stamper',
+                                     name_email=STAMPER_FROM,
+                                     key_type='eddsa', key_curve='Ed25519',
+                                     key_usage='sign')
+        key = self.gpg.gen_key('%no-protection\n' + gki)
+        if key.fingerprint is None:
+            raise RuntimeError("Cannot create throwaway key: %s" % key.stderr)
+        self.fingerprint = key.fingerprint
+        self.keyid = key.fingerprint[-8:]
+        logging.info("Created throwaway key %s in %s"
+                     % (self.fingerprint, self.home))
+
+    def verify_command(self):
+        """Value for `--stamper-gpg` to verify our replies"""
+        return 'gpg --homedir %s' % self.home
+
+    def clearsign(self, text):
+        sig = self.gpg.sign(text, keyid=self.fingerprint, clearsign=True)
+        if not sig.data:
+            raise RuntimeError("Clear-signing failed: %s" % sig.stderr)
+        return str(sig)
+
+    def cleanup(self):
+        subprocess.run(['gpgconf', '--homedir', self.home,
+                        '--kill', 'gpg-agent'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+def create_certificate(directory):
+    """Self-signed certificate for STARTTLS; `mail.py` does not verify it"""
+    cert = Path(directory, 'cert.pem')
+    key = Path(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-nodes', '-days', '2',
+                    '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-subj', '/CN=localhost',
+                    '-keyout', key.as_posix(), '-out', cert.as_posix()],
+                   check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert.as_posix(), key.as_posix())
+    return ctx
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    """Common line-based protocol handling, including STARTTLS"""
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = bytes(line, 'ASCII')
+        self.wfile.write(line + b'\r\n')
+
+    def recv(self):
+        line = self.rfile.readline(65536)
+        if line == b'':
+            raise ConnectionResetError("Client closed connection")
+        return str(line, 'ASCII', errors='replace').rstrip('\r\n')
+
+    def starttls(self):
+        self.connection = self.server.fake.tls.wrap_socket(
+            self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb', buffering=0)
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+
+class SMTPHandler(LineHandler):
+    def handle(self):
+        fake = self.server.fake
+        if fake.should_refuse('smtp'):
+            return
+        try:
+            self.send('220 localhost ESMTP fakestamper')
+            mailfrom = None
+            rcpts = []
+            while True:
+                line = self.recv()
+                verb = line.split(' ', 1)[0].upper()
+                if verb in ('EHLO', 'HELO'):
+                    self.send('250-localhost')
+                    self.send('250-STARTTLS')
+                    self.send('250-AUTH PLAIN')
+                    self.send('250 8BITMIME')
+                elif verb == 'STARTTLS':
+                    self.send('220 Ready to start TLS')
+                    self.starttls()
+                elif verb == 'AUTH':
+                    fields = line.split()
+                    if len(fields) < 3:
+                        self.send('334 ')
+                        self.recv()
+                    self.send('235 Authentication successful')
+                elif verb == 'MAIL':
+                    mailfrom = line[line.index(':') + 1:].strip(' <>')
+                    rcpts = []
+                    self.send('250 OK')
+                elif verb == 'RCPT':
+                    rcpts.append(line[line.index(':') + 1:].strip(' <>'))
+                    self.send('250 OK')
+                elif verb == 'DATA':
+                    self.send('354 End data with <CR><LF>.<CR><LF>')
+                    lines = []
+                    while True:
+                        raw = self.rfile.readline()
+                        if raw in (b'.\r\n', b'.\n', b''):
+                            break
+                        if raw.startswith(b'.'):
+                            raw = raw[1:]  # Undo dot-stuffing
+                        lines.append(raw)
+                    self.send('250 OK queued')
+                    fake.received(mailfrom, rcpts, b''.join(lines))
+                elif verb in ('RSET', 'NOOP'):
+                    self.send('250 OK')
+                elif verb == 'QUIT':
+                    self.send('221 Bye')
+                    return
+                else:
+                    self.send('502 Command not implemented')
+        except (ConnectionError, ssl.SSLError):
+            return
+
+
+def imap_tokens(args):
+    """Split IMAP arguments, honoring quoted strings and parentheses"""
+    return [t[0] if t[0] != '' else t[1] for t in
+            re.findall(r'"((?:[^"\\]|\\.)*)"|([^\s()]+)', args)]
+
+
+def imap_sequence(seqset, maximum):
+    ret = []
+    for part in seqset.split(','):
+        if ':' in part:
+            lo, hi = part.split(':', 1)
+            lo = maximum if lo == '*' else int(lo)
+            hi = maximum if hi == '*' else int(hi)
+            ret.extend(range(min(lo, hi), max(lo, hi) + 1))
+        else:
+            ret.append(maximum if part == '*' else int(part))
+    return [s for s in ret if 1 <= s <= maximum]
+
+
+class IMAPHandler(LineHandler):
+    capabilities = 'IMAP4rev1 STARTTLS IDLE AUTH=PLAIN'
+
+    def handle(self):
+        fake = self.server.fake
+        self.mailbox = fake.mailbox
+        if fake.should_refuse('imap'):
+            return
+        try:
+            self.send('* OK [CAPABILITY %s] fakestamper ready'
+                      % self.capabilities)
+            while True:
+                line = self.recv()
+                fields = line.split(' ', 2)
+                if len(fields) < 2:
+                    self.send('* BAD Missing command')
+                    continue
+                tag, command = fields[0], fields[1].upper()
+                args = fields[2] if len(fields) > 2 else ''
+                if command == 'UID':
+                    self.send('%s NO UID commands not supported' % tag)
+                    continue
+                method = getattr(self, 'do_' + command, None)
+                if method is None:
+                    self.send('%s BAD Command not implemented' % tag)
+                elif method(tag, args) is False:
+                    return
+        except (ConnectionError, ssl.SSLError, OSError):
+            return
+
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY %s' % self.capabilities)
+        self.send('%s OK CAPABILITY completed' % tag)
+
+    def do_STARTTLS(self, tag, args):
+        self.send('%s OK Begin TLS negotiation now' % tag)
+        self.starttls()
+
+    def do_LOGIN(self, tag, args):
+        self.send('%s OK LOGIN completed' % tag)
+
+    def do_SELECT(self, tag, args):
+        self.send('* %d EXISTS' % self.mailbox.count())
+        self.send('* 0 RECENT')
+        self.send('* FLAGS (\\Seen \\Deleted)')
+        self.send('%s OK [READ-WRITE] SELECT completed' % tag)
+
+    def do_NOOP(self, tag, args):
+        self.send('%s OK NOOP completed' % tag)
+
+    do_CHECK = do_NOOP
+
+    def do_EXPUNGE(self, tag, args):
+        self.mailbox.expunge()
+        self.send('%s OK EXPUNGE completed' % tag)
+
+    def do_CLOSE(self, tag, args):
+        self.mailbox.expunge()
+        self.send('%s OK CLOSE completed' % tag)
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE fakestamper logging out')
+        self.send('%s OK LOGOUT completed' % tag)
+        return False
+
+    def do_SEARCH(self, tag, args):
+        try:
+            found = self.mailbox.search(imap_tokens(args))
+        except (ValueError, StopIteration) as e:
+            self.send('%s BAD %s' % (tag, e))
+            return
+        self.send(('* SEARCH ' + ' '.join(map(str, found))).rstrip())
+        self.send('%s OK SEARCH completed' % tag)
+
+    def do_FETCH(self, tag, args):
+        seqset, items = args.split(' ', 1)
+        items = imap_tokens(items.upper())
+        for seqno in imap_sequence(seqset, self.mailbox.count()):
+            m = self.mailbox.message(seqno)
+            parts = []
+            for item in items:
+                if item in ('BODY[TEXT]', 'BODY.PEEK[TEXT]'):
+                    data = m['text']
+                    name = 'BODY[TEXT]'
+                elif item in ('BODY[]', 'BODY.PEEK[]', 'RFC822'):
+                    data = m['raw']
+                    name = 'RFC822' if item == 'RFC822' else 'BODY[]'
+                elif item == 'RFC822.SIZE':
+                    parts.append(b'RFC822.SIZE %d' % len(m['raw']))
+                    continue
+                elif item == 'FLAGS':
+                    parts.append(b'FLAGS (%s)'
+                                 % ' '.join(sorted(m['flags'])).encode())
+                    continue
+                else:
+                    continue
+                if '.PEEK' not in item:
+                    m['flags'].add('\\Seen')
+                parts.append(b'%s {%d}\r\n%s'
+                             % (name.encode(), len(data), data))
+            self.wfile.write(b'* %d FETCH (%s)\r\n'
+                             % (seqno, b' '.join(parts)))
+        self.send('%s OK FETCH completed' % tag)
+
+    def do_STORE(self, tag, args):
+        seqset, mode, flags = args.split(' ', 2)
+        flags = set(imap_tokens(flags))
+        for seqno in imap_sequence(seqset, self.mailbox.count()):
+            m = self.mailbox.message(seqno)
+            if mode.upper().startswith('+'):
+                m['flags'] |= flags
+            elif mode.upper().startswith('-'):
+                m['flags'] -= flags
+            else:
+                m['flags'] = flags
+            if '.SILENT' not in mode.upper():
+                self.send('* %d FETCH (FLAGS (%s))'
+                          % (seqno, ' '.join(sorted(m['flags']))))
+        self.send('%s OK STORE completed' % tag)
+
+    def do_IDLE(self, tag, args):
+        fake = self.server.fake
+        # Dovecot's wording, which `zeitgitter.mail.imap_idle()` expects
+        self.send('+ idling')
+        known = self.mailbox.count()
+        started = time.time()
+        while True:
+            if (fake.drop_idle_after is not None
+                    and time.time() - started > fake.drop_idle_after):
+                logging.info("Injected disconnect while IDLE")
+                return False
+            now = self.mailbox.wait_for_more(known, timeout=0.05)
+            if now > known:
+                self.send('* %d EXISTS' % now)
+                known = now
+            pending = (isinstance(self.connection, ssl.SSLSocket)
+                       and self.connection.pending())
+            if pending or select.select([self.connection], [], [], 0)[0]:
+                line = self.recv()
+                if line.upper() == 'DONE':
+                    self.send('%s OK IDLE terminated' % tag)
+                    return
+                else:
+                    self.send('%s BAD Expected DONE' % tag)
+                    return
+
+
+class ThreadingServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, fake, handler):
+        self.fake = fake
+        super().__init__(('127.0.0.1', 0), handler)
+
+
+class FakeStamper:
+    """Local PGP Digital Timestamping Service.
+
+    Fault injection parameters:
+    - `reply_delay`: Seconds between receiving a request and delivering
+      the signed reply to the IMAP INBOX.
+    - `drop_idle_after`: Seconds after which an IMAP IDLE connection is
+      dropped by the server (`None`: never).
+    - `refuse_smtp`, `refuse_imap`: Number of connections to be closed
+      immediately after being accepted."""
+
+    def __init__(self, reply_delay=0, drop_idle_after=None,
+                 refuse_smtp=0, refuse_imap=0):
+        self.reply_delay = reply_delay
+        self.drop_idle_after = drop_idle_after
+        self.refuse = {'smtp': refuse_smtp, 'imap': refuse_imap}
+        self.refuse_lock = threading.Lock()
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='fakestamper-')
+        self.tls = create_certificate(self.tmpdir.name)
+        self.signer = Signer()
+        self.mailbox = Mailbox()
+        self.reference = 1000000
+        self.reference_lock = threading.Lock()
+        self.servers = [ThreadingServer(self, SMTPHandler),
+                        ThreadingServer(self, IMAPHandler)]
+        for s in self.servers:
+            threading.Thread(target=s.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for s in self.servers:
+            s.shutdown()
+            s.server_close()
+        self.signer.cleanup()
+        self.tmpdir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def smtp_server(self):
+        return '%s:%d' % self.servers[0].server_address
+
+    @property
+    def imap_server(self):
+        return '%s:%d' % self.servers[1].server_address
+
+    def zeitgitter_args(self):
+        """Configuration options for `zeitgitter.config.get_args()`"""
+        return ['--stamper-own-address', OWN_ADDRESS,
+                '--stamper-to', STAMPER_TO,
+                '--stamper-from', STAMPER_FROM,
+                '--stamper-keyid', self.signer.keyid,
+                '--stamper-gpg', self.signer.verify_command(),
+                '--stamper-smtp-server', self.smtp_server,
+                '--stamper-imap-server', self.imap_server,
+                '--stamper-password', 'fakestamper']
+
+    def should_refuse(self, proto):
+        with self.refuse_lock:
+            if self.refuse[proto] > 0:
+                self.refuse[proto] -= 1
+                logging.info("Injected %s connection refusal" % proto)
+                return True
+            return False
+
+    def add_unrelated(self, count, size=2000):
+        """Fill the INBOX with `count` unrelated mails of about `size` bytes
+        (of varying senders and sizes, some of them in the size range
+        searched for by `zeitgitter.mail.check_for_stamper_mail()`)"""
+        for i in range(count):
+            body = ('Unrelated message %d\r\n' % i) * (1 + (i * 7919) % size // 20)
+            self.mailbox.deliver(self.format_mail(
+                'sender%d@example.org' % (i % 97), OWN_ADDRESS,
+                'Unrelated %d' % i, body))
+
+    def format_mail(self, frm, to, subject, body):
+        date = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+        return bytes("From: %s\r\nTo: %s\r\nDate: %s\r\nSubject: %s\r\n\r\n%s"
+                     % (frm, to, date, subject, body), 'ASCII')
+
+    def received(self, mailfrom, rcpts, data):
+        if STAMPER_TO not in rcpts:
+            self.mailbox.deliver(data)
+            return
+        threading.Thread(target=self.reply, args=(mailfrom, data),
+                         daemon=True).start()
+
+    def reply(self, mailfrom, data):
+        msg = email.message_from_bytes(data)
+        text = msg.get_payload().replace('\r\n', '\n')
+        with self.reference_lock:
+            self.reference += 1
+            reference = self.reference
+        now = time.gmtime()
+        header = """########################################################
+#
+# The text of this message was stamped by
+# a local fakestamper with reference %d
+# at %s
+#
+########################################################
+
+""" % (reference, strftime("%H:%M (GMT) on %A %d %B %Y", now))
+        signed = self.signer.clearsign(header + text + '\n\n\n')
+        if self.reply_delay:
+            time.sleep(self.reply_delay)
+        body = (PREAMBLE + signed).replace('\n', '\r\n')
+        self.mailbox.deliver(self.format_mail(
+            STAMPER_FROM, mailfrom, 'Stamped: '
+            + msg.get('Subject', ''), body))
+        logging.info("Delivered reply %d" % reference)
+
+
+def roundtrip(fake, repo, contents, timeout=60):
+    """Request a mail cross-timestamp for `contents` through
+    `zeitgitter.mail`; return the seconds from `send()` to the verified
+    `hashes.asc` being saved (it is renamed into place when complete), or
+    `None` on timeout.
+
+    `zeitgitter.config` must already be set up for `fake`."""
+    import zeitgitter.mail
+    preserve = Path(repo, 'hashes.stamp')
+    asc = Path(repo, 'hashes.asc')
+    if asc.exists():
+        asc.unlink()
+    with preserve.open('w') as f:
+        f.write(contents)
+    start = time.time()
+    zeitgitter.mail.async_email_timestamp(preserve)
+    while time.time() - start < timeout:
+        if asc.exists():
+            return time.time() - start
+        time.sleep(0.005)
+    return None
+
+
+def init_repo(repo):
+    """Minimal repository to request cross-timestamps for"""
+    git = ['git', '-c', 'user.name=Fakestamper', '-c',
+           'user.email=' + OWN_ADDRESS, '-c', 'commit.gpgsign=false']
+    subprocess.run(['git', 'init', '-q', repo], check=True)
+    subprocess.run(git + ['commit', '-q', '--allow-empty', '-m', 'Start'],
+                   cwd=repo, check=True)
+
+
+def bench(args):
+    import zeitgitter.config
+    with FakeStamper(reply_delay=args.reply_delay,
+                     drop_idle_after=args.drop_idle_after,
+                     refuse_smtp=args.refuse_smtp,
+                     refuse_imap=args.refuse_imap) as fake, \
+            tempfile.TemporaryDirectory() as repo:
+        init_repo(repo)
+        zeitgitter.config.get_args(args=[
+            '--own-url', 'https://fakestamper.localhost',
+            '--owner', '?', '--contact', '?', '--country', '?',
+            '--repository', repo] + fake.zeitgitter_args())
+        fake.add_unrelated(args.unrelated)
+        times = []
+        for i in range(args.rounds):
+            contents = ''.join('%040x\n' % (i * 1000 + j)
+                               for j in range(args.entries))
+            t = roundtrip(fake, repo, contents, timeout=args.timeout)
+            print("Round %d: %s" % (i, "timeout" if t is None
+                                   else "%.3f s" % t))
+            if t is not None:
+                times.append(t)
+            subprocess.run(['git', '-c', 'user.name=Fakestamper',
+                            '-c', 'user.email=' + OWN_ADDRESS,
+                            'commit', '-q', '--allow-empty', '-m',
+                            'Round %d' % i], cwd=repo, check=True)
+        if times:
+            print("%d/%d rounds completed; min %.3f s, median %.3f s,"
+                  " max %.3f s" % (len(times), args.rounds, min(times),
+                                   statistics.median(times), max(times)))
+        else:
+            print("No round completed")
+
+
+def serve(args):
+    with FakeStamper(reply_delay=args.reply_delay,
+                     drop_idle_after=args.drop_idle_after,
+                     refuse_smtp=args.refuse_smtp,
+                     refuse_imap=args.refuse_imap) as fake:
+        fake.add_unrelated(args.unrelated)
+        print("Add the following options to zeitgitterd:")
+        print(' '.join("'%s'" % a for a in fake.zeitgitter_args()))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the PGP Digital Timestamping Service")
+    parser.add_argument('--serve', action='store_true',
+                        help="only run the servers, for use with a separate"
+                        " zeitgitterd")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="number of mail round trips to measure")
+    parser.add_argument('--entries', type=int, default=100,
+                        help="number of commit IDs per round")
+    parser.add_argument('--unrelated', type=int, default=0,
+                        help="number of unrelated mails in the INBOX")
+    parser.add_argument('--reply-delay', type=float, default=0.5,
+                        help="seconds before the reply is delivered")
+    parser.add_argument('--drop-idle-after', type=float,
+                        help="drop IMAP IDLE connections after this many seconds")
+    parser.add_argument('--refuse-smtp', type=int, default=0,
+                        help="number of SMTP connections to refuse")
+    parser.add_argument('--refuse-imap', type=int, default=0,
+                        help="number of IMAP connections to refuse")
+    parser.add_argument('--timeout', type=float, default=300,
+                        help="seconds to wait for each round trip")
+    parser.add_argument('--debug-level', default='WARN',
+                        help="log level")
+    args = parser.parse_args()
+    _logging.basicConfig(level=_logging.getLevelName(args.debug_level.upper()))
+    if args.serve:
+        serve(args)
+    else:
+        bench(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
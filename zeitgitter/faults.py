@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Fault injection, for testing only
+#
+# `--fault-injection` delays and/or fails operations at the following
+# points, to see how the server degrades (e.g., with `zeitgitter-bench`):
+# - `fsync`: Appending commit IDs to `hashes.work` (while holding the lock
+#   serializing all stamping and rotation)
+# - `sign`: Every signature, in whichever GnuPG agent
+# - `agent<n>`: Signatures by agent `n` only (a wedged agent)
+# - `upstream`: Every `git timestamp` call to an upstream server
+#
+# Syntax: Comma-separated `point=action[@probability]`, where `action` is a
+# duration (e.g., `0.5s`), `fail`, or both (`30s+fail`). Example:
+# `fsync=0.2s@0.01, agent0=10s, upstream=5m+fail`
+
+import collections
+import random
+import re
+import time
+
+import zeitgitter.config
+import zeitgitter.deltat
+import zeitgitter.metrics
+
+Fault = collections.namedtuple('Fault', ('delay', 'fail', 'probability'))
+
+POINTS = re.compile(r'^(fsync|sign|agent[0-9]+|upstream)$')
+
+
+def parse(spec):
+    """Parse a `--fault-injection` value into a dict point → `Fault`.
+    Raises `ValueError` on syntax errors."""
+    faults = {}
+    for item in re.split(r'\s*,\s*', spec.strip()):
+        if item == '':
+            continue
+        if '=' not in item:
+            raise ValueError("Missing '=' in %r" % item)
+        (point, action) = item.split('=', 1)
+        if not POINTS.match(point):
+            raise ValueError("Unknown fault injection point %r" % point)
+        probability = 1.0
+        if '@' in action:
+            (action, p) = action.split('@', 1)
+            probability = float(p)
+            if not 0 < probability <= 1:
+                raise ValueError("Probability must be in (0, 1]: %r" % item)
+        delay = 0.0
+        fail = False
+        for part in action.split('+'):
+            if part == 'fail':
+                fail = True
+            else:
+                try:
+                    delay = zeitgitter.deltat.parse_time(part).total_seconds()
+                except AssertionError:
+                    raise ValueError("Invalid action %r" % part)
+        faults[point] = Fault(delay, fail, probability)
+    return faults
+
+
+def inject(point):
+    """Apply the fault configured for `point`, if any: sleep and/or return
+    `True` if the operation should fail"""
+    fault = zeitgitter.config.arg.fault_injection.get(point)
+    if fault is None or random.random() >= fault.probability:
+        return False
+    zeitgitter.metrics.faults_injected.child(point).inc()
+    if fault.delay:
+        time.sleep(fault.delay)
+    return fault.fail
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Health state, kept in memory
+#
+# The operations record their outcome here (`success()`, `failure()`), so
+# that `/healthz` can answer from memory, without any I/O, in constant time.
+
+import threading
+import time
+
+import zeitgitter.commit
+import zeitgitter.config
+
+# Before anything happened, ages are counted from the start
+started = time.time()
+
+# Name → time of last success, time of last failure, number of consecutive
+# failures. Names: `rotation`, `commit`, `round`, `cross-timestamp:<server>`,
+# `push:<repository>`, `agent:<n>`, `mail-sent`, `mail-reply`, `log`
+# (appending to `hashes.work`).
+events = {}
+events_lock = threading.Lock()
+
+# Consecutive signing failures after which an agent is considered broken
+AGENT_MAX_FAILURES = 3
+
+
+def success(name):
+    now = time.time()
+    with events_lock:
+        (_, failed, _) = events.get(name, (None, None, 0))
+        events[name] = (now, failed, 0)
+
+
+def failure(name):
+    now = time.time()
+    with events_lock:
+        (ok, _, failures) = events.get(name, (None, None, 0))
+        events[name] = (ok, now, failures + 1)
+
+
+def forget(name):
+    """E.g., for an agent no longer in use"""
+    with events_lock:
+        events.pop(name, None)
+
+
+def last_success(name):
+    return events.get(name, (None, None, 0))[0]
+
+
+def report(now=None):
+    """The health report as a dict, including a list of `problems` (empty
+    if healthy)"""
+    if now is None:
+        now = time.time()
+    arg = zeitgitter.config.arg
+    max_age = arg.health_max_age
+    problems = []
+    with events_lock:
+        snapshot = dict(events)
+
+    def age(name):
+        t = snapshot.get(name, (None,))[0]
+        return now - (started if t is None else t)
+
+    checks = {}
+    for name in ['round'] + [
+            'cross-timestamp:' + u for u in arg.upstream_timestamp] + [
+            'push:' + r for r in arg.push_repository]:
+        checks[name] = age(name)
+        if checks[name] > max_age:
+            problems.append("no successful %s for %ds" % (name, checks[name]))
+    ret = {'uptime': now - started,
+           'ages': checks,
+           'events': {n: {'success': s, 'failure': f, 'failures': c}
+                      for (n, (s, f, c)) in snapshot.items()}}
+
+    agents = {n: c for (n, (s, f, c)) in snapshot.items()
+              if n.startswith('agent:')}
+    for (n, c) in agents.items():
+        if c >= AGENT_MAX_FAILURES:
+            problems.append("%s failed %d times in a row" % (n, c))
+    if len(agents) > 0 and all(c >= AGENT_MAX_FAILURES
+                               for c in agents.values()):
+        problems.append("no working agent")
+
+    failures = snapshot.get('log', (None, None, 0))[2]
+    if failures > 0:
+        problems.append("logging commits failed %d times in a row"
+                        % failures)
+
+    sent = snapshot.get('mail-sent', (None,))[0]
+    reply = snapshot.get('mail-reply', (None,))[0]
+    if sent is not None and (reply is None or reply < sent):
+        ret['mail-pending'] = now - sent
+        if now - sent > arg.health_max_mail_wait:
+            problems.append("no PGP Timestamper reply for %ds" % (now - sent))
+
+    ret['backlog'] = zeitgitter.commit.work_entries
+    oldest = zeitgitter.commit.work_oldest
+    ret['backlog-age'] = 0 if oldest is None else now - oldest
+    if (arg.health_max_backlog is not None
+            and ret['backlog'] > arg.health_max_backlog):
+        problems.append("%d entries not yet committed" % ret['backlog'])
+    if ret['backlog-age'] > max_age:
+        problems.append("oldest entry not committed for %ds"
+                        % ret['backlog-age'])
+    ret['rounds'] = zeitgitter.commit.recent_rounds()
+    ret['problems'] = problems
+    return ret
+
+
+def live():
+    """Is the process alive, i.e., can it still commit?"""
+    return zeitgitter.commit.waiter is not None and zeitgitter.commit.waiter.is_alive()
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Index of timestamped commit IDs
+#
+# Maps every commit ID logged by `Stamper.log_commit()` to the interval
+# commit (the commit on `master` containing it in `hashes.log`) and, if
+# known, the time it was signed. It also keeps the Merkle tree nodes of
+# every interval, such that inclusion proofs only need O(log n) lookups.
+# The index lives in an SQLite database outside the working tree and is
+# updated incrementally after every commit round; it is rebuilt from the
+# `git` history when missing or of an older schema.
+
+import logging as _logging
+import re
+import sqlite3
+import threading
+
+import zeitgitter.config
+import zeitgitter.merkle
+
+logging = _logging.getLogger('index')
+
+# The `Index`, if enabled (see `--lookup-index`)
+index = None
+
+# Commit ID → list of signing times, for commits logged but not yet found
+# in an indexed interval commit
+pending = {}
+pending_lock = threading.Lock()
+
+entry_re = re.compile(r'^([0-9a-f]{40}|[0-9a-f]{64})$')
+
+# Increment on incompatible changes; the index will then be rebuilt
+SCHEMA = '3'
+
+
+def interval_entries(commit):
+    """The lines in `hashes.log` (i.e., the Merkle tree leaves), if
+    `commit` is an interval commit (i.e., it changed `hashes.log` or was
+    created as one), else `None`"""
+    try:
+        blob = commit.tree['hashes.log']
+    except KeyError:
+        return None
+    if commit.parents:
+        try:
+            if commit.parents[0].tree['hashes.log'].id == blob.id and not (
+                    commit.message.startswith('Newly timestamped commits')
+                    or commit.message.startswith('Found uncommitted data')):
+                return None
+        except KeyError:
+            pass
+    return zeitgitter.merkle.entries(blob.data)
+
+
+class Index:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta"
+                            " (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'schema'").fetchone()
+            if row is None or row[0] != SCHEMA:
+                logging.info("Index schema changed, rebuilding")
+                self.db.executescript("""
+DROP TABLE IF EXISTS intervals;
+DROP TABLE IF EXISTS stamps;
+DROP TABLE IF EXISTS merkle;
+DELETE FROM meta;
+""")
+                self.db.execute("INSERT INTO meta (key, value)"
+                                " VALUES ('schema', ?)", (SCHEMA,))
+            self.db.executescript("""
+CREATE TABLE IF NOT EXISTS intervals (
+    id INTEGER PRIMARY KEY,
+    commit_id TEXT UNIQUE NOT NULL,
+    time INTEGER NOT NULL,
+    leaves INTEGER NOT NULL,
+    height INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS stamps (
+    commit_id BLOB NOT NULL,
+    interval INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    time INTEGER);
+CREATE INDEX IF NOT EXISTS stamps_commit ON stamps(commit_id);
+CREATE TABLE IF NOT EXISTS merkle (
+    interval INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (interval, level, position)) WITHOUT ROWID;
+""")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def indexed_head(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'head'").fetchone()
+        return None if row is None else row[0]
+
+    def update(self, repodir, times=None):
+        """Index all interval commits on `HEAD` not yet indexed.
+        `times` maps commit IDs to lists of signing times (oldest first);
+        matched times are removed from it. Returns the number of new
+        interval commits."""
+        import pygit2  # Loaded on first use only, for a faster start
+        with self.update_lock:
+            repo = pygit2.Repository(repodir)
+            if repo.head_is_unborn:
+                return 0
+            last = self.indexed_head()
+            todo = []
+            commit = repo[repo.head.target]
+            while commit.hex != last:
+                todo.append(commit)
+                if not commit.parents:
+                    break
+                commit = commit.parents[0]
+            new = 0
+            for commit in reversed(todo):
+                entries = interval_entries(commit)
+                if entries is None:
+                    continue
+                rows = []
+                for (pos, e) in enumerate(entries):
+                    e = e.decode('ASCII', errors='replace')
+                    if not entry_re.match(e):
+                        continue
+                    t = None
+                    if times is not None:
+                        with pending_lock:
+                            if e in times:
+                                t = times[e].pop(0)
+                                if len(times[e]) == 0:
+                                    del times[e]
+                    rows.append((bytes.fromhex(e), pos, t))
+                tree = zeitgitter.merkle.levels(entries)
+                with self.lock, self.db:
+                    cur = self.db.execute(
+                        "INSERT OR IGNORE INTO intervals"
+                        " (commit_id, time, leaves, height)"
+                        " VALUES (?, ?, ?, ?)",
+                        (commit.hex, commit.commit_time, len(tree[0]),
+                         len(tree) - 1))
+                    if cur.rowcount == 0:
+                        continue  # Already indexed (history was rewritten?)
+                    interval = cur.lastrowid
+                    self.db.executemany(
+                        "INSERT INTO stamps (commit_id, interval, position,"
+                        " time) VALUES (?, ?, ?, ?)",
+                        ((c, interval, pos, t) for (c, pos, t) in rows))
+                    self.db.executemany(
+                        "INSERT INTO merkle (interval, level, position, hash)"
+                        " VALUES (?, ?, ?, ?)",
+                        ((interval, l, pos, h)
+                         for (l, level) in enumerate(tree)
+                         for (pos, h) in enumerate(level)))
+                new += 1
+            if len(todo) > 0:
+                with self.lock, self.db:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO meta (key, value)"
+                        " VALUES ('head', ?)", (todo[0].hex,))
+            if new > 0:
+                logging.info("Indexed %d new interval commit(s)" % new)
+            return new
+
+    def lookup(self, commits):
+        """Return a dict mapping each of `commits` to a (possibly empty) list
+        of dicts with keys `interval`, `interval-time`, and `time` (signing
+        time or `None`, if unknown, e.g. after a rebuild)"""
+        ret = {}
+        with self.lock:
+            for c in commits:
+                ret[c] = [{'interval': i, 'interval-time': it, 'time': t}
+                          for (i, it, t) in self.db.execute(
+                              "SELECT i.commit_id, i.time, s.time"
+                              " FROM stamps s JOIN intervals i"
+                              " ON s.interval = i.id"
+                              " WHERE s.commit_id = ? ORDER BY i.id",
+                              (bytes.fromhex(c),))]
+        return ret
+
+    def proofs(self, commit):
+        """Return a list of inclusion proofs for `commit`, one for every
+        time it has been logged, as dicts with keys `interval`,
+        `interval-time`, `time`, `root`, `leaves`, `index`, and `path` (see
+        `zeitgitter.merkle.path()`)"""
+        ret = []
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT i.id, i.commit_id, i.time, i.leaves, i.height,"
+                " s.position, s.time"
+                " FROM stamps s JOIN intervals i ON s.interval = i.id"
+                " WHERE s.commit_id = ? ORDER BY i.id",
+                (bytes.fromhex(commit),)).fetchall()
+            for (interval, cid, itime, leaves, height, pos, t) in rows:
+                def node(level, position):
+                    row = self.db.execute(
+                        "SELECT hash FROM merkle WHERE interval = ?"
+                        " AND level = ? AND position = ?",
+                        (interval, level, position)).fetchone()
+                    return None if row is None else row[0]
+                ret.append({'interval': cid,
+                            'interval-time': itime,
+                            'time': t,
+                            'root': 'sha256:' + node(height, 0).hex(),
+                            'leaves': leaves,
+                            'index': pos,
+                            'path': zeitgitter.merkle.path(node, pos)})
+        return ret
+
+
+def note(commit, now):
+    """Remember the signing time of `commit`; called from
+    `Stamper.log_commit()`"""
+    if index is not None:
+        with pending_lock:
+            pending.setdefault(commit, []).append(now)
+
+
+def update():
+    """Index interval commits added since the last call"""
+    if index is not None:
+        try:
+            index.update(zeitgitter.config.arg.repository, pending)
+        except Exception as e:
+            logging.error("Updating index failed: %s" % e)
+
+
+def lookup(commits):
+    return index.lookup(commits)
+
+
+def proofs(commit):
+    return index.proofs(commit)
+
+
+def setup():
+    """Open the index, if enabled, and bring it up to date (or rebuild it)
+    in the background"""
+    global index
+    if zeitgitter.config.arg.lookup_index is not None and index is None:
+        index = Index(zeitgitter.config.arg.lookup_index)
+        if index.indexed_head() is None:
+            logging.info("Building index %s from history"
+                         % zeitgitter.config.arg.lookup_index)
+        threading.Thread(target=update, daemon=True).start()
@@ -23,6 +23,7 @@
 import logging as _logging
 import os
 import re
+import shlex
 import subprocess
 import threading
 import time
@@ -35,6 +36,8 @@ from time import gmtime, strftime
 import pygit2 as git
 
 import zeitgitter.config
+import zeitgitter.health
+import zeitgitter.metrics
 
 logging = _logging.getLogger('mail')
 
@@ -139,8 +142,11 @@ def extract_pgp_body(body):
 def save_signature(bodylines):
     repo = zeitgitter.config.arg.repository
     ascfile = Path(repo, 'hashes.asc')
-    with ascfile.open(mode='w') as f:
+    # Complete before appearing under its name
+    tmp = ascfile.with_suffix('.asc.tmp')
+    with tmp.open(mode='w') as f:
         f.write('\n'.join(bodylines) + '\n')
+    tmp.replace(ascfile)
     res = subprocess.run(['git', 'add', ascfile], cwd=repo)
     if res.returncode != 0:
         logging.warning("git add %s in %s failed: %d"
@@ -166,31 +172,49 @@ def body_signature_correct(bodylines, stat):
             env[k] = os.environ[k]
     env['LANG'] = 'C'
     env['TZ'] = 'UTC'
-    res = subprocess.run(['gpg1', '--pgp2', '--verify'],
+    # Parse the machine-readable status output instead of the human-readable
+    # stderr, as the latter differs between `gpg1` and `gpg` (the latter
+    # being used by `zeitgitter.fakestamper`)
+    res = subprocess.run(shlex.split(zeitgitter.config.arg.stamper_gpg)
+                         + ['--status-fd', '1', '--verify'],
                          env=env, input=body.encode('ASCII'),
-                         stderr=subprocess.PIPE)
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stderr = maybe_decode(res.stderr)
     stdout = maybe_decode(res.stdout)
     logging.debug(stderr)
+    logging.debug(stdout)
     if res.returncode != 0:
-        logging.warning("gpg1 return code %d (%r)" % (res.returncode, stderr))
+        logging.warning("%s return code %d (%r)"
+                        % (zeitgitter.config.arg.stamper_gpg,
+                           res.returncode, stderr))
         return False
-    if not '\ngpg: Good signature' in stderr:
-        logging.warning("Not good signature (%r)" % stderr)
+    goodsig = None
+    validsig = None
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[0] == '[GNUPG:]':
+            if fields[1] == 'GOODSIG':
+                goodsig = fields
+            elif fields[1] == 'VALIDSIG' and len(fields) >= 5:
+                validsig = fields
+    if goodsig is None or validsig is None:
+        logging.warning("Not good signature (%r)" % stdout)
         return False
-    if not stderr.startswith('gpg: Signature made '):
-        logging.warning("Signature not made (%r)" % stderr)
-        return False
-    if not ((' key ID %s\n' % zeitgitter.config.arg.stamper_keyid)
-            in stderr):
-        logging.warning("Wrong KeyID (%r)" % stderr)
+    keyid = zeitgitter.config.arg.stamper_keyid.upper()
+    if keyid.startswith('0X'):
+        keyid = keyid[2:]
+    if not goodsig[2].upper().endswith(keyid):
+        logging.warning("Wrong KeyID (%r)" % stdout)
         return False
     try:
-        logging.debug(stderr[24:48])
-        sigtime = datetime.strptime(stderr[24:48], "%b %d %H:%M:%S %Y %Z")
+        # Seconds since the epoch or, with some options, ISO 8601
+        if 'T' in validsig[4]:
+            sigtime = datetime.strptime(validsig[4], "%Y%m%dT%H%M%S")
+        else:
+            sigtime = datetime.utcfromtimestamp(int(validsig[4]))
         logging.debug(sigtime)
     except ValueError:
-        logging.warning("Illegal date (%r)" % stderr)
+        logging.warning("Illegal date (%r)" % stdout)
         return False
     if sigtime > datetime.utcnow() + timedelta(seconds=30):
         logging.warning("Signature time %s lies more than 30 seconds in the future"
@@ -228,6 +252,9 @@ def verify_body_and_save_signature(body, stat, logfile, msgno):
         return False
 
     save_signature(bodylines)
+    # `logfile` was last modified right before sending
+    zeitgitter.metrics.mail_roundtrip.observe(time.time() - stat.st_mtime)
+    zeitgitter.health.success('mail-reply')
     return True
 
 
@@ -238,10 +265,19 @@ def body_contains_file(bodylines, logfile):
     with logfile.open(mode='r') as f:
         # A few empty/comment lines at the beginning
         firstline = f.readline().rstrip()
+        in_armor_headers = False
         for i in range(len(bodylines)):
             if bodylines[i] == firstline:
                 break
+            elif bodylines[i] == '-----BEGIN PGP SIGNED MESSAGE-----':
+                in_armor_headers = True
+                linesbefore += 1
+            elif in_armor_headers and re.match(r'^[A-Za-z]+: ', bodylines[i]):
+                # Armor headers such as `Hash: SHA256` (RFC 4880, 7.);
+                # not emitted by PGP 2.x, but by current GnuPG
+                linesbefore += 1
             elif bodylines[i] == '' or bodylines[i][0] in '#-':
+                in_armor_headers = False
                 linesbefore += 1
             else:
                 return None
@@ -415,5 +451,6 @@ def async_email_timestamp(logfile, resume=False):
         if not send(contents):
             logging.info("Mail not sent, not waiting for reply (obviously)")
             return
+        zeitgitter.health.success('mail-sent')
     threading.Thread(target=wait_for_receive, args=(repo, head, logfile),
                      daemon=True).start()
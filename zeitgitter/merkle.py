@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Merkle trees over log entries and inclusion proofs
+#
+# Leaves are the SHA-256 hashes of 0x00 followed by the entry, inner nodes
+# the SHA-256 hashes of 0x01 followed by both children. A node without a
+# sibling is promoted to the next level unchanged. The root of each
+# interval's `hashes.log` is recorded in the interval commit message as
+# `Merkle-Root: sha256:<hex>`. Batches of `stamp-aggregate-v1` requests
+# use the same trees (see `zeitgitter.aggregate`).
+#
+# Usage as offline verifier: zeitgitter-verify-proof --help
+
+import argparse
+import hashlib
+import json
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT_PREFIX = 'Merkle-Root: sha256:'
+# First line of the statements signed for `stamp-aggregate-v1`
+STATEMENT_HEADER = 'zeitgitter aggregate-v1\n'
+
+
+def leaf_hash(entry):
+    return hashlib.sha256(b'\x00' + entry).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def entries(data):
+    """The leaves (as `bytes`) of a log file's contents `data`"""
+    return [l for l in data.split(b'\n') if l != b'']
+
+
+def levels(leaves):
+    """All levels of the tree, from the leaf hashes to the root"""
+    level = [leaf_hash(l) for l in leaves]
+    ret = [level]
+    while len(level) > 1:
+        nxt = [node_hash(level[i], level[i + 1])
+               for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            nxt.append(level[-1])
+        ret.append(nxt)
+        level = nxt
+    return ret
+
+
+def root(leaves):
+    """The root of the tree over `leaves`; the hash of the empty string
+    for an empty tree"""
+    if len(leaves) == 0:
+        return hashlib.sha256(b'').digest()
+    return levels(leaves)[-1][0]
+
+
+def root_trailer(leaves):
+    return ROOT_PREFIX + root(leaves).hex()
+
+
+def path(nodes, index):
+    """The inclusion proof for leaf `index`. `nodes(level, idx)` returns
+    the hash at that position or `None` if there is none. Returns a list of
+    `L:<hex>`/`R:<hex>` strings, indicating the sibling's side and hash,
+    from the leaf upwards."""
+    ret = []
+    level = 0
+    while True:
+        sibling = index ^ 1
+        h = nodes(level, sibling)
+        if h is not None:
+            ret.append(('L:' if sibling < index else 'R:') + h.hex())
+        elif index == 0:
+            return ret  # Reached the root
+        level += 1
+        index //= 2
+
+
+def verify(entry, proof, expected):
+    """Does `proof` (as returned by `path()`) lead from `entry` (`bytes`)
+    to the root `expected` (`bytes`)?"""
+    h = leaf_hash(entry)
+    for step in proof:
+        side, sibling = step.split(':', 1)
+        sibling = bytes.fromhex(sibling)
+        if side == 'L':
+            h = node_hash(sibling, h)
+        elif side == 'R':
+            h = node_hash(h, sibling)
+        else:
+            raise ValueError("Illegal proof step %s" % step)
+    return h == expected
+
+
+def committed_root(repo, interval):
+    """The root recorded in the interval commit's message or, for commits
+    predating Merkle roots, computed from its `hashes.log`"""
+    msg = subprocess.run(['git', 'cat-file', 'commit', interval], cwd=repo,
+                         check=True, stdout=subprocess.PIPE).stdout
+    for line in msg.decode('UTF-8', errors='replace').splitlines():
+        if line.startswith(ROOT_PREFIX):
+            return bytes.fromhex(line[len(ROOT_PREFIX):].strip())
+    log = subprocess.run(['git', 'cat-file', 'blob', interval + ':hashes.log'],
+                         cwd=repo, check=True, stdout=subprocess.PIPE).stdout
+    return root(entries(log))
+
+
+def statement_root(text):
+    """The root (`bytes`) claimed in an aggregate statement, or `None`"""
+    if not text.startswith(STATEMENT_HEADER):
+        return None
+    for line in text.splitlines():
+        if line.startswith('root sha256:'):
+            return bytes.fromhex(line[len('root sha256:'):])
+    return None
+
+
+def signature_correct(gpg, text, signature):
+    """Does `signature` verify `text` using the `gpg` command?"""
+    with tempfile.TemporaryDirectory() as tmp:
+        data = Path(tmp, 'statement')
+        data.write_text(text)
+        sig = Path(tmp, 'statement.asc')
+        sig.write_text(signature)
+        return subprocess.run(shlex.split(gpg) + ['--verify', sig, data],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode == 0
+
+
+def verify_receipt(doc, gpg=None):
+    """Check a `stamp-aggregate-v1` receipt; returns an error message or
+    `None`"""
+    expected = statement_root(doc.get('statement', ''))
+    if expected is None:
+        return "no valid statement in receipt"
+    if not verify(bytes(doc['commit'], 'ASCII'), doc['path'], expected):
+        return "path does NOT lead to the signed root"
+    if gpg is not None and not signature_correct(gpg, doc['statement'],
+                                                  doc['signature']):
+        return "signature does NOT verify"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="""Verify inclusion proofs returned by a zeitgitter
+            `proof-v1` or `stamp-aggregate-v1` request offline.""")
+    parser.add_argument('proof', nargs='?', default='-',
+                        help="file containing the JSON proof (default: stdin)")
+    parser.add_argument('--repository',
+                        help="""local clone of the timestamper's repository;
+                            also checks that the root matches the one of
+                            the interval commit""")
+    parser.add_argument('--gpg',
+                        help="""for `stamp-aggregate-v1` receipts: also
+                            verify the signature using this command (e.g.,
+                            `gpg`); the timestamper's key must be in its
+                            keyring""")
+    args = parser.parse_args()
+    if args.proof == '-':
+        doc = json.load(sys.stdin)
+    else:
+        with open(args.proof) as f:
+            doc = json.load(f)
+    if not re.match('^[0-9a-f]{40}$', doc.get('commit', '')):
+        sys.exit("No valid commit ID in proof")
+    if 'statement' in doc:
+        err = verify_receipt(doc, args.gpg)
+        if err is not None:
+            print("%s: %s" % (doc['commit'], err))
+            return 1
+        print("%s: included in signed batch%s"
+              % (doc['commit'],
+                 '' if args.gpg is None else ' (signature verified)'))
+        return 0
+    if len(doc.get('proofs', [])) == 0:
+        sys.exit("%s: no proofs" % doc['commit'])
+    ok = True
+    for p in doc['proofs']:
+        expected = bytes.fromhex(p['root'].replace('sha256:', '', 1))
+        if not verify(bytes(doc['commit'], 'ASCII'), p['path'], expected):
+            print("%s: proof for interval %s does NOT match its root"
+                  % (doc['commit'], p['interval']))
+            ok = False
+        elif (args.repository is not None
+              and committed_root(args.repository, p['interval']) != expected):
+            print("%s: root does NOT match interval commit %s"
+                  % (doc['commit'], p['interval']))
+            ok = False
+        else:
+            print("%s: included in interval %s%s"
+                  % (doc['commit'], p['interval'],
+                     '' if args.repository is None else ' (root verified)'))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
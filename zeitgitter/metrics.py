@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Metrics registry, rendered in the Prometheus text exposition format
+#
+# Every combination of label values (a "child") has its own lock, so
+# updates only contend with updates to the very same time series. Children
+# are looked up without locking; the metric's lock is only taken when a new
+# label combination appears.
+
+import bisect
+import threading
+import time
+
+# Default histogram buckets (seconds)
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+           1, 2.5, 5, 10, 30, 60)
+# For things measured in minutes, e.g. mail round trips
+SLOW_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200)
+
+registry = []
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, escape(v)) for (n, v) in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if len(self.labels) == 0:
+            self.child()  # Export 0 right from the start
+        registry.append(self)
+
+    def child(self, *values):
+        values = tuple(str(v) for v in values)
+        try:
+            return self.children[values]
+        except KeyError:
+            with self.lock:
+                return self.children.setdefault(values, self.new_child())
+
+    def samples(self):
+        """Yields (suffix, labels, value) tuples"""
+        for (values, c) in sorted(self.children.items()):
+            for (suffix, extra, value) in c.samples():
+                yield (suffix, format_labels(self.labels, values, extra), value)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for (suffix, labels, value) in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield ('_total', (), self.value)
+
+
+class Counter(Metric):
+    kind = 'counter'
+    new_child = CounterChild
+
+    def inc(self, amount=1):
+        self.child().inc(amount)
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value  # Atomic
+
+    def samples(self):
+        yield ('', (), self.value)
+
+
+class Gauge(Metric):
+    """If `fn` is given, it is called when rendering to obtain the value"""
+    kind = 'gauge'
+    new_child = GaugeChild
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value):
+        self.child().set(value)
+
+    def samples(self):
+        if self.fn is not None:
+            yield ('', '', self.fn())
+        else:
+            yield from super().samples()
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield ('_bucket', (('le', format_value(float(bound))),),
+                   cumulative)
+        yield ('_sum', (), total)
+        yield ('_count', (), cumulative)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.child().observe(value)
+
+    def time(self, *values):
+        return Timer(self.child(*values))
+
+
+class Timer:
+    """Context manager observing the time spent inside it"""
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+def render():
+    return ''.join(m.render() for m in registry)
+
+
+# The metrics exported
+requests = Counter('zeitgitter_requests', "HTTP requests handled",
+                   ('request', 'status'))
+request_duration = Histogram('zeitgitter_request_duration_seconds',
+                             "Time to handle HTTP requests",
+                             ('request', 'status'))
+sign_wait = Histogram('zeitgitter_sign_wait_seconds',
+                      "Time waiting for a signing slot"
+                      " (`--max-parallel-signatures`)")
+sign_timeouts = Counter('zeitgitter_sign_timeouts',
+                        "Signing requests rejected after"
+                        " `--max-parallel-timeout`")
+sign_duration = Histogram('zeitgitter_sign_duration_seconds',
+                          "Time to create a signature, per GnuPG agent",
+                          ('agent',))
+log_fsync = Histogram('zeitgitter_log_fsync_seconds',
+                      "Time to append commit IDs to `hashes.work` and fsync")
+round_phase = Histogram('zeitgitter_round_phase_seconds',
+                        "Time spent in each phase of a commit round",
+                        ('kind', 'phase'), buckets=BUCKETS + (120, 300, 600))
+round_overruns = Counter('zeitgitter_round_overruns',
+                         "Commit rounds still running when the next was due")
+mail_roundtrip = Histogram('zeitgitter_mail_roundtrip_seconds',
+                           "Time from sending a request to the PGP"
+                           " Timestamper until its valid reply was found",
+                           buckets=SLOW_BUCKETS)
+faults_injected = Counter('zeitgitter_faults_injected',
+                          "Faults injected by `--fault-injection`",
+                          ('point',))
+connections_closed = Counter('zeitgitter_connections_closed',
+                             "HTTP connections closed, by reason",
+                             ('reason',))
+connection_requests = Histogram('zeitgitter_connection_requests',
+                                "HTTP requests per connection",
+                                buckets=(0, 1, 2, 5, 10, 100, 1000))
+dedup = Counter('zeitgitter_dedup_requests',
+                "Stamping requests by `--dedup-window` outcome: answered"
+                " from the cache (`hit`), sharing a concurrent identical"
+                " request (`shared`), or signed (`miss`)", ('result',))
@@ -0,0 +1,408 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Microbenchmarks of the pure-Python parts of handling a request
+#
+# Signing, `fsync()`, and the network are left out (see `zeitgitter.bench`
+# for these). To be comparable across machines, times are reported in
+# "calibration units": multiples of the time a fixed pure-Python loop takes
+# on the same machine, measured right before.
+#
+# The baseline is stored in `tests/microbench-baseline.json`; the test
+# suite compares against it if `ZEITGITTER_MICROBENCH` is set.
+#
+# `--allocations` also reports the peak memory allocated per call (by
+# Python objects, using `tracemalloc`), which does not depend on the
+# machine.
+#
+# Usage: python3 -m zeitgitter.microbench --help
+
+import argparse
+import http.client
+import ipaddress
+import io
+import json
+import socket
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+import zeitgitter.deltat
+import zeitgitter.server
+import zeitgitter.stamper
+from zeitgitter import moddir
+
+BASELINE = Path(moddir('tests'), 'microbench-baseline.json')
+
+# Default factor by which a benchmark may be slower than its baseline
+TOLERANCE = 2.0
+
+# Same shape and size as an Ed25519 signature by GnuPG
+SIGNATURE = """-----BEGIN PGP SIGNATURE-----
+
+iHUEABYKAB0WIQRrs36SIxSi9WrSeaw1Pf7FEvpHxwUCXHVz6wAKCRA1Pf7FEvpH
+x1OeAP9wzEjYV3YEmiWoXJ6wqGgS32kcw6Cz+6R1NZQ8Dp5GUgD/fDBvEqvKOq9e
+zWNhUE0lG9eH7hRbl0JiH6G2I3cHoQ0=
+=NC6F
+-----END PGP SIGNATURE-----
+"""
+
+COMMIT = '1dd8a3e2b11ef6e77d7e0e8bc0cbb4bc2a13ae7a'
+TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+PARENT = 'f7b6e5d4c3b2a1f0e9d8c7b6a5f4e3d2c1b0a9f8'
+
+# name → function returning the callable to be measured
+benchmarks = {}
+
+
+def benchmark(fn):
+    benchmarks[fn.__name__.replace('_', '-')] = fn
+    return fn
+
+
+class OfflineStamper(zeitgitter.stamper.Stamper):
+    """Formats timestamps like `Stamper`, but neither logs nor signs"""
+
+    def __init__(self):
+        self.url = 'https://hagrid.snakeoil'
+        self.fullid = 'Hagrid Snakeoil Timestamping Service <timestamping@hagrid.snakeoil>'
+        self.dedup = zeitgitter.stamper.Deduplicator(None)
+        self.prepare_templates()
+
+    def log_commit(self, commit, now):
+        pass
+
+    def limited_sign(self, now, commit, data):
+        return Signature()
+
+
+class Signature:
+    """Like the result of `gnupg.GPG.sign()`"""
+    data = bytes(SIGNATURE, 'ASCII')
+
+    def __str__(self):
+        return SIGNATURE
+
+
+class ParsingHandler(zeitgitter.server.StamperRequestHandler):
+    """Request handler on a canned request, only recording the parameters
+    parsed"""
+
+    def __init__(self, headers, body=b'', client='192.0.2.1',
+                 trusted_nets=()):
+        self.headers = http.client.parse_headers(io.BytesIO(headers))
+        self.rfile = io.BytesIO(body)
+        self.path = '/'
+        self.client_address = (client, 48879)
+        self.trusted_nets = list(trusted_nets)
+        self.params = None
+
+    def handle_request(self, params):
+        self.params = params
+
+    def send_bodyerr(self, status, title, body):
+        raise ValueError("%d %s" % (status, title))
+
+
+class RespondingHandler(ParsingHandler):
+    """Request handler on parsed parameters, writing the response to
+    `connection`"""
+
+    def __init__(self, stamper, connection):
+        super().__init__(b'\r\n')
+        self.stamper = stamper
+        self.server = argparse.Namespace(draining=False)
+        self.connection = connection
+        self.wfile = connection.makefile('wb', buffering=0)
+        self.command = 'POST'
+        self.request_version = 'HTTP/1.1'
+        self.requestline = 'POST / HTTP/1.1'
+        self.close_connection = False
+        self.close_reason = None
+        self.max_requests = 0
+        self.requests_handled = 1
+
+    handle_request = zeitgitter.server.StamperRequestHandler.handle_request
+
+    def handle_signature(self, params):
+        return self.stamper.stamp_tag(params['commit'][0],
+                                      params['tagname'][0])
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+def post(ctype, body):
+    return ParsingHandler(bytes('Content-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                                % (ctype, len(body)), 'ASCII'), body)
+
+
+def urlencoded_request():
+    return post('application/x-www-form-urlencoded', bytes(
+        'request=stamp-tag-v1&commit=%s&tagname=v1.2.3' % COMMIT, 'ASCII'))
+
+
+def multipart_request():
+    boundary = '------------------------d74496d66958873e'
+    body = ''.join('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                   '%s\r\n' % (boundary, k, v) for (k, v) in
+                   (('request', 'stamp-tag-v1'), ('commit', COMMIT),
+                    ('tagname', 'v1.2.3'))) + '--%s--\r\n' % boundary
+    return post('multipart/form-data; boundary=' + boundary,
+                bytes(body, 'ASCII'))
+
+
+def json_request():
+    return post('application/json', bytes(
+        '{"request":"stamp-tag-v1","commit":"%s","tagname":"v1.2.3"}'
+        % COMMIT, 'ASCII'))
+
+
+@benchmark
+def valid_commit():
+    stamper = OfflineStamper()
+    return lambda: stamper.valid_commit(COMMIT)
+
+
+@benchmark
+def valid_tag():
+    stamper = OfflineStamper()
+    return lambda: stamper.valid_tag('release-1.2.3_rc1')
+
+
+@benchmark
+def stamp_tag():
+    stamper = OfflineStamper()
+    return lambda: stamper.stamp_tag(COMMIT, 'v1.2.3')
+
+
+@benchmark
+def stamp_branch():
+    stamper = OfflineStamper()
+    return lambda: stamper.stamp_branch(COMMIT, PARENT, TREE)
+
+
+@benchmark
+def respond_tag():
+    stamper = OfflineStamper()
+    params = {'request': ['stamp-tag-v1'], 'commit': [COMMIT],
+              'tagname': ['v1.2.3']}
+    (connection, client) = socket.socketpair()
+    handler = RespondingHandler(stamper, connection)
+    received = bytearray(65536)
+
+    def run():
+        handler.handle_request(params)
+        return received[:client.recv_into(received)]
+    return run
+
+
+@benchmark
+def gpgsig_header():
+    return lambda: zeitgitter.stamper.gpgsig_header(Signature.data)
+
+
+@benchmark
+def parse_urlencoded():
+    def run():
+        handler = urlencoded_request()
+        handler.do_POST()
+        return handler.params
+    return run
+
+
+@benchmark
+def parse_multipart():
+    def run():
+        handler = multipart_request()
+        handler.do_POST()
+        return handler.params
+    return run
+
+
+@benchmark
+def parse_json():
+    def run():
+        handler = json_request()
+        handler.do_POST()
+        return handler.params
+    return run
+
+
+@benchmark
+def address_string():
+    # A client behind 30 trusted proxies: the whole chain has to be walked
+    chain = ', '.join('10.0.%d.%d' % (i // 250, i % 250 + 1)
+                      for i in range(30))
+    handler = ParsingHandler(bytes('X-Forwarded-For: 198.51.100.7, %s\r\n\r\n'
+                                   % chain, 'ASCII'),
+                             client='10.1.0.1',
+                             trusted_nets=[ipaddress.ip_network('10.0.0.0/8')])
+    return handler.address_string
+
+
+@benchmark
+def parse_time():
+    return lambda: zeitgitter.deltat.parse_time('1d 2h 3m 4.5s')
+
+
+def calibration_loop():
+    """Fixed pure-Python work (string operations, dict and list handling)
+    resembling the benchmarks"""
+    d = {}
+    for i in range(200):
+        s = '%040x' % i
+        d[s[:8]] = s.replace('0', '1').split('1')
+    return len(d)
+
+
+def measure(fn, repeat=5):
+    """Seconds per call of `fn` (the fastest of `repeat` measurements,
+    each lasting at least 0.2 s)"""
+    timer = timeit.Timer(fn)
+    (number, _) = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def allocated(fn, calls=20):
+    """Peak bytes allocated per call of `fn` (the average of `calls`)"""
+    fn()  # Fill caches
+    total = 0
+    for _ in range(calls):
+        tracemalloc.start()
+        try:
+            fn()
+            total += tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return total / calls
+
+
+def run(names=None, repeat=5):
+    """Returns the seconds per calibration unit and, per benchmark, the
+    time per call in calibration units"""
+    unit = measure(calibration_loop, repeat)
+    results = {}
+    for (name, setup) in benchmarks.items():
+        if names is None or name in names:
+            results[name] = measure(setup(), repeat) / unit
+    return (unit, results)
+
+
+def run_checked(baseline, tolerance=TOLERANCE, names=None, repeat=5,
+                retries=2):
+    """Like `run()`, but measure benchmarks appearing to have regressed
+    again (up to `retries` times), keeping their best result, to weed out
+    interference from other processes"""
+    (unit, results) = run(names, repeat)
+    for _ in range(retries):
+        slow = [n for n in results
+                if n in baseline and results[n] > baseline[n] * tolerance]
+        if len(slow) == 0:
+            break
+        (unit, again) = run(slow, repeat)
+        for n in slow:
+            results[n] = min(results[n], again[n])
+    return (unit, results)
+
+
+def load_baseline(path=BASELINE):
+    with Path(path).open() as f:
+        return json.load(f)['benchmarks']
+
+
+def save_baseline(results, path=BASELINE):
+    with Path(path).open('w') as f:
+        json.dump({'unit': 'calibration loop',
+                   'benchmarks': {n: round(v, 6) for (n, v)
+                                  in sorted(results.items())}},
+                  f, indent=1)
+        f.write('\n')
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    """Descriptions of all benchmarks slower than `tolerance` times their
+    baseline"""
+    return ["%s: %.4f units, %.2f× the baseline of %.4f"
+            % (name, value, value / baseline[name], baseline[name])
+            for (name, value) in sorted(results.items())
+            if name in baseline and value > baseline[name] * tolerance]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks of request parsing and formatting")
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help="benchmarks to run (default: all of %s)"
+                        % ', '.join(benchmarks))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="measurements per benchmark (the best counts)")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="fail if slower than this factor times the"
+                        " baseline")
+    parser.add_argument('--baseline', default=BASELINE,
+                        help="baseline file")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="store the results as the new baseline")
+    parser.add_argument('--allocations', action='store_true',
+                        help="also report the peak bytes allocated per call")
+    args = parser.parse_args()
+    for n in args.names:
+        if n not in benchmarks:
+            parser.error("unknown benchmark %r" % n)
+    try:
+        baseline = load_baseline(args.baseline)
+    except FileNotFoundError:
+        baseline = {}
+    if args.allocations:
+        print("%-18s %10s" % ('benchmark', 'bytes'))
+        for (name, setup) in benchmarks.items():
+            if not args.names or name in args.names:
+                print("%-18s %10.0f" % (name, allocated(setup())))
+    if args.update_baseline:
+        (unit, results) = run(args.names or None, args.repeat)
+    else:
+        (unit, results) = run_checked(baseline, args.tolerance,
+                                      args.names or None, args.repeat)
+    print("Calibration unit: %.2f µs" % (unit * 1e6))
+    print("%-18s %10s %10s %10s %7s" % ('benchmark', 'µs', 'units',
+                                         'baseline', 'ratio'))
+    for (name, value) in results.items():
+        if name in baseline:
+            print("%-18s %10.2f %10.4f %10.4f %7.2f"
+                  % (name, value * unit * 1e6, value, baseline[name],
+                     value / baseline[name]))
+        else:
+            print("%-18s %10.2f %10.4f %10s %7s"
+                  % (name, value * unit * 1e6, value, '-', '-'))
+    if args.update_baseline:
+        baseline.update(results)
+        save_baseline(baseline, args.baseline)
+        print("Baseline updated")
+        return 0
+    slow = regressions(results, baseline, args.tolerance)
+    for s in slow:
+        print("REGRESSION " + s)
+    return 1 if slow else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# On-demand profiling and stack dumps of the running daemon
+#
+# The profiler periodically samples the stacks of all threads (request
+# handlers, commit rounds, mail) and counts them in the "collapsed stack"
+# format understood by `flamegraph.pl` and speedscope: one line per distinct
+# stack, frames separated by `;`, followed by the number of samples.
+#
+# Triggered by SIGUSR1 (profile for `--profile-duration`) and SIGQUIT (stack
+# dump), or the administrative requests `/debug/profile` and `/debug/stacks`.
+# Results are logged or written to `--profile-dir`.
+
+import collections
+import logging as _logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import zeitgitter.config
+
+logging = _logging.getLogger('profiler')
+
+# Only one profile at a time
+running = threading.Lock()
+
+
+def thread_names():
+    return {t.ident: t.name for t in threading.enumerate()}
+
+
+def thread_group(name):
+    """Thread name without numbering, so that, e.g., all request handler
+    threads are merged into one"""
+    return re.sub(r'-[0-9]+', '', name)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def collapse(frame):
+    """The stack of `frame` from the outermost call, in collapsed format"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def sample(duration, interval=0.005):
+    """Sample the stacks of all other threads every `interval` seconds for
+    `duration` seconds. Returns a `Counter` of collapsed stacks, each
+    prefixed by the thread group; `None` if a profile is already running."""
+    if not running.acquire(blocking=False):
+        return None
+    try:
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            names = thread_names()
+            for (ident, frame) in sys._current_frames().items():
+                if ident != me:
+                    name = thread_group(names.get(ident, '?'))
+                    stacks[name + ';' + collapse(frame)] += 1
+            frame = None  # Do not keep the last frame alive while sleeping
+            time.sleep(interval)
+        return stacks
+    finally:
+        running.release()
+
+
+def format_collapsed(stacks):
+    return ''.join('%s %d\n' % (s, n) for (s, n) in sorted(stacks.items()))
+
+
+def dump_stacks():
+    """Human-readable stacks of all threads"""
+    names = thread_names()
+    ret = []
+    for (ident, frame) in sys._current_frames().items():
+        ret.append('Thread %s (%d):\n%s' % (names.get(ident, '?'), ident,
+                                           ''.join(traceback.format_stack(frame))))
+    return '\n'.join(ret)
+
+
+def output_file(kind):
+    path = Path(zeitgitter.config.arg.profile_dir,
+                'zeitgitter-%s-%s-%d.txt'
+                % (kind, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def profile_to_file(duration):
+    stacks = sample(duration)
+    if stacks is None:
+        logging.warning("Profile already running, ignoring request")
+        return
+    path = output_file('profile')
+    with path.open('w') as f:
+        f.write(format_collapsed(stacks))
+    logging.warning("Wrote %d samples to %s" % (sum(stacks.values()), path))
+
+
+def stacks_to_file():
+    stacks = dump_stacks()
+    path = output_file('stacks')
+    with path.open('w') as f:
+        f.write(stacks)
+    logging.warning("Thread stacks (also in %s):\n%s" % (path, stacks))
+
+
+def handle_signal(signum, frame):
+    # Do not do any real work (or logging) in the signal handler
+    if signum == signal.SIGUSR1:
+        target = lambda: profile_to_file(
+            zeitgitter.config.arg.profile_duration)
+    else:
+        target = stacks_to_file
+    threading.Thread(target=target, name='profiler', daemon=True).start()
+
+
+def setup():
+    signal.signal(signal.SIGUSR1, handle_signal)
+    signal.signal(signal.SIGQUIT, handle_signal)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Traffic recording (`--record-traffic`), for `zeitgitter-replay`
+#
+# One JSON line per request: arrival time, request type, method, sizes,
+# status, and duration. Client addresses and commit IDs are replaced by
+# pseudonyms (keyed hashes), so that bursts from the same client and
+# repeated commit IDs remain visible, but not who or what was timestamped.
+# The key is random and never stored: pseudonyms cannot be linked across
+# restarts or to other recordings. Tag names are not recorded.
+
+import hashlib
+import hmac
+import json
+import logging as _logging
+import os
+import threading
+import time
+
+import zeitgitter.config
+
+logging = _logging.getLogger('record')
+
+FORMAT = 'zeitgitter-traffic-v1'
+
+# The `Recorder`, if enabled
+recorder = None
+
+
+class Recorder:
+    def __init__(self, path):
+        self.key = os.urandom(32)
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=1)
+        self.write({'format': FORMAT, 'started': round(time.time(), 3)})
+        logging.info("Recording traffic to %s" % path)
+
+    def pseudonym(self, value):
+        return hmac.new(self.key, bytes(value, 'UTF-8'),
+                        hashlib.sha256).hexdigest()[:16]
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def record(self, arrival, request, method, status, size, response,
+               duration, client, commits=()):
+        self.write({'t': round(arrival, 3),
+                    'request': request,
+                    'method': method,
+                    'status': status,
+                    'size': size,
+                    'response': response,
+                    'duration': round(duration, 6),
+                    'client': self.pseudonym(client),
+                    'commits': [self.pseudonym(c) for c in commits]})
+
+
+def setup():
+    global recorder
+    path = zeitgitter.config.arg.record_traffic
+    if path is not None and recorder is None:
+        recorder = Recorder(path)
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Replay recorded traffic (see `--record-traffic`)
+#
+# Sends the timestamping and public key requests of a recording with the
+# recorded arrival pattern (optionally sped up) to a throwaway `zeitgitterd`
+# (see `zeitgitter.bench`) or a given server. Requests for the same commit
+# pseudonym use the same (made-up) commit ID, so repeated requests remain
+# repeated. Other requests (web pages, lookups, metrics, ...) are skipped.
+#
+# Usage: zeitgitter-replay --help
+
+import argparse
+import hashlib
+import json
+import logging as _logging
+import sys
+import urllib.parse
+
+import zeitgitter.bench
+import zeitgitter.record
+
+logging = _logging.getLogger('replay')
+
+KINDS = {'stamp-tag-v1': 'tag',
+         'stamp-branch-v1': 'branch',
+         'get-public-key-v1': 'pubkey',
+         'stamp-aggregate-v1': 'aggregate'}
+
+
+def load(lines, skip=0, duration=None):
+    """Returns the replayable records of the recording in `lines`, in order
+    of arrival, starting `skip` seconds after the first request and
+    covering `duration` seconds, and the number of other records"""
+    records = []
+    for line in lines:
+        if line.strip() == '':
+            continue
+        r = json.loads(line)
+        if 'format' in r:
+            if r['format'] != zeitgitter.record.FORMAT:
+                raise ValueError("Unsupported recording format %r"
+                                 % r['format'])
+        else:
+            records.append(r)
+    if len(records) == 0:
+        return ([], 0)
+    records.sort(key=lambda r: r['t'])
+    start = records[0]['t'] + skip
+    end = None if duration is None else start + duration
+    records = [r for r in records
+               if r['t'] >= start and (end is None or r['t'] < end)]
+    replayable = [r for r in records if r['request'] in KINDS]
+    return (replayable, len(records) - len(replayable))
+
+
+def commit_for(pseudonym):
+    return hashlib.sha1(bytes(pseudonym, 'ASCII')).hexdigest()
+
+
+def schedule(records, speed):
+    """The records as a schedule for `zeitgitter.bench.open_loop()`"""
+    t0 = records[0]['t']
+    return [((r['t'] - t0) / speed, KINDS[r['request']],
+             commit_for(r['commits'][0]) if r['commits'] else None)
+            for r in records]
+
+
+def timeline(records, samples, speed, bucket):
+    """Per `bucket` seconds of recording time: number of requests, recorded
+    and replayed 429 rates, and replayed p99 latency"""
+    t0 = records[0]['t']
+    begin = min(s[0] for s in samples) if samples else 0
+    rows = {}
+    for r in records:
+        row = rows.setdefault(int((r['t'] - t0) // bucket),
+                              {'recorded': 0, 'recorded-429': 0,
+                               'latencies': [], 'replayed-429': 0})
+        row['recorded'] += 1
+        row['recorded-429'] += r['status'] == 429
+    for s in samples:
+        row = rows.setdefault(int((s[0] - begin) * speed // bucket),
+                              {'recorded': 0, 'recorded-429': 0,
+                               'latencies': [], 'replayed-429': 0})
+        row['latencies'].append(s[1])
+        row['replayed-429'] += s[3] == 429
+    ret = []
+    for (i, row) in sorted(rows.items()):
+        latencies = sorted(row['latencies'])
+        ret.append({'offset': i * bucket,
+                    'requests': row['recorded'],
+                    'recorded-429': (row['recorded-429'] / row['recorded']
+                                     if row['recorded'] else 0),
+                    'replayed-429': (row['replayed-429'] / len(latencies)
+                                     if latencies else 0),
+                    'p99': zeitgitter.bench.percentile(latencies, 99)})
+    return ret
+
+
+def replay(args, records):
+    duration = (records[-1]['t'] - records[0]['t']) / args.speed
+    kinds = sorted(set(KINDS[r['request']] for r in records))
+
+    def run(host, port):
+        # Requests not sent within a second of their time are "unsent"
+        return zeitgitter.bench.drive(
+            host, port, kinds, args.connections, duration + 1,
+            schedule=schedule(records, args.speed))
+    result = {}
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        samples = run(url.hostname, url.port or 80)
+    else:
+        with zeitgitter.bench.throwaway_gnupg_home() as gnupg_home, \
+                zeitgitter.bench.BenchServer(gnupg_home,
+                                             args.server_arg) as server:
+            samples = run('127.0.0.1', server.port)
+            result['server'] = zeitgitter.bench.server_summary(
+                server.metrics())
+    result['summary'] = zeitgitter.bench.report(samples, max(duration, 1),
+                                                kinds)
+    if args.timeline:
+        result['timeline'] = timeline(records, samples, args.speed,
+                                      args.timeline)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Replay traffic recorded by `--record-traffic`")
+    parser.add_argument('recording',
+                        help="file written by `--record-traffic`")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="replay this many times faster (e.g., 1 to 100)")
+    parser.add_argument('--skip', type=float, default=0,
+                        help="start this many seconds into the recording")
+    parser.add_argument('--duration', type=float,
+                        help="replay only this many seconds of the recording"
+                        " (default: all)")
+    parser.add_argument('--connections', type=int, default=64,
+                        help="number of concurrent keep-alive connections;"
+                        " requests are delayed if all are busy")
+    parser.add_argument('--timeline', type=float, metavar='SECONDS',
+                        help="also report per this many seconds of recording")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="additional zeitgitterd option (repeat for"
+                        " every word)")
+    parser.add_argument('--url',
+                        help="replay to this already running server instead")
+    parser.add_argument('--json', action='store_true',
+                        help="output the results as JSON")
+    parser.add_argument('--debug-level', default='WARN',
+                        help="log level")
+    args = parser.parse_args()
+    _logging.basicConfig(level=_logging.getLevelName(args.debug_level.upper()))
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    with open(args.recording) as f:
+        (records, skipped) = load(f, args.skip, args.duration)
+    if len(records) == 0:
+        sys.exit("Nothing to replay in %s" % args.recording)
+    logging.info("Replaying %d requests, skipping %d others"
+                 % (len(records), skipped))
+    result = replay(args, records)
+    if args.json:
+        print(json.dumps(result, indent=1))
+        return
+    zeitgitter.bench.print_table([dict(result,
+                                       **{'max-parallel-signatures': None,
+                                          'number-of-gpg-agents': None})])
+    recorded = sum(r['status'] == 429 for r in records)
+    print("Recorded: %d requests, 429 %.2f %%; %d other requests skipped"
+          % (len(records), recorded * 100 / len(records), skipped))
+    for row in result.get('timeline', []):
+        print("%8.0fs %6d requests, 429 recorded %6.2f %%, replayed %6.2f %%,"
+              " p99 %s ms" % (row['offset'], row['requests'],
+                              row['recorded-429'] * 100,
+                              row['replayed-429'] * 100,
+                              zeitgitter.bench.format_ms(row['p99'])))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
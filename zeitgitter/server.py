@@ -21,22 +21,41 @@
 # HTTP request handling
 
 
-import cgi
+import email.utils
+import fcntl
+import html
 import importlib.resources
 import logging as _logging
 import os
 import re
+import select
+import signal
 import socket
 import socketserver
 import subprocess
+import sys
+import threading
+import time
 import urllib
 import ipaddress
+import json
+import mmap
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 
+import zeitgitter.aggregate
+import zeitgitter.calibrate
 import zeitgitter.commit
 import zeitgitter.config
+import zeitgitter.formparse
+import zeitgitter.health
+import zeitgitter.index
+import zeitgitter.metrics
+import zeitgitter.profiler
+import zeitgitter.record
 import zeitgitter.stamper
+import zeitgitter.startup
+import zeitgitter.trace
 import zeitgitter.version
 from zeitgitter import moddir
 
@@ -44,21 +63,29 @@ logging = _logging.getLogger('server')
 
 
 class SocketActivationMixin:
-    """Use systemd provided socket, if available.
-    When socket activation is used, exactly one socket needs to be passed."""
+    """Use the socket `fd` provided by systemd (or handed over by the
+    previous process on a graceful restart, see `restart()`) instead of
+    binding a new one, if given. Whose `X-Forwarded-For` is trusted on
+    this listener is decided by `trusted_proxies` (the configured policy
+    for its address, if `None`)"""
+
+    def __init__(self, server_address, RequestHandlerClass, fd=None,
+                 trusted_proxies=None):
+        self.activated_fd = fd
+        super().__init__(server_address, RequestHandlerClass)
+        if trusted_proxies is None:
+            trusted_proxies = configured_trust(self.server_address)
+        self.trusted_unix = 'unix' in trusted_proxies
+        self.trusted_nets = [ipaddress.ip_network(p)
+                             for p in trusted_proxies if p != 'unix']
 
     def server_bind(self):
-        nfds = 0
-        if os.environ.get('LISTEN_PID', None) == str(os.getpid()):
-            nfds = int(os.environ.get('LISTEN_FDS', 0))
-            if nfds == 1:
-                self.socket = socket.socket(fileno=3)
-            else:
-                logging.error(
-                    "Socket activation must provide exactly one socket (for now)\n")
-                exit(1)
-        else:
+        if self.activated_fd is None:
             super().server_bind()
+        else:
+            self.socket.close()
+            self.socket = socket.socket(fileno=self.activated_fd)
+            self.server_address = self.socket.getsockname()
 
 
 class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
@@ -66,38 +93,408 @@ class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
     pass
 
 
-class SocketActivationHTTPServer(SocketActivationMixin, ThreadingHTTPServer):
+class DrainingMixin:
+    """Keep track of the open connections, to be able to drain them before
+    a graceful restart"""
+
+    DRAIN_GRACE = 0.5
+    # Queue many connections while not accepting, e.g., during a restart
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, *args, **kwargs):
+        self.connections = set()
+        self.connections_changed = threading.Condition()
+        self.draining = False
+        # Becomes (and stays) readable when draining starts
+        (self.drain_wakeup, self.drain_trigger) = os.pipe()
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        with self.connections_changed:
+            self.connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_changed:
+            self.connections.discard(request)
+            self.connections_changed.notify_all()
+        super().shutdown_request(request)
+
+    def wait_for_request(self, connection, timeout=None):
+        """Wait until the next request on `connection` starts arriving.
+        Returns `None` then, or why the connection should be closed instead:
+        `'idle-timeout'` if nothing arrived within `timeout` seconds, or
+        `'restart'` if we are draining and it has been idle for
+        `DRAIN_GRACE` seconds since. (The grace period avoids closing
+        connections whose client has already sent the next request after a
+        response not yet announcing `Connection: close`.)"""
+        poll = select.poll()
+        poll.register(connection, select.POLLIN)
+        poll.register(self.drain_wakeup, select.POLLIN)
+        ready = poll.poll(None if timeout is None else timeout * 1000)
+        if len(ready) == 0:
+            return 'idle-timeout'
+        if any(fd != self.drain_wakeup for (fd, _) in ready):
+            return None
+        poll.unregister(self.drain_wakeup)
+        if len(poll.poll(self.DRAIN_GRACE * 1000)) > 0:
+            return None
+        return 'restart'
+
+    def begin_drain(self):
+        """Close idle connections now and busy ones after their current
+        request"""
+        with self.connections_changed:
+            self.draining = True
+            os.write(self.drain_trigger, b'.')
+
+    def wait_drained(self, timeout):
+        """Wait up to `timeout` seconds for all connections to be closed;
+        returns the number still open"""
+        with self.connections_changed:
+            self.connections_changed.wait_for(
+                lambda: len(self.connections) == 0, timeout)
+            return len(self.connections)
+
+    def server_close(self):
+        super().server_close()
+        os.close(self.drain_wakeup)
+        os.close(self.drain_trigger)
+
+
+class SocketActivationHTTPServer(SocketActivationMixin, DrainingMixin,
+                                 ThreadingHTTPServer):
+    def __init__(self, server_address, RequestHandlerClass, fd=None,
+                 trusted_proxies=None):
+        if ':' in server_address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(server_address, RequestHandlerClass, fd,
+                         trusted_proxies)
+
+    def server_bind(self):
+        if self.address_family == socket.AF_INET6:
+            # Allow separate IPv4 and IPv6 listeners on the same port
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        super().server_bind()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix domain socket, e.g., for a reverse proxy on the
+    same machine; its peer is `UNIX_PEER`"""
+
+    remove_on_close = False
+
+    def server_bind(self):
+        try:
+            Path(self.server_address).unlink()  # Left over
+        except FileNotFoundError:
+            pass
+        super().server_bind()
+        os.chmod(self.server_address,
+                 int(zeitgitter.config.arg.listen_unix_mode, 8))
+        self.remove_on_close = True
+
+    def server_close(self):
+        super().server_close()
+        if self.remove_on_close:  # Not if passed by systemd
+            try:
+                Path(self.server_address).unlink()
+            except FileNotFoundError:
+                pass
+
+
+class SocketActivationUnixHTTPServer(SocketActivationMixin, DrainingMixin,
+                                     UnixHTTPServer):
     pass
 
 
+def activated_fds():
+    """The file descriptors passed by systemd (or the previous process)"""
+    if os.environ.get('LISTEN_PID', None) != str(os.getpid()):
+        return []
+    return list(range(3, 3 + int(os.environ.get('LISTEN_FDS', 0))))
+
+
+def configured_trust(server_address):
+    """The trusted proxies configured for the listener on `server_address`
+    (e.g., a socket handed over on a restart), defaulting to
+    `--trusted-proxies`"""
+    arg = zeitgitter.config.arg
+    if isinstance(server_address, tuple):
+        (host, port) = server_address[:2]
+        for (address, proxies) in arg.listen_address:
+            try:
+                same = (ipaddress.ip_address(address)
+                        == ipaddress.ip_address(host))
+            except ValueError:  # E.g., a host name
+                same = address == host
+            if same and port == arg.listen_port and proxies is not None:
+                return proxies
+    elif (server_address == arg.listen_unix
+          and arg.listen_unix_trusted is not None):
+        return arg.listen_unix_trusted
+    return arg.trusted_proxies
+
+
+def create_servers():
+    """One server per listener: the sockets passed by systemd (or the
+    previous process), if any; otherwise, those configured"""
+    arg = zeitgitter.config.arg
+    servers = []
+    fds = activated_fds()
+    for fd in fds:
+        # Only to learn the address family
+        with socket.socket(fileno=os.dup(fd)) as sock:
+            family = sock.family
+        if family == socket.AF_UNIX:
+            server = SocketActivationUnixHTTPServer(
+                '', StamperRequestHandler, fd)
+            # Ours, if handed over on a restart
+            server.remove_on_close = server.server_address == arg.listen_unix
+            servers.append(server)
+        else:
+            servers.append(SocketActivationHTTPServer(
+                ('', 0), StamperRequestHandler, fd))
+    if not fds:
+        for (address, proxies) in arg.listen_address:
+            servers.append(SocketActivationHTTPServer(
+                (address, arg.listen_port), StamperRequestHandler,
+                trusted_proxies=proxies))
+        if arg.listen_unix is not None:
+            servers.append(SocketActivationUnixHTTPServer(
+                arg.listen_unix, StamperRequestHandler,
+                trusted_proxies=arg.listen_unix_trusted))
+    if not servers:
+        sys.exit("Nothing to listen on")
+    for server in servers:
+        logging.info("Listening on %s" % (server.server_address,))
+    return servers
+
+
+class StaticFile:
+    """An open file from the webroot, with what is needed to serve it"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb', buffering=0)
+        st = os.fstat(self.file.fileno())
+        self.identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.templated = None
+
+    def is_templated(self, keys):
+        """Whether any of `keys` (the same on every call) occurs in the file"""
+        if self.templated is None:
+            if self.size == 0:
+                self.templated = False
+            else:
+                with mmap.mmap(self.file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as m:
+                    self.templated = any(m.find(k) >= 0 for k in keys)
+        return self.templated
+
+    def read(self):
+        return os.pread(self.file.fileno(), self.size, 0)
+
+
+# Open webroot files, by path. A file replaced on disk is opened again;
+# requests still sending the old one keep it open until they are done.
+static_files = {}
+static_files_lock = threading.Lock()
+STATIC_FILES_MAX = 64
+
+
+def static_file(path):
+    """The (cached) `StaticFile` for `path`. Raises `OSError` if there is
+    no such file."""
+    st = os.stat(path)
+    identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with static_files_lock:
+        f = static_files.get(path)
+    if f is not None and f.identity == identity:
+        return f
+    f = StaticFile(path)
+    with static_files_lock:
+        if path not in static_files and len(static_files) >= STATIC_FILES_MAX:
+            del static_files[next(iter(static_files))]  # The oldest
+        static_files[path] = f
+    return f
+
+
+def parse_range(header, size):
+    """The `(start, stop)` to send for the `Range` header, or `None` to
+    send everything (no or multiple ranges). Raises `ValueError` if the
+    range cannot be satisfied."""
+    match = re.match(r'^bytes=\s*(\d*)-(\d*)\s*$', header or '')
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':  # Suffix: the last n bytes
+        suffix = int(match.group(2))
+        if suffix == 0 or size == 0:
+            raise ValueError("Empty suffix range")
+        return (max(size - suffix, 0), size)
+    start = int(match.group(1))
+    stop = size if match.group(2) == '' else int(match.group(2)) + 1
+    if start >= size or stop <= start:
+        raise ValueError("Range outside of file")
+    return (start, min(stop, size))
+
+
 class FlatFileRequestHandler(BaseHTTPRequestHandler):
     def send_file(self, content_type, filename, replace={}):
+        if content_type.startswith('text/'):
+            content_type += '; charset=UTF-8'
         try:
             webroot = zeitgitter.config.arg.webroot
             if webroot is None:
                 webroot = moddir('web')
             if webroot and os.path.isdir(webroot):
-                with Path(webroot, filename).open(mode='rb') as f:
-                    contents = f.read()
+                f = static_file(Path(webroot, filename))
+                static = not (replace and f.is_templated(replace.keys()))
+                contents = None if static else f.read()
             else:
+                static = False
                 contents = importlib.resources.read_binary(
                     'zeitgitter', filename)
-            for k, v in replace.items():
-                contents = contents.replace(k, v)
-            self.send_response(200)
+        except OSError:
+            self.send_bodyerr(404, "File not found",
+                              "This file was not found on this server")
+            return
+        if static:
+            # Outside the `try`: Write errors (e.g., the client went away)
+            # close the connection instead of appending a 404 response
+            self.send_static(content_type, f)
+            return
+        for k, v in replace.items():
+            contents = contents.replace(k, v)
+        self.send_response(200)
+        self.send_header(
+            'Cache-Control', zeitgitter.config.arg.cache_control_static)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(contents))
+        self.send_body(contents)
+
+    def send_static(self, content_type, f):
+        """Send `StaticFile` `f`, honoring `If-Modified-Since` and `Range`"""
+        try:
+            since = email.utils.parsedate_to_datetime(
+                self.headers['If-Modified-Since']).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and f.mtime <= since:
+            self.send_response(304)
             self.send_header(
                 'Cache-Control', zeitgitter.config.arg.cache_control_static)
-            if content_type.startswith('text/'):
-                self.send_header(
-                    'Content-Type', content_type + '; charset=UTF-8')
-            else:
-                self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', len(contents))
+            self.send_header('Last-Modified', f.last_modified)
             self.end_headers()
-            self.wfile.write(contents)
-        except IOError as e:
-            self.send_bodyerr(404, "File not found",
-                              "This file was not found on this server")
+            return
+        if self.headers.get('If-Range', f.last_modified) != f.last_modified:
+            byterange = None  # Changed since: send all
+        else:
+            try:
+                byterange = parse_range(self.headers['Range'], f.size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % f.size)
+                self.send_header('Content-Length', 0)
+                self.end_headers()
+                return
+        (start, stop) = byterange or (0, f.size)
+        self.send_response(200 if byterange is None else 206)
+        self.send_header(
+            'Cache-Control', zeitgitter.config.arg.cache_control_static)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Last-Modified', f.last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        if byterange is not None:
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, stop - 1, f.size))
+        self.send_header('Content-Length', stop - start)
+        if self.command == 'HEAD':
+            self.end_headers()
+            return
+        # Corked: sent together with (the start of) the body
+        self.write_all([self.ended_headers()], more=stop > start)
+        self.send_body_file(f.file, start, stop - start)
+
+    def send_body_file(self, file, offset, count):
+        """Send `count` bytes from `offset` in `file`, without copying them
+        through user space where possible. The file position is not used,
+        as the file is shared between threads."""
+        fd = file.fileno()
+        if hasattr(os, 'sendfile') and self.plain_socket():
+            out = self.connection.fileno()
+            while count > 0:
+                sent = os.sendfile(out, fd, offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        else:
+            while count > 0:
+                data = os.pread(fd, min(count, 65536), offset)
+                if len(data) == 0:
+                    break
+                self.wfile.write(data)
+                offset += len(data)
+                count -= len(data)
+        if count > 0:
+            # Truncated meanwhile: the client notices by the early close
+            logging.warning("%s shrunk while being sent" % file.name)
+            self.close_connection = True
+
+    # While set, `end_headers()` keeps the headers buffered
+    defer_headers = False
+
+    def flush_headers(self):
+        if not self.defer_headers:
+            super().flush_headers()
+
+    def ended_headers(self):
+        """End the headers, returning them instead of sending them"""
+        self.defer_headers = True
+        try:
+            self.end_headers()
+        finally:
+            self.defer_headers = False
+        headers = b''.join(getattr(self, '_headers_buffer', []))
+        self._headers_buffer = []
+        return headers
+
+    def send_body(self, data):
+        """End the headers and send them together with the body (unless
+        answering a `HEAD` request), in a single system call. (Separate
+        writes would stall keep-alive clients for the delayed ACK.)"""
+        headers = self.ended_headers()
+        if self.command == 'HEAD':
+            self.write_all([headers])
+        else:
+            self.write_all([headers, data])
+
+    def plain_socket(self):
+        """Whether we can write to the socket directly, bypassing `wfile`:
+        plain blocking sockets only, not, e.g., `ssl.SSLSocket`"""
+        return (type(self.connection) is socket.socket
+                and self.connection.gettimeout() is None)
+
+    def write_all(self, buffers, more=False):
+        """Write `buffers` with as few system calls as possible, usually a
+        single `sendmsg()` (i.e., `writev()`). With `more`, the kernel
+        waits for more data (e.g., from `sendfile()`) before sending."""
+        if not self.plain_socket():
+            self.wfile.write(b''.join(buffers))
+            return
+        flags = getattr(socket, 'MSG_MORE', 0) if more else 0
+        buffers = [b for b in buffers if len(b) > 0]
+        while buffers:
+            sent = self.connection.sendmsg(buffers, (), flags)
+            while sent > 0:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                else:
+                    buffers[0] = memoryview(buffers[0])[sent:]
+                    sent = 0
 
     def send_bodyerr(self, status, title, body):
         explain = """<html><head><title>%s</title></head>
@@ -108,8 +505,7 @@ class FlatFileRequestHandler(BaseHTTPRequestHandler):
         self.send_response(status)
         self.send_header('Content-Type', 'text/html; charset=UTF-8')
         self.send_header('Content-Length', len(explain))
-        self.end_headers()
-        self.wfile.write(explain)
+        self.send_body(explain)
 
     def do_GET(self):
         subst = {b'ZEITGITTER_DOMAIN': bytes(zeitgitter.config.arg.domain, 'UTF-8'),
@@ -131,7 +527,9 @@ class FlatFileRequestHandler(BaseHTTPRequestHandler):
             'ico': 'image/png',
             'svg': 'image/svg+xml',
             'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg'}
+            'jpeg': 'image/jpeg',
+            'log': 'text/plain',
+            'pdf': 'application/pdf'}
         if match and match.group(2) in mimemap:
             mime = mimemap[match.group(2)]
             if mime.startswith('text/'):
@@ -146,25 +544,135 @@ class FlatFileRequestHandler(BaseHTTPRequestHandler):
 stamper = None
 public_key = None
 
+# Client address of requests over a Unix domain socket (without a
+# trusted `X-Forwarded-For`)
+UNIX_PEER = 'unix'
+
+# Request types distinguished in the metrics (to bound their number)
+REQUESTS = ('stamp-tag-v1', 'stamp-branch-v1', 'stamp-aggregate-v1',
+            'get-public-key-v1', 'lookup-v1', 'proof-v1')
 
-def ensure_stamper(start_multi_threaded=False):
+
+def ensure_stamper(start_multi_threaded=False, key=None):
     global stamper
     if stamper is None:
-        stamper = zeitgitter.stamper.Stamper()
+        stamper = zeitgitter.stamper.Stamper(key)
     if start_multi_threaded:
         stamper.start_multi_threaded()
 
 
 class StamperRequestHandler(FlatFileRequestHandler):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, request, client_address, server):
         ensure_stamper()
         self.protocol_version = 'HTTP/1.1'
-        if zeitgitter.config.arg.trusted_proxies == "none":
-            self.trusted_nets = []
+        # The listener's policy
+        self.trusted_unix = server.trusted_unix
+        self.trusted_nets = server.trusted_nets
+        self.admin_nets = list(map(ipaddress.ip_network,
+                                   zeitgitter.config.arg.admin_networks))
+        self.keep_alive_timeout = zeitgitter.config.arg.keep_alive_timeout
+        self.max_requests = zeitgitter.config.arg.keep_alive_max_requests
+        self.requests_handled = 0
+        self.close_reason = None
+        super().__init__(request, client_address, server)
+
+    def finish(self):
+        """Account the connection in the metrics"""
+        zeitgitter.metrics.connections_closed.child(
+            self.close_reason or 'client').inc()
+        zeitgitter.metrics.connection_requests.observe(self.requests_handled)
+        super().finish()
+
+    def request_buffered(self):
+        """Whether (the start of) a pipelined request has already been read
+        into `rfile`, so waiting on the socket could stall it"""
+        if self.requests_handled == 0:
+            return False
+        self.connection.setblocking(False)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        """Account each request in the metrics (and the recording)"""
+        self.request_name = None
+        self.params = {}
+        self.status = None
+        self.response_size = 0
+        self.arrival = None
+        self.trace_token = None
+        self.parsed = False
+        if not self.request_buffered():
+            reason = self.server.wait_for_request(self.connection,
+                                                  self.keep_alive_timeout)
+            if reason is not None:
+                self.close_reason = reason
+                self.close_connection = True
+                return
+        try:
+            super().handle_one_request()
+        finally:
+            if self.status is not None:
+                if self.arrival is None:  # Request line too long
+                    self.arrival = time.time()
+                    self.start = time.perf_counter()
+                duration = time.perf_counter() - self.start
+                labels = (self.request_name or 'invalid', self.status)
+                zeitgitter.metrics.requests.child(*labels).inc()
+                zeitgitter.metrics.request_duration.child(*labels).observe(
+                    duration)
+                zeitgitter.trace.annotate(request=labels[0], status=self.status)
+                zeitgitter.trace.finish(self.trace_token)
+                if zeitgitter.record.recorder is not None:
+                    self.record(labels[0], duration)
+            elif self.trace_token is not None:
+                zeitgitter.trace.current.reset(self.trace_token)  # No request
+
+    def parse_started(self):
+        """The request line has arrived (i.e., we are no longer waiting
+        on an idle keep-alive connection)"""
+        self.arrival = time.time()
+        self.start = time.perf_counter()
+        self.trace_token = zeitgitter.trace.start()
+
+    def parse_request(self):
+        self.parse_started()
+        self.parsed = super().parse_request()
+        if not self.parsed:
+            return False
+        self.requests_handled += 1
+        if self.command != 'POST' and (
+                self.headers.get('Content-Length', '0') != '0'
+                or 'Transfer-Encoding' in self.headers):
+            self.close_reason = 'error'  # The body will not be read
+        return True
+
+    def send_header(self, keyword, value):
+        if keyword == 'Content-Length':
+            self.response_size = int(value)
+        super().send_header(keyword, value)
+
+    def record(self, request, duration):
+        if getattr(self, 'headers', None) is None:  # Bad request line
+            (size, client) = (0, self.peer_address())
         else:
-            self.trusted_nets = list(map(ipaddress.ip_network,
-                                re.split(r'\s*,\s*', zeitgitter.config.arg.trusted_proxies)))
-        super().__init__(*args, **kwargs)
+            try:
+                size = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                size = 0
+            client = self.address_string()
+        zeitgitter.record.recorder.record(
+            self.arrival, request, self.command, self.status, size,
+            self.response_size, duration, client,
+            self.params.get('commit', []))
+
+    def set_request_name(self, params):
+        name = params.get('request', [None])[0]
+        self.request_name = name if name in REQUESTS else 'invalid'
+        self.params = params
 
     def version_string(self):
         return "zeitgitter/" + zeitgitter.version.VERSION
@@ -175,8 +683,14 @@ class StamperRequestHandler(FlatFileRequestHandler):
             addr = addr.ipv4_mapped
         return any(map(lambda net: addr in net, self.trusted_nets))
 
+    def peer_address(self):
+        """IP address of the peer, or `UNIX_PEER` on a Unix domain socket"""
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return UNIX_PEER
+
     def address_string(self):
-        addr = super().address_string()
+        addr = self.peer_address()
         xff = self.headers.get('X-Forwarded-For')
         if xff:
             addr = xff + "," + addr
@@ -186,6 +700,12 @@ class StamperRequestHandler(FlatFileRequestHandler):
         # Any address except the last one may be faked,
         # so be careful. So start with a reliable one
         # and work backward as far as we can.
+        if not isinstance(self.client_address, tuple):
+            # Unix domain socket: Trust the peer's claim about the previous
+            # hop, if configured so
+            if not self.trusted_unix or len(addrs) == 1:
+                return UNIX_PEER
+            addrs = addrs[:-1]
         best_addr = addrs[-1]
         for a in reversed(addrs):
             try:
@@ -199,6 +719,113 @@ class StamperRequestHandler(FlatFileRequestHandler):
         return addrs[0]
 
 
+    def is_admin(self):
+        """Only direct (i.e., not proxied) connections from
+        `--admin-networks` may access administrative information"""
+        if self.headers.get('X-Forwarded-For'):
+            return False
+        try:
+            addr = ipaddress.ip_address(self.peer_address())
+        except ValueError:
+            return False  # E.g., Unix domain socket
+        if addr.version == 6 and addr.ipv4_mapped is not None:
+            addr = addr.ipv4_mapped
+        return any(map(lambda net: addr in net, self.admin_nets))
+
+    def send_metrics(self):
+        self.request_name = 'metrics'
+        if not self.is_admin():
+            self.send_bodyerr(403, "Forbidden",
+                              "<p>Metrics are only available locally</p>")
+            return
+        result = bytes(zeitgitter.metrics.render(), 'UTF-8')
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, no-store')
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=UTF-8')
+        self.send_header('Content-Length', len(result))
+        self.send_body(result)
+
+    def send_text(self, text, status=200):
+        result = bytes(text, 'UTF-8')
+        self.send_response(status)
+        self.send_header('Cache-Control', 'no-cache, no-store')
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.send_header('Content-Length', len(result))
+        self.send_body(result)
+
+    def send_debug(self, what, params):
+        """`/debug/stacks`: Stacks of all threads;
+        `/debug/profile?seconds=<n>`: Profile all threads for n seconds;
+        `POST /debug/reload`: Reload the configuration"""
+        self.request_name = 'debug'
+        if not self.is_admin():
+            self.send_bodyerr(403, "Forbidden",
+                              "<p>Debugging is only available locally</p>")
+        elif what == 'reload':
+            if self.method != 'POST':
+                self.send_bodyerr(405, "Method not allowed",
+                                  "<p>Use POST to reload</p>")
+            else:
+                (ok, text) = reload_config()
+                self.send_text(text, 200 if ok else 400)
+        elif what == 'stacks':
+            self.send_text(zeitgitter.profiler.dump_stacks())
+        elif what == 'profile':
+            try:
+                seconds = float(params.get('seconds', ['10'])[0])
+            except ValueError:
+                seconds = -1
+            if not 0 < seconds <= 300:
+                self.send_bodyerr(406, "Bad parameters",
+                                  "<p>Need 0 &lt; seconds &le; 300</p>")
+                return
+            stacks = zeitgitter.profiler.sample(seconds)
+            if stacks is None:
+                self.send_bodyerr(409, "Profile already running",
+                                  "<p>Try again later</p>")
+            else:
+                self.send_text(zeitgitter.profiler.format_collapsed(stacks))
+        else:
+            self.send_bodyerr(404, "Not found", "<p>No such debug page</p>")
+
+    def send_health(self, what):
+        """`/healthz/live`: 503 if the process cannot commit anymore;
+        `/healthz/ready`: 503 if anything is unhealthy (the reasons are only
+        given to `--admin-networks`); `/healthz`: full report (admin only)"""
+        self.request_name = 'health'
+        live = zeitgitter.health.live()
+        if what == '/live':
+            status = 200 if live else 503
+            self.send_text("ok\n" if live else "not live\n", status)
+        elif what == '/ready':
+            problems = zeitgitter.health.report()['problems']
+            if not live:
+                problems.insert(0, "not live")
+            if len(problems) == 0:
+                self.send_text("ok\n")
+            elif self.is_admin():
+                self.send_text(''.join(p + '\n' for p in problems), 503)
+            else:
+                self.send_text("unhealthy\n", 503)
+        elif what == '':
+            if not self.is_admin():
+                self.send_bodyerr(403, "Forbidden",
+                                  "<p>Health details are only available"
+                                  " locally</p>")
+                return
+            report = zeitgitter.health.report()
+            report['live'] = live
+            report['ready'] = live and len(report['problems']) == 0
+            result = bytes(json.dumps(report, indent=1) + '\n', 'ASCII')
+            self.send_response(200 if report['ready'] else 503)
+            self.send_header('Cache-Control', 'no-cache, no-store')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(result))
+            self.send_body(result)
+        else:
+            self.send_bodyerr(404, "Not found", "<p>No such health check</p>")
+
     def send_public_key(self):
         global stamper, public_key
         if public_key == None:
@@ -213,8 +840,64 @@ class StamperRequestHandler(FlatFileRequestHandler):
                 'Cache-Control', zeitgitter.config.arg.cache_control_static)
             self.send_header('Content-Type', 'application/pgp-keys')
             self.send_header('Content-Length', len(pk))
-            self.end_headers()
-            self.wfile.write(pk)
+            self.send_body(pk)
+
+    def send_lookup(self, commits):
+        global stamper
+        if zeitgitter.index.index is None:
+            self.send_bodyerr(404, "Lookup not available",
+                              "<p>This server does not keep an index</p>")
+        elif (len(commits) == 0 or len(commits) > 100
+              or not all(map(stamper.valid_commit, commits))):
+            self.send_bodyerr(406, "Bad parameters",
+                              "<p>Need 1 to 100 valid `commit` parameters</p>")
+        else:
+            result = bytes(json.dumps(zeitgitter.index.lookup(commits),
+                                      indent=1) + '\n', 'ASCII')
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(result))
+            self.send_body(result)
+
+    def send_proof(self, commits):
+        global stamper
+        if zeitgitter.index.index is None:
+            self.send_bodyerr(404, "Proofs not available",
+                              "<p>This server does not keep an index</p>")
+        elif len(commits) != 1 or not stamper.valid_commit(commits[0]):
+            self.send_bodyerr(406, "Bad parameters",
+                              "<p>Need exactly one valid `commit` parameter</p>")
+        else:
+            result = {'commit': commits[0],
+                      'proofs': zeitgitter.index.proofs(commits[0])}
+            result = bytes(json.dumps(result, indent=1) + '\n', 'ASCII')
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(result))
+            self.send_body(result)
+
+    def send_aggregate(self, commits):
+        if zeitgitter.aggregate.aggregator is None:
+            self.send_bodyerr(404, "Aggregation not available",
+                              "<p>This server does not aggregate requests</p>")
+        elif len(commits) != 1 or not stamper.valid_commit(commits[0]):
+            self.send_bodyerr(406, "Bad parameters",
+                              "<p>Need exactly one valid `commit` parameter</p>")
+        else:
+            receipt = zeitgitter.aggregate.submit(commits[0])
+            if receipt is None:
+                self.send_bodyerr(429, "Too many requests",
+                                  "<p>The server is currently overloaded</p>")
+                return
+            result = bytes(json.dumps(receipt, indent=1) + '\n', 'ASCII')
+            with zeitgitter.trace.span('respond'):
+                self.send_response(200)
+                self.send_header('Cache-Control', 'no-cache, no-store')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', len(result))
+                self.send_body(result)
 
     def handle_signature(self, params):
         global stamper
@@ -237,7 +920,20 @@ class StamperRequestHandler(FlatFileRequestHandler):
             return 406
 
     def handle_request(self, params):
-        sig = self.handle_signature(params)
+        self.set_request_name(params)
+        try:
+            if ('request' in params
+                    and params['request'][0] == 'stamp-aggregate-v1'):
+                self.send_aggregate(params.get('commit', []))
+                return
+            sig = self.handle_signature(params)
+        except OSError as e:
+            # Logging the commit failed (recorded as a health failure); it
+            # must not be signed then
+            logging.error("Cannot log commit: %s" % e)
+            self.send_bodyerr(500, "Internal server error",
+                              "<p>The request could not be logged</p>")
+            return
         if sig == 406:
             self.send_bodyerr(406, "Unsupported timestamping request",
                               "<p>See the documentation for the accepted requests</p>")
@@ -245,80 +941,206 @@ class StamperRequestHandler(FlatFileRequestHandler):
             self.send_bodyerr(429, "Too many requests",
                               "<p>The server is currently overloaded</p>")
         else:
-            sig = bytes(sig, 'ASCII')
-            self.send_response(200)
-            self.send_header('Cache-Control', 'no-cache, no-store')
-            self.send_header('Content-Type', 'application/x-git-object')
-            self.send_header('Content-Length', len(sig))
-            self.end_headers()
-            self.wfile.write(sig)
+            with zeitgitter.trace.span('respond'):
+                self.send_response(200)
+                self.send_header('Cache-Control', 'no-cache, no-store')
+                self.send_header('Content-Type', 'application/x-git-object')
+                self.send_header('Content-Length', len(sig))
+                self.send_body(sig)
 
     def do_POST(self):
         self.method = 'POST'
-        ctype, pdict = cgi.parse_header(self.headers['Content-Type'])
-        try:
-            clen = self.headers['Content-Length']
-            clen = int(clen)
-        except:
-            self.send_bodyerr(411, "Length required",
-                              "<p>Your request did not contain a valid length</p>")
+        if self.path.startswith('/debug/'):
+            self.close_reason = 'error'  # Any body is not read
+            url = urllib.parse.urlsplit(self.path)
+            self.send_debug(url.path[len('/debug/'):],
+                            urllib.parse.parse_qs(url.query))
             return
-        if clen > 1000 or clen < 0:
-            self.send_bodyerr(413, "Request too long",
-                              "<p>Your request is too long</p>")
+        try:
+            with zeitgitter.trace.span('parse'):
+                params = zeitgitter.formparse.parse(self.headers, self.rfile)
+        except zeitgitter.formparse.FormError as e:
+            self.close_reason = 'error'  # The body may not have been read
+            self.send_bodyerr(e.status, e.title,
+                              "<p>%s</p>" % html.escape(e.message))
             return
-        if ctype == 'multipart/form-data':
-            params = cgi.parse_multipart(self.rfile, pdict)
-            self.handle_request(params)
-        elif ctype == 'application/x-www-form-urlencoded':
-            contents = self.rfile.read(clen)
-            contents = contents.decode('UTF-8')
-            params = urllib.parse.parse_qs(contents)
-            self.handle_request(params)
-        else:
-            self.send_bodyerr(415, "Unsupported media type",
-                              "<p>Need form data input</p>")
+        self.handle_request(params)
 
     def do_GET(self):
         self.method = 'GET'
-        if self.path.startswith('/?'):
+        if self.path == '/metrics':
+            self.send_metrics()
+        elif self.path.startswith('/healthz'):
+            self.send_health(self.path[len('/healthz'):])
+        elif self.path.startswith('/debug/'):
+            url = urllib.parse.urlsplit(self.path)
+            self.send_debug(url.path[len('/debug/'):],
+                            urllib.parse.parse_qs(url.query))
+        elif self.path.startswith('/?'):
             params = urllib.parse.parse_qs(self.path[2:])
+            self.set_request_name(params)
             if 'request' in params and params['request'][0] == 'get-public-key-v1':
                 self.send_public_key()
+            elif 'request' in params and params['request'][0] == 'lookup-v1':
+                self.send_lookup(params.get('commit', []))
+            elif 'request' in params and params['request'][0] == 'proof-v1':
+                self.send_proof(params.get('commit', []))
             else:
                 self.send_bodyerr(406, "Bad parameters",
                                   "<p>Need a valid `request` parameter</p>")
         else:
+            self.request_name = 'static'
             super().do_GET()
 
     def send_response(self, code, message=None):
-        try:
-            if code != 200 and self.method == 'HEAD':
-                self.method = self.method + '+error'
-        except AttributeError:
-            self.method = '[UNKNOWN]'
+        self.status = code
         super().send_response(code, message)
 
+    def send_error(self, code, message=None, explain=None):
+        if not self.parsed:  # Malformed request
+            self.close_reason = self.close_reason or 'error'
+        super().send_error(code, message, explain)
+
     def end_headers(self):
-        """If it is a successful HEAD request, drop the body.
-        Evil hack for minimal HEAD support."""
+        """Announce whether the connection will be kept open"""
+        if self.close_reason is None and not self.close_connection:
+            if self.server.draining:
+                self.close_reason = 'restart'
+            elif 0 < self.max_requests <= self.requests_handled:
+                self.close_reason = 'max-requests'
+        if self.close_reason is not None and not self.close_connection:
+            self.send_header('Connection', 'close')  # Sets `close_connection`
+        elif self.request_version == 'HTTP/1.0' and not self.close_connection:
+            self.send_header('Connection', 'keep-alive')
         super().end_headers()
-        if self.method == 'HEAD':
-            self.wfile.close()
-            self.rfile.close()
 
     def do_HEAD(self):
-        self.method = 'HEAD'
-        self.do_GET()
+        self.do_GET()  # `send_body()` drops the body
+
+
+reload_lock = threading.Lock()
+
+
+def format_setting(value):
+    if isinstance(value, list):
+        return "'%s'" % ' '.join(value)
+    return str(value)
+
+
+def reload_config():
+    """Re-read the configuration and apply what can be changed while
+    running (on SIGHUP or `POST /debug/reload`). Returns success and a
+    description of the outcome, which is also logged."""
+    with reload_lock:
+        try:
+            (changed, ignored) = zeitgitter.config.reload()
+        except ValueError as e:
+            msg = "Reload failed, keeping the configuration: %s" % e
+            logging.error(msg)
+            return (False, msg + "\n")
+        if stamper is not None:
+            stamper.reconfigure()
+        arg = zeitgitter.config.arg
+        lines = ["Reloaded configuration, changed: %s"
+                 % (', '.join(changed) or "nothing")]
+        if ignored:
+            lines.append("Changes needing a restart (ignored): %s"
+                         % ', '.join(ignored))
+            logging.warning(lines[-1])
+        lines.append("Effective: %s" % ', '.join(
+            '%s=%s' % (n.replace('_', '-'), format_setting(getattr(arg, n)))
+            for n in zeitgitter.config.RELOADABLE))
+        logging.info(lines[0])
+        logging.info(lines[-1])
+        return (True, "\n".join(lines) + "\n")
+
+
+def handle_sighup(signum, frame):
+    # Do not do any real work (or logging) in the signal handler
+    threading.Thread(target=reload_config, name='reload',
+                     daemon=True).start()
+
+
+# The servers (one per listener), and whether `serve_forever()` was
+# stopped for a restart
+servers = []
+restart_requested = False
+
+
+def stop_serving():
+    for server in servers:
+        server.shutdown()
+
+
+def handle_sigusr2(signum, frame):
+    global restart_requested
+    restart_requested = True
+    # `shutdown()` waits for `serve_forever()`, which may run in this thread
+    threading.Thread(target=stop_serving, name='restart').start()
+
+
+def restart():
+    """Graceful restart (SIGUSR2), after `serve_forever()` has returned:
+    Drain the connections, let a running commit round finish and keep
+    further entries from being logged, then re-execute with the listening
+    sockets passed as with systemd socket activation (`LISTEN_FDS`). As the
+    sockets stay open, new connections are queued meanwhile instead of
+    being refused; the PID does not change."""
+    timeout = zeitgitter.config.arg.restart_drain_timeout
+    end = time.time() + timeout
+    logging.info("Graceful restart: draining connections")
+    for server in servers:
+        server.begin_drain()
+    busy = sum(server.wait_drained(max(0, end - time.time()))
+               for server in servers)
+    if busy:
+        logging.warning("Restarting with %d connection(s) still busy after"
+                        " %g s" % (busy, timeout))
+    if not zeitgitter.commit.pause(max(0, end - time.time())):
+        logging.warning("Restarting during a commit round")
+    # Never released: no logging or rotation may be in progress on exec
+    zeitgitter.commit.serialize.acquire()
+    # Move the sockets to 3, 4, ... (inheritable), via descriptors above
+    # these, to not overwrite any of them. The temporary copies are
+    # close-on-exec, so they do not leak into the new process.
+    fds = [fcntl.fcntl(server.socket.fileno(), fcntl.F_DUPFD_CLOEXEC,
+                       3 + len(servers)) for server in servers]
+    for (i, fd) in enumerate(fds):
+        os.dup2(fd, 3 + i)
+    for fd in fds:
+        os.close(fd)
+    argv = getattr(sys, 'orig_argv', [sys.executable] + sys.argv)
+    env = dict(os.environ, LISTEN_PID=str(os.getpid()),
+               LISTEN_FDS=str(len(servers)))
+    logging.info("Re-executing %s" % ' '.join(argv))
+    _logging.shutdown()
+    try:
+        os.execve(sys.executable, argv, env)
+    except OSError as e:
+        # E.g., the executable was removed during an upgrade. With the log
+        # lock held and no listeners, exit for the supervisor to restart us.
+        logging.critical("Re-executing %s failed: %s" % (sys.executable, e))
+        _logging.shutdown()
+        os._exit(1)
 
 
 def finish_setup(arg):
     # 1. Determine or create key, if possible
-    #    (Not yet ready to use global stamper)
-    arg.keyid = zeitgitter.stamper.get_keyid(arg.keyid,
-                                             arg.domain, arg.gnupg_home)
+    #    (Not yet ready to use global stamper),
+    #    unless known from the previous start
+    setting = arg.keyid
+    if arg.keyid_secondary is not None:
+        setting = [arg.keyid, arg.keyid_secondary]
+    key = zeitgitter.stamper.cached_key(setting, arg.gnupg_home,
+                                        arg.repository)
+    if key is not None:
+        arg.keyid = key['keyid']
+    else:
+        arg.keyid = zeitgitter.stamper.get_keyid(arg.keyid,
+                                                 arg.domain, arg.gnupg_home)
     # Now, we're ready
-    ensure_stamper()
+    ensure_stamper(key=key)
+    zeitgitter.startup.mark('key')
 
     # 2. Create git repository, if necessary
     #    and set user name/email
@@ -345,27 +1167,54 @@ def finish_setup(arg):
                        cwd=repo, check=True)
         subprocess.run(['git', 'commit', '-m', 'Started timestamping'],
                        cwd=repo, check=True)
+    if key is None:
+        zeitgitter.stamper.cache_key(setting, arg.gnupg_home, repo, stamper)
+    zeitgitter.startup.mark('repository')
 
 
 def run():
+    zeitgitter.startup.mark('imports')
     zeitgitter.config.get_args()
+    zeitgitter.startup.mark('configuration')
     finish_setup(zeitgitter.config.arg)
     zeitgitter.commit.run()
-    httpd = SocketActivationHTTPServer(
-        (zeitgitter.config.arg.listen_address,
-         zeitgitter.config.arg.listen_port),
-        StamperRequestHandler)
-    logging.info("Start serving")
+    servers.extend(create_servers())
+    zeitgitter.startup.mark('listeners')
+    zeitgitter.index.setup()
+    zeitgitter.profiler.setup()
+    zeitgitter.record.setup()
+    signal.signal(signal.SIGHUP, handle_sighup)
+    signal.signal(signal.SIGUSR2, handle_sigusr2)
     ensure_stamper(start_multi_threaded=True)
+    zeitgitter.calibrate.setup(stamper)
+    zeitgitter.startup.mark('calibration')
+    stamper.warm_up()
+    zeitgitter.startup.mark('agent warm-up')
+    zeitgitter.aggregate.setup(stamper)
     # Try to resume a waiting for a PGP Timestamping Server reply, if any
     if zeitgitter.config.arg.stamper_own_address:
         repo = zeitgitter.config.arg.repository
         preserve = Path(repo, 'hashes.stamp')
         if preserve.exists():
             logging.info("possibly resuming cross-timestamping by mail")
-            zeitgitter.mail.async_email_timestamp(preserve)
+            from zeitgitter import mail  # Only loaded if needed
+            mail.async_email_timestamp(preserve)
+    zeitgitter.startup.mark('other')
+    if zeitgitter.config.arg.print_startup_timings:
+        print(zeitgitter.startup.report(), file=sys.stderr, flush=True)
+    logging.info("Start serving")
+    others = [threading.Thread(target=server.serve_forever,
+                               name='serve-%d' % i)
+              for (i, server) in enumerate(servers[1:], 1)]
+    for thread in others:
+        thread.start()
     try:
-        httpd.serve_forever()
+        servers[0].serve_forever()
     except KeyboardInterrupt:
         logging.info("Received Ctrl-C, shutting down...")
-    httpd.server_close()
+    for server in servers[1:]:
+        server.shutdown()
+    if restart_requested:
+        restart()
+    for server in servers:
+        server.server_close()
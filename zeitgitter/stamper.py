@@ -20,6 +20,10 @@
 
 # Timestamp creation
 
+import base64
+import collections
+import errno
+import json
 import logging as _logging
 import os
 import re
@@ -33,6 +37,11 @@ import gnupg
 
 import zeitgitter.commit
 import zeitgitter.config
+import zeitgitter.faults
+import zeitgitter.health
+import zeitgitter.index
+import zeitgitter.metrics
+import zeitgitter.trace
 
 logging = _logging.getLogger('stamper')
 
@@ -45,6 +54,73 @@ def get_nick(domain):
     sys.exit("Please specify a keyid")
 
 
+def gpgsig_header(sig):
+    """The ASCII-armored signature (`bytes`) as a `gpgsig` commit header"""
+    # Replace all inner '\n' with '\n '
+    gpgsig = b'gpgsig ' + sig.replace(b'\n', b'\n ')[:-1]
+    assert gpgsig[-1:] == b'\n'
+    return gpgsig
+
+
+def dearmor(armored):
+    """The OpenPGP packets in an ASCII-armored block (`bytes`)"""
+    lines = [line.strip() for line in armored.split(b'\n')]
+    body = []
+    for line in lines[lines.index(b'') + 1:]:  # Skip any armor headers
+        if line.startswith((b'=', b'-----')):  # Checksum or end
+            break
+        body.append(line)
+    return base64.b64decode(b''.join(body))
+
+
+def crc24(data):
+    """The OpenPGP armor checksum (RFC 4880, section 6.1)"""
+    crc = 0xB704CE
+    for byte in data:
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def armor(packets):
+    """ASCII-armor `packets` as a signature block, like GnuPG does"""
+    b64 = base64.b64encode(packets)
+    return (b'-----BEGIN PGP SIGNATURE-----\n\n'
+            + b''.join(b64[i:i + 64] + b'\n' for i in range(0, len(b64), 64))
+            + b'=' + base64.b64encode(crc24(packets).to_bytes(3, 'big'))
+            + b'\n-----END PGP SIGNATURE-----\n')
+
+
+def merge_signatures(*sigs):
+    """Combine ASCII-armored detached signatures into a single block, which
+    `gpg --verify` checks all of"""
+    return armor(b''.join(dearmor(sig) for sig in sigs))
+
+
+def gnupg_copy(suffix):
+    """The path of a copy of `--gnupg-home` (with `suffix` appended),
+    created if needed; to trick an additional gpg-agent being started for
+    the same keys"""
+    original = zeitgitter.config.arg.gnupg_home
+    home = Path('%s-%s' % (original, suffix))
+    if home.exists():
+        if home.is_symlink():
+            logging.info("Creating GnuPG key copy %s→%s"
+                         ", replacing old symlink" % (original, home))
+            home.unlink()
+            # Ignore sockets (must) and backups (may) on copy
+            shutil.copytree(original, home,
+                            ignore=shutil.ignore_patterns("S.*", "*~"))
+    else:
+        logging.info("Creating GnuPG key copy %s→%s" % (original, home))
+        shutil.copytree(original, home,
+                        ignore=shutil.ignore_patterns("S.*", "*~"))
+    return home
+
+
 def create_key(gpg, keyid):
     name, mail = keyid.split(' <')
     mail = mail[:-1]
@@ -108,50 +184,360 @@ def get_keyid(keyid, domain, gnupg_home):
             sys.exit("Please specify a keyid in the configuration file")
 
 
-class Stamper:
+# Key information from the previous start, in the repository's `.git`
+KEY_CACHE = 'zeitgitter-key.json'
+
+
+def keyring_state(gnupg_home):
+    """Size and modification time of the keyring files, which change
+    whenever keys are added, modified, or removed"""
+    state = []
+    for name in ('pubring.kbx', 'pubring.gpg', 'secring.gpg',
+                 'private-keys-v1.d'):
+        try:
+            st = os.stat(Path(gnupg_home, name))
+        except FileNotFoundError:
+            continue
+        state.append([name, st.st_size, st.st_mtime_ns])
+    return state
+
+
+def cached_key(keyid, gnupg_home, repository):
+    """The key information (`keyid`, `fullid`, and `pubkey`) stored by
+    `cache_key()` for the same `keyid` setting and GnuPG home, if the
+    keyring has not changed since; else `None`. Saves querying GnuPG
+    (several `gpg` processes) on startup."""
+    try:
+        with Path(repository, '.git', KEY_CACHE).open() as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(cache, dict) or cache.get('setting') != keyid
+            or cache.get('gnupg-home') != gnupg_home
+            or cache.get('keyring') != keyring_state(gnupg_home)):
+        return None
+    return cache
+
+
+def cache_key(keyid, gnupg_home, repository, stamper):
+    """Remember the key `stamper` uses for the `keyid` setting"""
+    path = Path(repository, '.git', KEY_CACHE)
+    tmp = path.with_suffix('.tmp')
+    try:
+        with tmp.open('w') as f:
+            json.dump({'setting': keyid,
+                       'gnupg-home': gnupg_home,
+                       'keyring': keyring_state(gnupg_home),
+                       'keyid': stamper.keyid,
+                       'fullid': stamper.fullid,
+                       'pubkey': stamper.pubkey}, f, indent=1)
+        tmp.replace(path)
+    except OSError as e:
+        logging.warning("Cannot cache key information in %s: %s" % (path, e))
+
+
+class ResizableSemaphore:
+    """Like `threading.BoundedSemaphore`, but the number of slots can be
+    changed while in use. When shrinking, current holders are not affected;
+    new acquisitions wait until enough slots have been released."""
+
+    def __init__(self, value):
+        self.cond = threading.Condition(threading.Lock())
+        self.value = value
+        self.used = 0
+
+    def acquire(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.used < self.value,
+                                      timeout):
+                return False
+            self.used += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            if self.used <= 0:
+                raise ValueError("Semaphore released too many times")
+            self.used -= 1
+            self.cond.notify()
+
+    def resize(self, value):
+        with self.cond:
+            self.value = value
+            self.cond.notify_all()
+
+
+class Flight:
+    """A request being handled, for identical ones arriving meanwhile"""
+
     def __init__(self):
-        self.sem = threading.BoundedSemaphore(
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Deduplicator:
+    """Identical requests arriving while the first one is being handled
+    share its result ("singleflight"). Successful results are also
+    returned for identical requests within `window` seconds, from a cache
+    of at most `max_entries` (least recently used first out). A `window`
+    of `None` disables both, `0` the cache."""
+
+    def __init__(self, window, max_entries=10000):
+        self.window = window
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.cache = collections.OrderedDict()  # key → (expiry, result)
+
+    def reconfigure(self, window):
+        with self.lock:
+            self.window = window
+            if not window:
+                self.cache.clear()
+
+    def run(self, key, fn):
+        """`fn()`, unless an identical request (`key`) is in progress or
+        cached"""
+        if self.window is None:
+            return fn()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if cached[0] > time.monotonic():
+                    self.cache.move_to_end(key)
+                    zeitgitter.metrics.dedup.child('hit').inc()
+                    zeitgitter.trace.annotate(dedup='hit')
+                    return cached[1]
+                del self.cache[key]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            with zeitgitter.trace.span('dedup-wait'):
+                flight.done.wait()
+            zeitgitter.metrics.dedup.child('shared').inc()
+            zeitgitter.trace.annotate(dedup='shared')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        zeitgitter.metrics.dedup.child('miss').inc()
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if self.window and isinstance(flight.result, bytes):
+                    self.cache[key] = (time.monotonic() + self.window,
+                                       flight.result)
+                    while len(self.cache) > self.max_entries:
+                        self.cache.popitem(last=False)
+            flight.done.set()
+
+
+class SecondarySigner:
+    """Signs with `--keyid-secondary` on its own pool of GnuPG agents (the
+    copies `<gnupg-home>-secondary-<n>`), sized independently, as the other
+    algorithm may be much slower"""
+
+    def __init__(self, keyid, agents):
+        self.keyid = keyid
+        self.agents = agents
+        self.lock = threading.Lock()
+        self.gpgs = []
+
+    def gpg(self):
+        """The next GnuPG object, in round robin order"""
+        with self.lock:
+            if len(self.gpgs) < self.agents:
+                home = gnupg_copy('secondary-%d' % len(self.gpgs))
+                gpg = gnupg.GPG(gnupghome=home.as_posix())
+                gpg.number = len(self.gpgs)
+                gpg.agent = 'secondary%d' % gpg.number
+            else:
+                gpg = self.gpgs.pop(0)
+            self.gpgs.append(gpg)
+            return gpg
+
+    def resize(self, agents):
+        """Use the first `agents` copies from now on; as for the primary
+        pool, the others are kept running"""
+        with self.lock:
+            self.agents = agents
+            for gpg in self.gpgs:
+                if gpg.number >= agents:
+                    zeitgitter.health.forget('agent:%s' % gpg.agent)
+            self.gpgs = [gpg for gpg in self.gpgs if gpg.number < agents]
+
+    def warm_up_agent(self, gpg):
+        if gpg.sign('warm-up', keyid=self.keyid, binary=False, detach=True):
+            zeitgitter.health.success('agent:%s' % gpg.agent)
+        else:
+            logging.error("GnuPG agent %s failed to sign" % gpg.agent)
+            zeitgitter.health.failure('agent:%s' % gpg.agent)
+
+    def sign(self, now, data):
+        gpg = self.gpg()
+        with zeitgitter.metrics.sign_duration.time(gpg.agent):
+            if zeitgitter.faults.inject('sign'):
+                ret = None
+            else:
+                ret = gpg.sign(data, keyid=self.keyid, binary=False,
+                               clearsign=False, detach=True,
+                               extra_args=('--faked-system-time',
+                                           str(now) + '!'))
+        if ret:
+            zeitgitter.health.success('agent:%s' % gpg.agent)
+        else:
+            zeitgitter.health.failure('agent:%s' % gpg.agent)
+        return ret
+
+    def start(self, now, data):
+        """Sign `data` in the background; returns the `Flight`"""
+        flight = Flight()
+
+        def run():
+            try:
+                flight.result = self.sign(now, data)
+            except Exception as e:
+                flight.error = e
+            finally:
+                flight.done.set()
+        threading.Thread(target=run, name='sign-secondary',
+                         daemon=True).start()
+        return flight
+
+
+class Stamper:
+    def __init__(self, key=None):
+        """`key`: As returned by `cached_key()`, to avoid asking GnuPG"""
+        self.sem = ResizableSemaphore(
             zeitgitter.config.arg.max_parallel_signatures)
         self.gpg_serialize = threading.Lock()
         self.timeout = zeitgitter.config.arg.max_parallel_timeout
         self.url = zeitgitter.config.arg.own_url
         self.keyid = zeitgitter.config.arg.keyid
+        if zeitgitter.config.arg.keyid_secondary is None:
+            self.secondary = None
+        else:
+            self.secondary = SecondarySigner(
+                zeitgitter.config.arg.keyid_secondary,
+                zeitgitter.config.arg.number_of_gpg_agents_secondary)
         self.gpgs = [gnupg.GPG(gnupghome=zeitgitter.config.arg.gnupg_home)]
+        self.gpgs[0].agent = 0  # For metrics
         self.max_threads = 1  # Start single-threaded
-        self.keyinfo = self.gpg().list_keys(True, keys=self.keyid)
-        if len(self.keyinfo) == 0:
-            raise ValueError("No keys found")
-        self.fullid = self.keyinfo[0]['uids'][0]
-        self.pubkey = self.gpg().export_keys(self.keyid)
+        self.multi_threaded = False
+        if key is not None:
+            self.fullid = key['fullid']
+            self.pubkey = key['pubkey']
+        else:
+            keyinfo = self.gpg().list_keys(True, keys=self.keyid)
+            if len(keyinfo) == 0:
+                raise ValueError("No keys found")
+            self.fullid = keyinfo[0]['uids'][0]
+            if self.secondary is None:
+                self.pubkey = self.gpg().export_keys(self.keyid)
+            else:
+                if len(self.gpg().list_keys(True,
+                                            keys=self.secondary.keyid)) == 0:
+                    raise ValueError("No secondary keys found")
+                # Both, so that clients can verify both signatures
+                self.pubkey = self.gpg().export_keys(
+                    [self.keyid, self.secondary.keyid])
         self.extra_delay = None
+        self.dedup = Deduplicator(zeitgitter.config.arg.dedup_window)
+        self.prepare_templates()
+
+    def prepare_templates(self):
+        """Encode the parts of the timestamps which never change once, as
+        `bytes` templates for `%`"""
+        fullid = bytes(self.fullid, 'UTF-8').replace(b'%', b'%%')
+        url = bytes(self.url, 'UTF-8').replace(b'%', b'%%')
+        self.tag_template = (b'object %s\ntype commit\ntag %s\ntagger '
+                             + fullid + b' %d +0000\n\n:watch: '
+                             + url + b' tag timestamp\n')
+        # `%s` after the tree: the optional `parent` line
+        self.branch_template = (b'tree %s\n%sparent %s\nauthor ' + fullid
+                                + b' %d +0000\ncommitter ' + fullid
+                                + b' %d +0000\n')
+        self.branch_trailer = (b'\n:watch: ' + url
+                               + b' branch timestamp %s\n')
+        self.last_isonow = (None, None)
+
+    def isonow(self, now):
+        """`now` as ISO timestamp (`bytes`), cached for the current second"""
+        (t, iso) = self.last_isonow
+        if t != now:
+            iso = bytes(time.strftime("%Y-%m-%d %H:%M:%S UTC",
+                                      time.gmtime(now)), 'ASCII')
+            self.last_isonow = (now, iso)
+        return iso
 
     def start_multi_threaded(self):
+        self.multi_threaded = True
         self.max_threads = zeitgitter.config.arg.number_of_gpg_agents
 
+    def reconfigure(self):
+        """Apply changed `--max-parallel-signatures`, `--max-parallel-timeout`,
+        `--number-of-gpg-agents`, and `--number-of-gpg-agents-secondary`.
+        Signatures in progress are not affected. Agents removed from the pool are kept running, so they
+        are warm when the pool grows again."""
+        arg = zeitgitter.config.arg
+        self.sem.resize(arg.max_parallel_signatures)
+        self.timeout = arg.max_parallel_timeout
+        self.dedup.reconfigure(arg.dedup_window)
+        if self.secondary is not None:
+            self.secondary.resize(arg.number_of_gpg_agents_secondary)
+        if self.multi_threaded:
+            with self.gpg_serialize:
+                self.max_threads = arg.number_of_gpg_agents
+                # Agent n uses the n-th copy: Keep the first ones, so that
+                # growing the pool again reuses the copies in order
+                for gpg in self.gpgs:
+                    if gpg.agent >= self.max_threads:
+                        zeitgitter.health.forget('agent:%d' % gpg.agent)
+                self.gpgs = [gpg for gpg in self.gpgs
+                             if gpg.agent < self.max_threads]
+
+    def warm_up(self):
+        """Start all GnuPG agents and have each of them sign once, so that
+        the first requests do not have to wait for this. The agents start
+        in parallel."""
+        start = time.perf_counter()
+        agents = [(self.warm_up_agent, self.gpg())
+                  for _ in range(self.max_threads)]
+        if self.secondary is not None:
+            agents += [(self.secondary.warm_up_agent, self.secondary.gpg())
+                       for _ in range(self.secondary.agents)]
+        threads = [threading.Thread(target=fn, args=(gpg,))
+                   for (fn, gpg) in agents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logging.info("Warmed up %d GnuPG agent(s) in %.3f s"
+                     % (len(agents), time.perf_counter() - start))
+
+    def warm_up_agent(self, gpg):
+        if gpg.sign('warm-up', keyid=self.keyid, binary=False, detach=True):
+            zeitgitter.health.success('agent:%d' % gpg.agent)
+        else:
+            logging.error("GnuPG agent %d failed to sign" % gpg.agent)
+            zeitgitter.health.failure('agent:%d' % gpg.agent)
+
     def gpg(self):
         """Return the next GnuPG object, in round robin order.
         Create one, if less than `number-of-gpg-agents` are available."""
         with self.gpg_serialize:
             if len(self.gpgs) < self.max_threads:
-                home = Path('%s-%d' %
-                            (zeitgitter.config.arg.gnupg_home, len(self.gpgs)))
-                # Create copy if needed; to trick an additional gpg-agent
-                # being started for the same directory
-                if home.exists():
-                    if home.is_symlink():
-                        logging.info("Creating GnuPG key copy %s→%s"
-                                     ", replacing old symlink"
-                                     % (zeitgitter.config.arg.gnupg_home, home))
-                        home.unlink()
-                        # Ignore sockets (must) and backups (may) on copy
-                        shutil.copytree(zeitgitter.config.arg.gnupg_home,
-                                        home, ignore=shutil.ignore_patterns("S.*", "*~"))
-                else:
-                    logging.info("Creating GnuPG key copy %s→%s"
-                                 % (zeitgitter.config.arg.gnupg_home, home))
-                    shutil.copytree(zeitgitter.config.arg.gnupg_home,
-                                    home, ignore=shutil.ignore_patterns("S.*", "*~"))
+                home = gnupg_copy(len(self.gpgs))
                 nextgpg = gnupg.GPG(gnupghome=home.as_posix())
+                nextgpg.agent = len(self.gpgs)
                 self.gpgs.append(nextgpg)
                 logging.debug("Returning new %r (gnupghome=%s)" %
                               (nextgpg, nextgpg.gnupghome))
@@ -195,83 +581,124 @@ class Stamper:
         or wait indefinitely, if `--max-parallel-timeout` has not been
         given (i.e., is None). It logs any commit ID to stable storage
         before attempting to even create a signature. It also makes sure
-        that the GnuPG signature time matches the GIT timestamps."""
-        if self.sem.acquire(timeout=self.timeout):
+        that the GnuPG signature time matches the GIT timestamps. With
+        `--keyid-secondary`, the second signature is created in parallel
+        and both are returned in a single block (`.data`)."""
+        start = time.perf_counter()
+        with zeitgitter.trace.span('sem-wait'):
+            acquired = self.sem.acquire(timeout=self.timeout)
+        if acquired:
+            zeitgitter.metrics.sign_wait.observe(time.perf_counter() - start)
             ret = None
             try:
                 if self.extra_delay:
                     time.sleep(self.extra_delay)
-                ret = self.gpg().sign(data, keyid=self.keyid, binary=False,
-                                      clearsign=False, detach=True,
-                                      extra_args=('--faked-system-time',
-                                                  str(now) + '!'))
+                secondary = None
+                if self.secondary is not None:
+                    secondary = self.secondary.start(now, data)
+                with zeitgitter.trace.span('agent-select'):
+                    gpg = self.gpg()
+                zeitgitter.trace.annotate(agent=gpg.agent)
+                with zeitgitter.metrics.sign_duration.time(gpg.agent), \
+                        zeitgitter.trace.span('sign'):
+                    # Evaluate both, for their delays
+                    failed = any([zeitgitter.faults.inject('sign'),
+                                  zeitgitter.faults.inject(
+                                      'agent%d' % gpg.agent)])
+                    if not failed:
+                        ret = gpg.sign(data, keyid=self.keyid, binary=False,
+                                       clearsign=False, detach=True,
+                                       extra_args=('--faked-system-time',
+                                                   str(now) + '!'))
+                if ret:
+                    zeitgitter.health.success('agent:%d' % gpg.agent)
+                else:
+                    zeitgitter.health.failure('agent:%d' % gpg.agent)
+                if secondary is not None:
+                    with zeitgitter.trace.span('sign-secondary-wait'):
+                        secondary.done.wait()
+                    if secondary.error is not None:
+                        raise secondary.error
+                    if ret and secondary.result:
+                        ret.data = merge_signatures(ret.data,
+                                                    secondary.result.data)
+                    else:
+                        ret = None
             finally:
                 self.sem.release()
             return ret
         else:  # Timeout
+            zeitgitter.metrics.sign_timeouts.inc()
             return None
 
-    def log_commit(self, commit):
-        with Path(zeitgitter.config.arg.repository,
-                  'hashes.work').open(mode='ab', buffering=0) as f:
-            f.write(bytes(commit + '\n', 'ASCII'))
-            os.fsync(f.fileno())
+    def log_commit(self, commit, now):
+        self.log_commits([commit], now)
+
+    def log_commits(self, commits, now):
+        """Log all `commits` with a single write and `fsync()`"""
+        data = bytes(''.join(c + '\n' for c in commits), 'ASCII')
+        try:
+            with zeitgitter.metrics.log_fsync.time(), \
+                    zeitgitter.trace.span('log-fsync'), \
+                    Path(zeitgitter.config.arg.repository,
+                         'hashes.work').open(mode='ab', buffering=0) as f:
+                f.write(data)
+                if zeitgitter.faults.inject('fsync'):
+                    raise OSError(errno.EIO, "Injected fsync failure")
+                os.fsync(f.fileno())
+        except OSError:
+            zeitgitter.health.failure('log')
+            raise
+        zeitgitter.health.success('log')
+        zeitgitter.commit.note_logged(len(commits), len(data))
+        for c in commits:
+            zeitgitter.index.note(c, now)
 
     def stamp_tag(self, commit, tagname):
         if self.valid_commit(commit) and self.valid_tag(tagname):
-            with zeitgitter.commit.serialize:
-                now = int(self.sig_time())
-                self.log_commit(commit)
-            isonow = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(now))
-            tagobj = """object %s
-type commit
-tag %s
-tagger %s %d +0000
-
-:watch: %s tag timestamp
-""" % (commit, tagname, self.fullid, now,
-                self.url)
-
-            sig = self.limited_sign(now, commit, tagobj)
-            if sig == None:
-                return None
-            else:
-                return tagobj + str(sig)
+            return self.dedup.run(('tag', commit, tagname),
+                                  lambda: self.issue_tag(commit, tagname))
         else:
             return 406
 
+    def issue_tag(self, commit, tagname):
+        with zeitgitter.trace.acquire(zeitgitter.commit.serialize,
+                                      'serialize-wait'):
+            now = int(self.sig_time())
+            self.log_commit(commit, now)
+        tagobj = self.tag_template % (bytes(commit, 'ASCII'),
+                                      bytes(tagname, 'UTF-8'), now)
+
+        sig = self.limited_sign(now, commit, tagobj)
+        if sig == None:
+            return None
+        else:
+            return tagobj + sig.data
+
     def stamp_branch(self, commit, parent, tree):
         if (self.valid_commit(commit) and self.valid_commit(tree)
                 and (parent == None or self.valid_commit(parent))):
-            with zeitgitter.commit.serialize:
-                now = int(self.sig_time())
-                self.log_commit(commit)
-            isonow = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(now))
-            if parent == None:
-                commitobj1 = """tree %s
-parent %s
-author %s %d +0000
-committer %s %d +0000
-""" % (tree, commit, self.fullid, now, self.fullid, now)
-            else:
-                commitobj1 = """tree %s
-parent %s
-parent %s
-author %s %d +0000
-committer %s %d +0000
-""" % (tree, parent, commit, self.fullid, now, self.fullid, now)
-
-            commitobj2 = """
-:watch: %s branch timestamp %s
-""" % (self.url, isonow)
-
-            sig = self.limited_sign(now, commit, commitobj1 + commitobj2)
-            if sig == None:
-                return None
-            else:
-                # Replace all inner '\n' with '\n '
-                gpgsig = 'gpgsig ' + str(sig).replace('\n', '\n ')[:-1]
-                assert gpgsig[-1] == '\n'
-                return commitobj1 + gpgsig + commitobj2
+            return self.dedup.run(
+                ('branch', commit, parent, tree),
+                lambda: self.issue_branch(commit, parent, tree))
         else:
             return 406
+
+    def issue_branch(self, commit, parent, tree):
+        with zeitgitter.trace.acquire(zeitgitter.commit.serialize,
+                                      'serialize-wait'):
+            now = int(self.sig_time())
+            self.log_commit(commit, now)
+        if parent == None:
+            parent = b''
+        else:
+            parent = b'parent %s\n' % bytes(parent, 'ASCII')
+        commitobj1 = self.branch_template % (bytes(tree, 'ASCII'), parent,
+                                             bytes(commit, 'ASCII'), now, now)
+        commitobj2 = self.branch_trailer % self.isonow(now)
+
+        sig = self.limited_sign(now, commit, commitobj1 + commitobj2)
+        if sig == None:
+            return None
+        else:
+            return commitobj1 + gpgsig_header(sig.data) + commitobj2
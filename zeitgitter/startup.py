@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Startup timing (`--print-startup-timings`)
+#
+# The phases of starting up (until the first request can be served), each
+# ended by `mark()`. The first one starts when the `zeitgitter` package is
+# loaded, i.e., after the Python interpreter has started.
+
+import time
+
+import zeitgitter
+
+# (name, seconds) of the phases so far
+phases = []
+last = zeitgitter.load_start
+
+
+def mark(name):
+    """End the phase `name`, which started at the previous `mark()`"""
+    global last
+    now = time.perf_counter()
+    phases.append((name, now - last))
+    last = now
+
+
+def report():
+    width = max(len(name) for (name, _) in phases + [('total', 0)])
+    lines = ["Startup timings:"]
+    for (name, seconds) in phases + [('total', sum(s for (_, s) in phases))]:
+        lines.append("  %-*s %7.3f s" % (width, name, seconds))
+    return "\n".join(lines)
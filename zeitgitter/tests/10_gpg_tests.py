@@ -133,7 +133,7 @@ eUVPRmPROLObWS2mzfEAn1dMGgRB2pPRQeaayWyodleWuWZy
 def test_sign_tag():
     tagstamp = stamper.stamp_tag('1' * 40, 'sample-timestamping-tag')
     print(tagstamp)
-    assertEqual(tagstamp, """object 1111111111111111111111111111111111111111
+    assertEqual(tagstamp, b"""object 1111111111111111111111111111111111111111
 type commit
 tag sample-timestamping-tag
 tagger Hagrid Snakeoil Timestomping Service <timestomping@hagrid.snakeoil> 1551155115 +0000
@@ -151,7 +151,7 @@ xz10AJ4iSQRbbKVPFSk2hhORPBe8mEkzhQCcCmz/GQwmv4ZwTWE6G0ltXJ5oZ+Y=
 def test_sign_branch1():
     branchstamp = stamper.stamp_branch('1' * 40, '2' * 40, '3' * 40)
     print(branchstamp)
-    assertEqual(branchstamp, """tree 3333333333333333333333333333333333333333
+    assertEqual(branchstamp, b"""tree 3333333333333333333333333333333333333333
 parent 2222222222222222222222222222222222222222
 parent 1111111111111111111111111111111111111111
 author Hagrid Snakeoil Timestomping Service <timestomping@hagrid.snakeoil> 1551155115 +0000
@@ -170,7 +170,7 @@ gpgsig -----BEGIN PGP SIGNATURE-----
 def test_sign_branch2():
     branchstamp = stamper.stamp_branch('1' * 40, None, '3' * 40)
     print(branchstamp)
-    assertEqual(branchstamp, """tree 3333333333333333333333333333333333333333
+    assertEqual(branchstamp, b"""tree 3333333333333333333333333333333333333333
 parent 1111111111111111111111111111111111111111
 author Hagrid Snakeoil Timestomping Service <timestomping@hagrid.snakeoil> 1551155115 +0000
 committer Hagrid Snakeoil Timestomping Service <timestomping@hagrid.snakeoil> 1551155115 +0000
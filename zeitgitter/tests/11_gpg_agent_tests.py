@@ -67,7 +67,7 @@ def teardown_module():
 
 def test_sign_tag():
     tagstamp = stamper.stamp_tag('1' * 40, 'sample-timestamping-tag')
-    assertEqual(tagstamp, """object 1111111111111111111111111111111111111111
+    assertEqual(tagstamp, b"""object 1111111111111111111111111111111111111111
 type commit
 tag sample-timestamping-tag
 tagger Hagrid Snakeoil Timestomping Service <timestomping@hagrid.snakeoil> 1551155115 +0000
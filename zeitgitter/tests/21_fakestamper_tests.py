@@ -0,0 +1,80 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test mail sending/receiving against the local PGP Timestamper stand-in
+
+import os
+import tempfile
+from pathlib import Path
+
+import zeitgitter.config
+import zeitgitter.fakestamper
+import zeitgitter.mail
+
+
+def setup_module():
+    global fake
+    global tmpdir
+    fake = zeitgitter.fakestamper.FakeStamper(reply_delay=0.2)
+    tmpdir = tempfile.TemporaryDirectory()
+    zeitgitter.fakestamper.init_repo(tmpdir.name)
+    zeitgitter.config.get_args(args=[
+        '--country', '', '--owner', '', '--contact', '',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--repository', tmpdir.name] + fake.zeitgitter_args())
+
+
+def teardown_module():
+    fake.stop()
+    tmpdir.cleanup()
+
+
+entries = ''.join('%040x\n' % i for i in range(1, 21))
+
+
+def test_roundtrip():
+    t = zeitgitter.fakestamper.roundtrip(fake, tmpdir.name, entries,
+                                         timeout=30)
+    assert t is not None
+    with Path(tmpdir.name, 'hashes.asc').open() as f:
+        asc = f.read()
+    assert asc.startswith('-----BEGIN PGP SIGNED MESSAGE-----\n')
+    assert entries in asc
+    assert asc.endswith('-----END PGP SIGNATURE-----\n')
+
+
+def test_roundtrip_unrelated():
+    fake.add_unrelated(500)
+    t = zeitgitter.fakestamper.roundtrip(fake, tmpdir.name, entries[41:],
+                                         timeout=30)
+    assert t is not None
+
+
+def test_wrong_keyid():
+    bodylines = zeitgitter.mail.extract_pgp_body(
+        bytes(fake.signer.clearsign(entries), 'ASCII'))
+    stat = os.stat(tmpdir.name)
+    assert zeitgitter.mail.body_signature_correct(bodylines, stat)
+    keyid = zeitgitter.config.arg.stamper_keyid
+    try:
+        zeitgitter.config.arg.stamper_keyid = '70B61F81'
+        assert not zeitgitter.mail.body_signature_correct(bodylines, stat)
+    finally:
+        zeitgitter.config.arg.stamper_keyid = keyid
@@ -0,0 +1,124 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test the index of timestamped commit IDs
+
+import sqlite3
+import subprocess
+import tempfile
+from pathlib import Path
+
+import zeitgitter.index
+import zeitgitter.merkle
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def git(*args):
+    return subprocess.run(['git', '-c', 'user.name=Hagrid', '-c',
+                           'user.email=hagrid@hagrid.snakeoil',
+                           '-c', 'commit.gpgsign=false'] + list(args),
+                          cwd=tmpdir.name, check=True, text=True,
+                          stdout=subprocess.PIPE).stdout.strip()
+
+
+def interval(entries, msg="Newly timestamped commits up to now"):
+    with Path(tmpdir.name, 'hashes.log').open('w') as f:
+        f.write(''.join(e + '\n' for e in entries))
+    git('add', 'hashes.log')
+    git('commit', '-q', '--allow-empty', '-m', msg)
+    return git('rev-parse', 'HEAD')
+
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.TemporaryDirectory()
+    git('init', '-q')
+    git('commit', '-q', '--allow-empty', '-m', 'Started timestamping')
+
+
+def teardown_module():
+    tmpdir.cleanup()
+
+
+def test_index():
+    a, b, c = '1' * 40, '2' * 40, '3' * 40
+    first = interval([a, b])
+    second = interval([])
+    times = {b: [1551155115], c: [1551155116, 1551155117]}
+    path = Path(tmpdir.name, '.git', 'index.sqlite')
+    index = zeitgitter.index.Index(path.as_posix())
+    assertEqual(index.update(tmpdir.name, times), 2)
+    assertEqual(index.update(tmpdir.name, times), 0)
+    found = index.lookup([a, b, c])
+    assertEqual(len(found[a]), 1)
+    assertEqual(found[a][0]['interval'], first)
+    assertEqual(found[a][0]['time'], None)
+    assertEqual(found[b][0]['time'], 1551155115)
+    assertEqual(found[c], [])
+
+    # Incremental update, same commit stamped twice in one interval
+    third = interval([c, a, c])
+    assertEqual(index.update(tmpdir.name, times), 1)
+    assertEqual(times, {})
+    found = index.lookup([a, c])
+    assertEqual([f['interval'] for f in found[a]], [first, third])
+    assertEqual([f['time'] for f in found[c]], [1551155116, 1551155117])
+
+    # Inclusion proofs
+    proofs = index.proofs(c)
+    assertEqual([(p['interval'], p['index'], p['leaves']) for p in proofs],
+                [(third, 0, 3), (third, 2, 3)])
+    root = zeitgitter.merkle.root([c.encode(), a.encode(), c.encode()])
+    for p in proofs:
+        assertEqual(p['root'], 'sha256:' + root.hex())
+        assert zeitgitter.merkle.verify(c.encode(), p['path'], root)
+    assertEqual(zeitgitter.merkle.committed_root(tmpdir.name, third), root)
+    index.close()
+
+    # Rebuild from history
+    path.unlink()
+    index = zeitgitter.index.Index(path.as_posix())
+    assertEqual(index.update(tmpdir.name), 3)
+    found = index.lookup([c])
+    assertEqual([(f['interval'], f['time']) for f in found[c]],
+                [(third, None), (third, None)])
+    assertEqual(found[c][0]['interval-time'], int(git('log', '-1', '--format=%ct')))
+    index.close()
+
+    # Indexes of an older schema are rebuilt
+    db = sqlite3.connect(path.as_posix())
+    with db:
+        db.execute("UPDATE meta SET value = '2' WHERE key = 'schema'")
+    db.close()
+    index = zeitgitter.index.Index(path.as_posix())
+    assertEqual(index.update(tmpdir.name), 3)
+    assertEqual([(p['index'], p['leaves']) for p in index.proofs(c)],
+                [(0, 3), (2, 3)])
+    index.close()
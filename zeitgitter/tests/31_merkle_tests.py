@@ -0,0 +1,59 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test Merkle trees and inclusion proofs
+
+import math
+
+import zeitgitter.merkle as merkle
+
+
+def node_lookup(tree):
+    def node(level, position):
+        if level < len(tree) and position < len(tree[level]):
+            return tree[level][position]
+        return None
+    return node
+
+
+def test_proofs():
+    for n in range(1, 70):
+        leaves = [b'%040x' % i for i in range(n)]
+        tree = merkle.levels(leaves)
+        root = merkle.root(leaves)
+        assert tree[-1] == [root]
+        for i in range(n):
+            proof = merkle.path(node_lookup(tree), i)
+            assert len(proof) <= math.ceil(math.log2(n))
+            assert merkle.verify(leaves[i], proof, root)
+            assert not merkle.verify(b'%040x' % (n + 1), proof, root)
+            if len(proof) > 0:
+                bad = proof[:-1] + [proof[-1][:2] + '0' * 64]
+                assert not merkle.verify(leaves[i], bad, root)
+
+
+def test_root():
+    assert merkle.entries(b'a\nb\n\n') == [b'a', b'b']
+    # Fixed values guard against accidental changes of the tree format
+    assert (merkle.root([b'a']).hex() ==
+            '022a6979e6dab7aa5ae4c3e5e45f7e977112a7e63593820dbec1ec738a24f93c')
+    assert merkle.root([b'a', b'b', b'c']) == merkle.node_hash(
+        merkle.node_hash(merkle.leaf_hash(b'a'), merkle.leaf_hash(b'b')),
+        merkle.leaf_hash(b'c'))
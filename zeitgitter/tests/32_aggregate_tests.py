@@ -0,0 +1,148 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test aggregated signing
+
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+import zeitgitter.aggregate
+import zeitgitter.config
+import zeitgitter.faults
+import zeitgitter.merkle
+import zeitgitter.stamper
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+gnupg_home = str(pathlib.Path(os.path.dirname(os.path.realpath(__file__)),
+                              'gnupg'))
+
+
+def setup_module():
+    global aggregator
+    global tmpdir
+    tmpdir = tempfile.TemporaryDirectory()
+    zeitgitter.config.get_args(args=[
+        '--gnupg-home', gnupg_home,
+        '--country', '', '--owner', '', '--contact', '',
+        '--keyid', '353DFEC512FA47C7',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--aggregation-window', '0.5s',
+        '--repository', tmpdir.name])
+    os.environ['ZEITGITTER_FAKE_TIME'] = '1551155115'
+    aggregator = zeitgitter.aggregate.Aggregator(
+        zeitgitter.stamper.Stamper(),
+        zeitgitter.config.arg.aggregation_window,
+        zeitgitter.config.arg.aggregation_max_batch)
+
+
+def teardown_module():
+    del os.environ['ZEITGITTER_FAKE_TIME']
+    tmpdir.cleanup()
+
+
+def test_batch():
+    commits = ['%040x' % i for i in range(1, 8)]
+    receipts = {}
+
+    def submit(c):
+        receipts[c] = aggregator.submit(c)
+
+    threads = [threading.Thread(target=submit, args=(c,)) for c in commits]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    statements = set(r['statement'] for r in receipts.values())
+    assertEqual(len(statements), 1)
+    statement = statements.pop()
+    assert 'leaves 7\n' in statement
+    assert 'time 1551155115\n' in statement
+    for c in commits:
+        assertEqual(receipts[c]['commit'], c)
+        assertEqual(zeitgitter.merkle.verify_receipt(receipts[c]), None)
+    assertEqual(zeitgitter.merkle.verify_receipt(
+        receipts[commits[0]], gpg='gpg --homedir ' + gnupg_home), None)
+    # All commits are logged once
+    with pathlib.Path(tmpdir.name, 'hashes.work').open() as f:
+        assertEqual(sorted(f.read().split()), commits)
+
+    # Mismatching commit or statement
+    r = dict(receipts[commits[1]], commit=commits[0])
+    assert zeitgitter.merkle.verify_receipt(r) is not None
+    r = dict(receipts[commits[1]],
+             statement=statement.replace('time 1551155115', 'time 1'))
+    assertEqual(zeitgitter.merkle.verify_receipt(r), None)
+    assert zeitgitter.merkle.verify_receipt(
+        r, gpg='gpg --homedir ' + gnupg_home) is not None
+
+
+def test_single():
+    receipt = aggregator.submit('1' * 40)
+    assertEqual(receipt['path'], [])
+    assertEqual(receipt['index'], 0)
+    assertEqual(zeitgitter.merkle.verify_receipt(receipt), None)
+
+
+def test_log_failure():
+    zeitgitter.config.arg.fault_injection = zeitgitter.faults.parse(
+        'fsync=fail')
+    try:
+        aggregator.submit('2' * 40)
+        raise AssertionError("Logging failure ignored")
+    except OSError:
+        pass
+    finally:
+        zeitgitter.config.arg.fault_injection = {}
+    assertEqual(aggregator.submit('3' * 40)['index'], 0)
+
+
+def test_max_batch():
+    # A full batch is signed without waiting for the window to end
+    full = zeitgitter.aggregate.Aggregator(aggregator.stamper, 60, 3)
+    commits = ['%040x' % i for i in range(11, 14)]
+    receipts = {}
+
+    def submit(c):
+        receipts[c] = full.submit(c)
+
+    start = time.time()
+    threads = [threading.Thread(target=submit, args=(c,)) for c in commits]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert time.time() - start < 10
+    assertEqual(sorted(receipts), commits)
+    assert 'leaves 3\n' in receipts[commits[0]]['statement']
+    assertEqual(full.batch, None)
@@ -0,0 +1,164 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test log rotation and commit scheduling
+
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import zeitgitter.commit
+import zeitgitter.config
+import zeitgitter.stamper
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def git(*args):
+    return subprocess.run(['git'] + list(args), cwd=repo, check=True,
+                          text=True, stdout=subprocess.PIPE).stdout.strip()
+
+
+def setup_module():
+    global stamper
+    global tmpdir
+    global repo
+    tmpdir = tempfile.TemporaryDirectory()
+    gnupg = pathlib.Path(tmpdir.name, 'gnupg')
+    shutil.copytree(pathlib.Path(os.path.dirname(os.path.realpath(__file__)),
+                                 'gnupg'), gnupg,
+                    ignore=shutil.ignore_patterns("S.*", "*~"))
+    repo = pathlib.Path(tmpdir.name, 'repo')
+    repo.mkdir()
+    zeitgitter.config.get_args(args=[
+        '--gnupg-home', gnupg.as_posix(),
+        '--country', '', '--owner', '', '--contact', '',
+        '--keyid', '353DFEC512FA47C7',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--rotate-max-entries', '3',
+        '--rotate-max-size', '1000',
+        '--rotate-max-age', '2s',
+        '--skip-empty-intervals',
+        '--lookup-index', 'none',
+        '--repository', repo.as_posix()])
+    git('init', '-q')
+    git('config', 'user.name', 'Hagrid')
+    git('config', 'user.email', 'hagrid@hagrid.snakeoil')
+    git('commit', '-q', '--allow-empty', '-m', 'Started timestamping')
+    stamper = zeitgitter.stamper.Stamper()
+    # Forget about entries logged by other tests
+    zeitgitter.commit.reset_logged()
+
+
+def teardown_module():
+    tmpdir.cleanup()
+
+
+def log_commits(first, n):
+    with zeitgitter.commit.serialize:
+        stamper.log_commits(['%040x' % i for i in range(first, first + n)],
+                            int(time.time()))
+
+
+def test_entries():
+    log_commits(1, 2)
+    assert not zeitgitter.commit.rotation_due()
+    log_commits(3, 1)
+    assert zeitgitter.commit.rotation_due()
+    assert zeitgitter.commit.rotate_wakeup.is_set()
+    zeitgitter.commit.rotate_early()
+    assertEqual(zeitgitter.commit.work_entries, 0)
+    assertEqual(git('show', 'HEAD:hashes.log').split(),
+                ['%040x' % i for i in range(1, 4)])
+    assert not zeitgitter.commit.rotation_due()
+    # Not due anymore: no additional commit
+    head = git('rev-parse', 'HEAD')
+    zeitgitter.commit.rotate_early()
+    assertEqual(git('rev-parse', 'HEAD'), head)
+
+
+def test_size():
+    zeitgitter.config.arg.rotate_max_size = 41
+    log_commits(4, 1)
+    assert zeitgitter.commit.rotation_due()
+    zeitgitter.commit.rotate_early()
+    assertEqual(git('show', 'HEAD:hashes.log').split(), ['%040x' % 4])
+    zeitgitter.config.arg.rotate_max_size = 1000
+
+
+def test_age():
+    log_commits(5, 1)
+    deadline = zeitgitter.commit.rotation_deadline()
+    assert deadline is not None and deadline <= time.time() + 2
+    assert not zeitgitter.commit.rotation_due()
+    time.sleep(deadline - time.time())
+    assert zeitgitter.commit.rotation_due()
+    zeitgitter.commit.rotate_early()
+    assertEqual(zeitgitter.commit.rotation_deadline(), None)
+
+
+def test_skip_empty():
+    head = git('rev-parse', 'HEAD')
+    zeitgitter.commit.do_commit()  # Earlier rotations, but no push etc.
+    zeitgitter.commit.do_commit()
+    assertEqual(git('rev-parse', 'HEAD'), head)
+    assertEqual(zeitgitter.commit.rotated_since_round, False)
+
+
+def test_schedule():
+    release = threading.Event()
+    started = []
+    do_commit = zeitgitter.commit.do_commit
+
+    def slow_commit(rnd):
+        started.append(rnd)
+        with rnd.phase('push'):
+            release.wait()
+
+    try:
+        zeitgitter.commit.do_commit = slow_commit
+        zeitgitter.commit.schedule(100)
+        zeitgitter.commit.schedule(200)  # Overruns
+        zeitgitter.commit.schedule(300)  # Coalesced with the previous one
+        release.set()
+        for i in range(50):
+            if zeitgitter.commit.current_round is None:
+                break
+            time.sleep(0.1)
+    finally:
+        zeitgitter.commit.do_commit = do_commit
+    assertEqual([(r.slot, r.coalesced) for r in started], [(100, 0), (300, 2)])
+    rounds = zeitgitter.commit.recent_rounds()[-2:]
+    assertEqual([(r['slot'], r['overrun']) for r in rounds],
+                [(100, True), (300, False)])
+    assert 'push' in rounds[0]['phases']
@@ -0,0 +1,85 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test the metrics registry
+
+import threading
+
+import zeitgitter.metrics
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def test_counter():
+    c = zeitgitter.metrics.Counter('test_counter', "A \"test\"", ('a',))
+    c.child('x').inc()
+    c.child('y\n').inc(2)
+
+    def count():
+        for i in range(1000):
+            c.child('x').inc()
+    threads = [threading.Thread(target=count) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assertEqual(c.render(), """# HELP test_counter A "test"
+# TYPE test_counter counter
+test_counter_total{a="x"} 4001
+test_counter_total{a="y\\n"} 2
+""")
+
+
+def test_histogram():
+    h = zeitgitter.metrics.Histogram('test_histogram', "Test",
+                                     buckets=(0.1, 1))
+    h.observe(0.05)
+    h.observe(0.1)
+    h.observe(0.5)
+    h.observe(2)
+    assertEqual(h.render(), """# HELP test_histogram Test
+# TYPE test_histogram histogram
+test_histogram_bucket{le="0.1"} 2
+test_histogram_bucket{le="1"} 3
+test_histogram_bucket{le="+Inf"} 4
+test_histogram_sum 2.65
+test_histogram_count 4
+""")
+
+
+def test_gauge():
+    value = [3]
+    g = zeitgitter.metrics.Gauge('test_gauge', "Test", fn=lambda: value[0])
+    value[0] = 5
+    assertEqual(g.render(), """# HELP test_gauge Test
+# TYPE test_gauge gauge
+test_gauge 5
+""")
+    assert '# TYPE zeitgitter_sign_wait_seconds histogram\n' \
+        in zeitgitter.metrics.render()
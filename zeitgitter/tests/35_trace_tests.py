@@ -0,0 +1,109 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test request tracing
+
+import json
+import logging
+import threading
+import time
+
+import zeitgitter.config
+import zeitgitter.trace
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+def setup_module():
+    global collect
+    zeitgitter.config.get_args(args=[
+        '--country', '', '--owner', '', '--contact', '',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--trace-slow-threshold', '0.05s'])
+    collect = Collect()
+    zeitgitter.trace.logging.addHandler(collect)
+    zeitgitter.trace.logging.setLevel(logging.INFO)
+
+
+def teardown_module():
+    zeitgitter.trace.logging.removeHandler(collect)
+
+
+def request(delay):
+    token = zeitgitter.trace.start()
+    lock = threading.Lock()
+    with zeitgitter.trace.acquire(lock, 'lock-wait'):
+        with zeitgitter.trace.span('work'):
+            time.sleep(delay)
+    zeitgitter.trace.annotate(request='test')
+    zeitgitter.trace.finish(token)
+
+
+def test_slow_only():
+    collect.records.clear()
+    request(0)
+    assertEqual(collect.records, [])
+    request(0.06)
+    assertEqual(len(collect.records), 1)
+    r = collect.records[0]
+    assertEqual(r['request'], 'test')
+    assertEqual(r['slow'], True)
+    assertEqual([s['name'] for s in r['spans']], ['lock-wait', 'work'])
+    assert r['spans'][1]['duration'] >= 0.06
+    assertEqual(zeitgitter.trace.current.get(), None)
+
+
+def test_sampled():
+    collect.records.clear()
+    zeitgitter.config.arg.trace_sample_rate = 1.0
+    try:
+        request(0)
+    finally:
+        zeitgitter.config.arg.trace_sample_rate = 0.0
+    assertEqual(len(collect.records), 1)
+    assertEqual(collect.records[0]['slow'], False)
+
+
+def test_disabled():
+    zeitgitter.config.arg.trace_slow_threshold = None
+    try:
+        assertEqual(zeitgitter.trace.start(), None)
+        with zeitgitter.trace.span('nothing'):
+            pass
+    finally:
+        zeitgitter.config.arg.trace_slow_threshold = 0.05
@@ -0,0 +1,70 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test the sampling profiler and stack dumps
+
+import threading
+
+import zeitgitter.profiler
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def waiting_for_hagrid(event):
+    event.wait()
+
+
+def test_sample():
+    done = threading.Event()
+    threads = [threading.Thread(target=waiting_for_hagrid, args=(done,),
+                                name='Hagrid-%d' % i) for i in range(3)]
+    for t in threads:
+        t.start()
+    try:
+        stacks = zeitgitter.profiler.sample(0.2, interval=0.01)
+        assert 'waiting_for_hagrid' in zeitgitter.profiler.dump_stacks()
+    finally:
+        done.set()
+        for t in threads:
+            t.join()
+    hagrid = [(s, n) for (s, n) in stacks.items()
+              if s.startswith('Hagrid;') and 'waiting_for_hagrid (' in s]
+    # All three threads are merged into the same stack
+    assertEqual(len(hagrid), 1)
+    assert hagrid[0][1] >= 3
+    lines = zeitgitter.profiler.format_collapsed(stacks).splitlines()
+    assertEqual(len(lines), len(stacks))
+
+
+def test_exclusive():
+    zeitgitter.profiler.running.acquire()
+    try:
+        assertEqual(zeitgitter.profiler.sample(0.1), None)
+    finally:
+        zeitgitter.profiler.running.release()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test the health report
+
+import zeitgitter.commit
+import zeitgitter.config
+import zeitgitter.health
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    zeitgitter.config.get_args(args=[
+        '--country', '', '--owner', '', '--contact', '',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--upstream-timestamp', 'gitta',
+        '--push-repository', 'origin',
+        '--health-max-age', '10m',
+        '--health-max-mail-wait', '1h',
+        '--health-max-backlog', '2'])
+    zeitgitter.health.events.clear()
+    zeitgitter.commit.reset_logged()
+
+
+def test_report():
+    start = zeitgitter.health.started
+    assertEqual(zeitgitter.health.report(start + 10)['problems'], [])
+    assertEqual(zeitgitter.health.report(start + 601)['problems'],
+                ["no successful round for 601s",
+                 "no successful cross-timestamp:gitta for 601s",
+                 "no successful push:origin for 601s"])
+
+    zeitgitter.health.success('round')
+    zeitgitter.health.success('cross-timestamp:gitta')
+    zeitgitter.health.success('push:origin')
+    zeitgitter.health.failure('push:origin')
+    now = zeitgitter.health.last_success('round')
+    report = zeitgitter.health.report(now + 1)
+    assertEqual(report['problems'], [])
+    assertEqual(report['events']['push:origin']['failures'], 1)
+
+    for i in range(3):
+        zeitgitter.health.failure('agent:0')
+    zeitgitter.health.success('mail-sent')
+    zeitgitter.commit.reset_logged(3, 123)
+    try:
+        problems = zeitgitter.health.report(now + 3700)['problems'][3:]
+        assertEqual([p.split(' for ')[0] for p in problems],
+                    ["agent:0 failed 3 times in a row",
+                     "no working agent",
+                     "no PGP Timestamper reply",
+                     "3 entries not yet committed",
+                     "oldest entry not committed"])
+    finally:
+        zeitgitter.commit.reset_logged()
+    zeitgitter.health.success('agent:0')
+    zeitgitter.health.success('mail-reply')
+    assertEqual(zeitgitter.health.report(now + 1)['problems'], [])
+
+
+def test_rounds():
+    rnd = zeitgitter.commit.Round(slot=1551155100, coalesced=2)
+    with rnd.phase('commit'):
+        pass
+    rnd.overrun = True
+    rnd.finish()
+    with zeitgitter.commit.schedule_lock:
+        zeitgitter.commit.rounds.append(rnd)
+    try:
+        rounds = zeitgitter.health.report()['rounds']
+        assertEqual(rounds[-1]['slot'], 1551155100)
+        assertEqual((rounds[-1]['overrun'], rounds[-1]['coalesced']),
+                    (True, 2))
+        assertEqual(list(rounds[-1]['phases']), ['commit'])
+    finally:
+        zeitgitter.commit.rounds.clear()
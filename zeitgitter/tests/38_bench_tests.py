@@ -0,0 +1,100 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+# Test the load generator against a real server
+
+import tempfile
+
+import zeitgitter.bench
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    global gnupg_home
+    gnupg_home = tempfile.TemporaryDirectory()
+
+
+def teardown_module():
+    gnupg_home.cleanup()
+
+
+def test_percentile():
+    values = list(range(1, 1001))
+    assertEqual(zeitgitter.bench.percentile(values, 50), 500)
+    assertEqual(zeitgitter.bench.percentile(values, 99.9), 999)
+    assertEqual(zeitgitter.bench.percentile(values, 100), 1000)
+    assertEqual(zeitgitter.bench.percentile([7], 99), 7)
+    assertEqual(zeitgitter.bench.percentile([], 50), None)
+
+
+def test_summarize():
+    samples = [(0, 0.1, 'tag', 200), (0, 0.2, 'tag', 429),
+               (0, 0.3, 'branch', 200), (0, 0.4, 'branch', 'error')]
+    s = zeitgitter.bench.report(samples, 2, ['tag', 'branch'])
+    assertEqual(s['all']['requests'], 4)
+    assertEqual(s['all']['throughput'], 1.0)
+    assertEqual(s['all']['rate-429'], 0.25)
+    assertEqual(s['all']['errors'], 1)
+    assertEqual(s['all']['p50'], 0.2)
+    assertEqual(s['tag']['p99'], 0.2)
+    assertEqual(s['branch']['errors'], 1)
+
+
+def test_closed_loop():
+    with zeitgitter.bench.BenchServer(gnupg_home.name) as server:
+        samples = zeitgitter.bench.drive(
+            '127.0.0.1', server.port, ['tag', 'branch', 'pubkey'], 2, 1)
+    assert len(samples) > 3
+    assertEqual({s[3] for s in samples}, {200})
+    assertEqual({s[2] for s in samples}, {'tag', 'branch', 'pubkey'})
+
+
+def test_open_loop():
+    with zeitgitter.bench.BenchServer(gnupg_home.name) as server:
+        samples = zeitgitter.bench.drive(
+            '127.0.0.1', server.port, ['pubkey'], 2, 1, rate=20)
+    assert 15 <= len(samples) <= 25
+    assertEqual({s[3] for s in samples}, {200})
+
+
+def test_server_summary():
+    metrics = zeitgitter.bench.parse_metrics("""# HELP x y
+zeitgitter_sign_timeouts_total 3
+zeitgitter_faults_injected_total{point="agent0"} 5
+zeitgitter_round_phase_seconds_sum{kind="early",phase="commit"} 0.5
+zeitgitter_round_phase_seconds_sum{kind="early",phase="rotate"} 0.1
+zeitgitter_round_phase_seconds_count{kind="early",phase="commit"} 2
+zeitgitter_round_phase_seconds_count{kind="early",phase="rotate"} 2
+""")
+    assertEqual(zeitgitter.bench.server_summary(metrics),
+                {'sign-timeouts': 3, 'round-overruns': 0,
+                 'faults-agent0': 5, 'rounds-early': 2,
+                 'round-seconds-early': 0.3})
@@ -0,0 +1,89 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+# Check the microbenchmarks; compare them against the baseline only if
+# `ZEITGITTER_MICROBENCH` is set (timing depends on the machine's load)
+
+import os
+import unittest
+
+import zeitgitter.microbench
+import zeitgitter.stamper
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def bench(name):
+    return zeitgitter.microbench.benchmarks[name]()()
+
+
+def test_results():
+    params = {'request': ['stamp-tag-v1'],
+              'commit': [zeitgitter.microbench.COMMIT],
+              'tagname': ['v1.2.3']}
+    assertEqual(bench('parse-urlencoded'), params)
+    assertEqual(bench('parse-multipart'), params)
+    assertEqual(bench('address-string'), '198.51.100.7')
+    assert bench('valid-commit')
+    assert bench('valid-tag')
+    tag = bench('stamp-tag')
+    assert tag.startswith(b'object %s\ntype commit\ntag v1.2.3\n'
+                          % bytes(zeitgitter.microbench.COMMIT, 'ASCII'))
+    assert tag.endswith(zeitgitter.microbench.Signature.data)
+    branch = bench('stamp-branch')
+    assert (b'\ngpgsig -----BEGIN PGP SIGNATURE-----\n \n' in branch)
+    assert (b'\n -----END PGP SIGNATURE-----\n\n:watch: ' in branch)
+    assertEqual(bench('gpgsig-header').count(b'\n '), 6)
+    response = bench('respond-tag')
+    assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert response.endswith(b'\r\n\r\n' + tag)
+
+
+def test_baseline_complete():
+    baseline = zeitgitter.microbench.load_baseline()
+    assertEqual(sorted(baseline), sorted(zeitgitter.microbench.benchmarks))
+
+
+def test_regressions():
+    baseline = {'fast': 1.0, 'slow': 1.0}
+    assertEqual(zeitgitter.microbench.regressions(
+        {'fast': 1.4, 'slow': 2.5, 'new': 9.0}, baseline),
+        ["slow: 2.5000 units, 2.50× the baseline of 1.0000"])
+
+
+@unittest.skipUnless(os.getenv('ZEITGITTER_MICROBENCH'),
+                     "ZEITGITTER_MICROBENCH not set")
+def test_against_baseline():
+    tolerance = float(os.getenv('ZEITGITTER_MICROBENCH_TOLERANCE',
+                                zeitgitter.microbench.TOLERANCE))
+    baseline = zeitgitter.microbench.load_baseline()
+    (_, results) = zeitgitter.microbench.run_checked(baseline, tolerance)
+    assertEqual(zeitgitter.microbench.regressions(results, baseline,
+                                                  tolerance), [])
@@ -0,0 +1,154 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+# Test fault injection
+
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+import zeitgitter.commit
+import zeitgitter.config
+import zeitgitter.faults
+import zeitgitter.health
+import zeitgitter.server
+import zeitgitter.stamper
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    global stamper
+    global tmpdir
+    tmpdir = tempfile.TemporaryDirectory()
+    gnupg = pathlib.Path(tmpdir.name, 'gnupg')
+    shutil.copytree(pathlib.Path(os.path.dirname(os.path.realpath(__file__)),
+                                 'gnupg'), gnupg,
+                    ignore=shutil.ignore_patterns("S.*", "*~"))
+    zeitgitter.config.get_args(args=[
+        '--gnupg-home', gnupg.as_posix(),
+        '--country', '', '--owner', '', '--contact', '',
+        '--keyid', '353DFEC512FA47C7',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--lookup-index', 'none',
+        '--repository', tmpdir.name])
+    stamper = zeitgitter.stamper.Stamper()
+
+
+def teardown_module():
+    zeitgitter.config.arg.fault_injection = {}
+    zeitgitter.commit.reset_logged()
+    tmpdir.cleanup()
+
+
+def set_faults(spec):
+    zeitgitter.config.arg.fault_injection = zeitgitter.faults.parse(spec)
+
+
+def test_parse():
+    Fault = zeitgitter.faults.Fault
+    assertEqual(zeitgitter.faults.parse(''), {})
+    assertEqual(zeitgitter.faults.parse(
+        'fsync=0.2s@0.01, agent0=10s,upstream=5m+fail , sign=fail'),
+        {'fsync': Fault(0.2, False, 0.01),
+         'agent0': Fault(10.0, False, 1.0),
+         'upstream': Fault(300.0, True, 1.0),
+         'sign': Fault(0.0, True, 1.0)})
+    for bad in ('fsync', 'disk=1s', 'fsync=soon', 'sign=1s@2'):
+        try:
+            zeitgitter.faults.parse(bad)
+            raise AssertionError("%r accepted" % bad)
+        except ValueError:
+            pass
+
+
+def test_no_faults():
+    set_faults('')
+    assert not zeitgitter.faults.inject('fsync')
+    tag = stamper.stamp_tag('%040x' % 1, 'v1')
+    assert tag.startswith(b'object ')
+
+
+def test_fsync():
+    set_faults('fsync=0.2s')
+    start = time.time()
+    stamper.log_commit('%040x' % 2, 1551155115)
+    assert time.time() - start >= 0.2
+    set_faults('fsync=fail')
+    try:
+        stamper.log_commit('%040x' % 3, 1551155115)
+        raise AssertionError("Injected fsync failure ignored")
+    except OSError:
+        pass
+    assertEqual(zeitgitter.health.events['log'][2], 1)
+    assert "logging commits failed 1 times in a row" \
+        in zeitgitter.health.report()['problems']
+    set_faults('')
+    stamper.log_commit('%040x' % 3, 1551155115)
+    assertEqual(zeitgitter.health.events['log'][2], 0)
+
+
+def test_fsync_request():
+    # The failure is answered by the handler, not propagated
+    set_faults('fsync=fail')
+    zeitgitter.server.stamper = stamper
+    handler = zeitgitter.server.StamperRequestHandler.__new__(
+        zeitgitter.server.StamperRequestHandler)
+    errors = []
+    handler.send_bodyerr = lambda status, title, body: errors.append(status)
+    handler.handle_request({'request': ['stamp-tag-v1'],
+                            'commit': ['%040x' % 6], 'tagname': ['v6']})
+    assertEqual(errors, [500])
+    assertEqual(zeitgitter.health.events['log'][2], 1)
+    set_faults('')
+    zeitgitter.health.forget('log')
+
+
+def test_sign():
+    set_faults('agent0=0.2s+fail')
+    start = time.time()
+    assertEqual(stamper.stamp_tag('%040x' % 4, 'v4'), None)
+    assert time.time() - start >= 0.2
+    set_faults('agent1=fail')  # Not in use
+    assert stamper.stamp_tag('%040x' % 5, 'v5').startswith(b'object ')
+
+
+def test_probability():
+    set_faults('sign=fail@0.5')
+    failed = sum(zeitgitter.faults.inject('sign') for _ in range(1000))
+    assert 350 < failed < 650
+
+
+def test_upstream():
+    set_faults('upstream=fail')
+    assertEqual(zeitgitter.commit.cross_timestamp(
+        tmpdir.name, ['--server', 'https://gitta.enotar.ch']), False)
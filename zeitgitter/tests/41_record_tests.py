@@ -0,0 +1,119 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+# Test traffic recording and replay
+
+import json
+import pathlib
+import tempfile
+
+import zeitgitter.bench
+import zeitgitter.record
+import zeitgitter.replay
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.TemporaryDirectory()
+
+
+def teardown_module():
+    tmpdir.cleanup()
+
+
+def test_pseudonyms():
+    path = pathlib.Path(tmpdir.name, 'pseudonyms.jsonl')
+    recorder = zeitgitter.record.Recorder(path)
+    commit = '%040x' % 1
+    recorder.record(1551155115.5, 'stamp-tag-v1', 'POST', 200, 78, 400,
+                    0.01, '192.0.2.1', [commit])
+    recorder.record(1551155116.5, 'stamp-tag-v1', 'POST', 429, 78, 200,
+                    0.5, '192.0.2.1', [commit])
+    recorder.file.close()
+    with path.open() as f:
+        text = f.read()
+    assert commit not in text and '192.0.2.1' not in text
+    lines = [json.loads(line) for line in text.splitlines()]
+    assertEqual(lines[0]['format'], zeitgitter.record.FORMAT)
+    assertEqual(lines[1]['client'], lines[2]['client'])
+    assertEqual(lines[1]['commits'], lines[2]['commits'])
+    assertEqual(len(lines[1]['client']), 16)
+    assertEqual(lines[2]['status'], 429)
+    # A new recorder has a new key
+    other = zeitgitter.record.Recorder(pathlib.Path(tmpdir.name, 'other'))
+    assert other.pseudonym(commit) != lines[1]['commits'][0]
+
+
+def test_load():
+    lines = ['{"format": "%s"}' % zeitgitter.record.FORMAT] + [
+        json.dumps({'t': 100 + i, 'request': request, 'status': 200,
+                    'commits': ['c%d' % (i % 2)]})
+        for (i, request) in enumerate(['stamp-tag-v1', 'static',
+                                       'stamp-branch-v1', 'lookup-v1',
+                                       'get-public-key-v1'])]
+    (records, skipped) = zeitgitter.replay.load(reversed(lines))
+    assertEqual([r['t'] for r in records], [100, 102, 104])
+    assertEqual(skipped, 2)
+    (records, skipped) = zeitgitter.replay.load(lines, skip=1, duration=2)
+    assertEqual([r['t'] for r in records], [102])
+    assertEqual(skipped, 1)
+    (records, _) = zeitgitter.replay.load(lines)
+    sched = zeitgitter.replay.schedule(records, 4)
+    assertEqual([(t, k) for (t, k, _) in sched],
+                [(0.0, 'tag'), (0.5, 'branch'), (1.0, 'pubkey')])
+    # Same pseudonym, same commit ID
+    assertEqual(sched[0][2], sched[1][2])
+    assertEqual(len(sched[0][2]), 40)
+
+
+def test_record_and_replay():
+    path = pathlib.Path(tmpdir.name, 'traffic.jsonl')
+    with zeitgitter.bench.throwaway_gnupg_home() as home:
+        with zeitgitter.bench.BenchServer(
+                home, ['--record-traffic', path.as_posix()]) as server:
+            samples = zeitgitter.bench.drive(
+                '127.0.0.1', server.port, ['tag', 'branch', 'pubkey'], 2, 0.5)
+        with path.open() as f:
+            (records, skipped) = zeitgitter.replay.load(f)
+        # Requests may still have been running when `drive()` stopped
+        assert len(samples) <= len(records) <= len(samples) + 2
+        assertEqual({r['status'] for r in records}, {200})
+        assertEqual({r['request'] for r in records},
+                    {'stamp-tag-v1', 'stamp-branch-v1', 'get-public-key-v1'})
+        assert skipped >= 1  # Readiness check
+        with zeitgitter.bench.BenchServer(home) as server:
+            replayed = zeitgitter.bench.drive(
+                '127.0.0.1', server.port, ['tag'], 4,
+                (records[-1]['t'] - records[0]['t']) / 10 + 1,
+                schedule=zeitgitter.replay.schedule(records, 10))
+    assertEqual(len(replayed), len(records))
+    assertEqual({s[3] for s in replayed}, {200})
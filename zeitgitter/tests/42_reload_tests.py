@@ -0,0 +1,222 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+
+# Test reloading the configuration
+
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+
+import zeitgitter.config
+import zeitgitter.server
+import zeitgitter.stamper
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    global tmpdir, config
+    tmpdir = tempfile.TemporaryDirectory()
+    gnupg = pathlib.Path(tmpdir.name, 'gnupg')
+    shutil.copytree(pathlib.Path(os.path.dirname(os.path.realpath(__file__)),
+                                 'gnupg'), gnupg,
+                    ignore=shutil.ignore_patterns("S.*", "*~"))
+    config = pathlib.Path(tmpdir.name, 'zeitgitter.conf')
+    write_config()
+    zeitgitter.config.get_args(args=[
+        '--config-file', config.as_posix(),
+        '--gnupg-home', gnupg.as_posix(),
+        '--country', '', '--contact', '',
+        '--keyid', '353DFEC512FA47C7',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--lookup-index', 'none',
+        '--repository', tmpdir.name])
+
+
+def teardown_module():
+    for i in (1, 2):
+        os.system("gpgconf --homedir %s/gnupg-%d --kill gpg-agent"
+                  % (tmpdir.name, i))
+    tmpdir.cleanup()
+
+
+def write_config(**settings):
+    settings = dict({'owner': 'Hagrid', 'max-parallel-signatures': '2',
+                     'number-of-gpg-agents': '2', 'commit-interval': '1h',
+                     'commit-offset': '10m'}, **settings)
+    config.write_text(''.join('%s = %s\n' % item
+                              for item in settings.items()))
+
+
+def test_semaphore():
+    sem = zeitgitter.stamper.ResizableSemaphore(1)
+    assertEqual(sem.acquire(0), True)
+    assertEqual(sem.acquire(0), False)
+    sem.resize(2)
+    assertEqual(sem.acquire(0), True)
+    sem.resize(1)
+    sem.release()
+    # Still one held, with one slot
+    assertEqual(sem.acquire(0), False)
+    # Waiters are woken up when growing
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(sem.acquire(5)))
+    waiter.start()
+    time.sleep(0.1)
+    sem.resize(3)
+    waiter.join()
+    assertEqual(acquired, [True])
+    sem.release()
+    sem.release()
+    try:
+        sem.release()
+        raise AssertionError("Over-release not detected")
+    except ValueError:
+        pass
+
+
+def test_reload():
+    arg = zeitgitter.config.arg
+    assertEqual(zeitgitter.config.reload(), ([], []))
+    write_config(**{'max-parallel-signatures': '5',
+                    'upstream-timestamp': 'gitta',
+                    'owner': 'Someone else'})
+    (changed, ignored) = zeitgitter.config.reload()
+    assertEqual(changed, ['max_parallel_signatures', 'upstream_timestamp'])
+    assertEqual(ignored, ['owner'])
+    assertEqual(arg.max_parallel_signatures, 5)
+    assertEqual(arg.upstream_timestamp, ['gitta'])
+    assertEqual(arg.owner, 'Hagrid')
+    assertEqual(zeitgitter.config.arg is arg, True)
+
+
+def test_reload_invalid():
+    arg = zeitgitter.config.arg
+    write_config(**{'max-parallel-signatures': '7', 'commit-offset': '2h'})
+    try:
+        zeitgitter.config.reload()
+        raise AssertionError("Invalid configuration accepted")
+    except ValueError:
+        pass
+    assertEqual(arg.max_parallel_signatures, 5)
+    write_config()
+    zeitgitter.config.reload()
+
+
+def test_reload_log_levels():
+    root = logging.getLogger()
+    write_config(**{'debug-level': 'WARN,stamper=DEBUG'})
+    zeitgitter.config.reload()
+    assertEqual((root.level, logging.getLogger('stamper').level),
+                (logging.WARN, logging.DEBUG))
+    # Rejected: levels unchanged
+    write_config(**{'debug-level': 'ERROR', 'commit-offset': '2h'})
+    try:
+        zeitgitter.config.reload()
+        raise AssertionError("Invalid configuration accepted")
+    except ValueError:
+        pass
+    assertEqual((root.level, logging.getLogger('stamper').level),
+                (logging.WARN, logging.DEBUG))
+    assertEqual(zeitgitter.config.arg.debug_level, 'WARN,stamper=DEBUG')
+    # Levels removed from the setting are reset
+    write_config()
+    zeitgitter.config.reload()
+    assertEqual((root.level, logging.getLogger('stamper').level),
+                (logging.INFO, logging.NOTSET))
+
+
+def test_reconfigure():
+    stamper = zeitgitter.stamper.Stamper()
+    stamper.start_multi_threaded()
+    for i in range(2):
+        stamper.gpg()
+    assertEqual(sorted(g.agent for g in stamper.gpgs), [0, 1])
+    write_config(**{'number-of-gpg-agents': '1',
+                    'max-parallel-signatures': '1',
+                    'max-parallel-timeout': '3'})
+    zeitgitter.config.reload()
+    stamper.reconfigure()
+    assertEqual(stamper.sem.value, 1)
+    assertEqual(stamper.timeout, 3.0)
+    assertEqual([g.agent for g in stamper.gpgs], [0])
+    assertEqual(stamper.gpg().agent, 0)
+    # Signing still works with the shrunk pool
+    tag = stamper.stamp_tag('1' * 40, 'v1')
+    assertEqual(b'-----BEGIN PGP SIGNATURE-----' in tag, True)
+
+
+def test_reload_derived():
+    arg = zeitgitter.config.arg
+    write_config(**{'commit-interval': '2h', 'number-of-gpg-agents': '3'})
+    (changed, ignored) = zeitgitter.config.reload()
+    assertEqual(ignored, [])
+    assertEqual((arg.health_max_age, arg.health_max_mail_wait),
+                (7500.0, 9000.0))
+    assertEqual(arg.number_of_gpg_agents_secondary, 3)
+    # Explicit settings are kept
+    write_config(**{'health-max-age': '1h',
+                    'number-of-gpg-agents-secondary': '1'})
+    (changed, ignored) = zeitgitter.config.reload()
+    assertEqual(ignored, [])
+    assertEqual((arg.health_max_age, arg.health_max_mail_wait),
+                (3600.0, 5400.0))
+    assertEqual(arg.number_of_gpg_agents_secondary, 1)
+    write_config()
+    zeitgitter.config.reload()
+
+
+def test_resize_secondary():
+    secondary = zeitgitter.stamper.SecondarySigner('353DFEC512FA47C7', 2)
+    for i in range(2):
+        secondary.gpg()
+    secondary.resize(1)
+    assertEqual([g.number for g in secondary.gpgs], [0])
+    assertEqual(secondary.gpg().number, 0)
+    secondary.resize(2)
+    assertEqual(secondary.gpg().number, 1)
+
+
+def test_reload_config():
+    write_config(**{'commit-interval': '2h'})
+    (ok, text) = zeitgitter.server.reload_config()
+    assertEqual(ok, True)
+    assertEqual('commit_interval' in text.split('\n')[0], True)
+    assertEqual(zeitgitter.config.arg.commit_interval.total_seconds(), 7200.0)
+    write_config(**{'number-of-gpg-agents': '0'})
+    (ok, text) = zeitgitter.server.reload_config()
+    assertEqual(ok, False)
+    write_config()
+    zeitgitter.server.reload_config()
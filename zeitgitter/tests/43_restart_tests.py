@@ -0,0 +1,104 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+
+# Test graceful restarts (SIGUSR2)
+
+import argparse
+import os
+import signal
+import threading
+
+import zeitgitter.bench
+import zeitgitter.commit
+import zeitgitter.config
+import zeitgitter.server
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def test_pause():
+    try:
+        zeitgitter.commit.current_round = zeitgitter.commit.Round()
+        assertEqual(zeitgitter.commit.pause(0.2), False)
+        zeitgitter.commit.current_round = None
+        assertEqual(zeitgitter.commit.pause(0.2), True)
+        # No further rounds are started
+        zeitgitter.commit.schedule(0)
+        assertEqual(zeitgitter.commit.current_round, None)
+    finally:
+        zeitgitter.commit.current_round = None
+        zeitgitter.commit.paused = False
+
+
+def test_exec_failure():
+    exits = []
+
+    def execve(*args):
+        raise FileNotFoundError("Removed during upgrade")
+
+    def exit(status):
+        exits.append(status)
+        raise SystemExit(status)
+    saved = (getattr(zeitgitter.config, 'arg', None), os.execve, os._exit,
+             zeitgitter.server.servers)
+    zeitgitter.config.arg = argparse.Namespace(restart_drain_timeout=0)
+    (os.execve, os._exit) = (execve, exit)
+    zeitgitter.server.servers = []
+    try:
+        zeitgitter.server.restart()
+        raise AssertionError("Returned after failing to re-execute")
+    except SystemExit:
+        pass
+    finally:
+        (zeitgitter.config.arg, os.execve, os._exit,
+         zeitgitter.server.servers) = saved
+        zeitgitter.commit.serialize.release()
+        zeitgitter.commit.paused = False
+    # Exits non-zero, for the supervisor to restart the service
+    assertEqual(exits, [1])
+
+
+def test_restart_under_load():
+    with zeitgitter.bench.throwaway_gnupg_home() as home, \
+            zeitgitter.bench.BenchServer(
+                home, ['--debug-level', 'INFO']) as server:
+        restart = threading.Timer(
+            0.5, lambda: server.proc.send_signal(signal.SIGUSR2))
+        restart.start()
+        samples = zeitgitter.bench.drive(
+            '127.0.0.1', server.port, ['tag', 'branch', 'pubkey'], 4, 2)
+        restart.join()
+        # Same process, re-executed, without a single failed request
+        assertEqual(server.proc.poll(), None)
+        log = server.log.read_text()
+        assertEqual(log.count("Re-executing"), 1)
+        assertEqual(log.count("Start serving"), 2)
+        assertEqual({s[3] for s in samples}, {200})
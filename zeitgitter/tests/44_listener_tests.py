@@ -0,0 +1,146 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+
+# Test multiple listeners, including a Unix domain socket
+
+import io
+import signal
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+import zeitgitter.bench
+import zeitgitter.config
+import zeitgitter.microbench
+import zeitgitter.server
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def unix_handler(xff, trusted):
+    headers = 'X-Forwarded-For: %s\r\n\r\n' % xff if xff else '\r\n'
+    handler = zeitgitter.microbench.ParsingHandler(bytes(headers, 'ASCII'))
+    handler.client_address = ''  # As returned by `accept()`
+    handler.trusted_nets = [zeitgitter.server.ipaddress.ip_network(
+        '10.0.0.0/8')]
+    handler.trusted_unix = trusted
+    return handler
+
+
+def test_unix_address_string():
+    assertEqual(unix_handler(None, True).address_string(), 'unix')
+    assertEqual(unix_handler('198.51.100.7', True).address_string(),
+                '198.51.100.7')
+    assertEqual(unix_handler('198.51.100.7', False).address_string(), 'unix')
+    # Only the chain of trusted proxies is followed
+    assertEqual(unix_handler('192.0.2.1, 198.51.100.7, 10.1.2.3',
+                             True).address_string(), '198.51.100.7')
+    assertEqual(unix_handler('192.0.2.1', True).is_admin(), False)
+
+
+def test_listener_trust():
+    # Loopback may forward for others, the public (but fc00::/7) listener
+    # must not
+    zeitgitter.config.get_args(args=[
+        '--country', '', '--owner', '', '--contact', '',
+        '--keyid', '353DFEC512FA47C7',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--listen-address', '127.0.0.1;trusted=127.0.0.0/8 ::1;trusted=none',
+        '--listen-port', '0'])
+    arg = zeitgitter.config.arg
+    assertEqual(arg.listen_address, [('127.0.0.1', ['127.0.0.0/8']),
+                                     ('::1', [])])
+    assertEqual(arg.listen_unix_trusted, None)
+    assertEqual(zeitgitter.server.configured_trust(('0::1', 0, 0, 0)), [])
+    assertEqual(zeitgitter.server.configured_trust(('::1', 1, 0, 0)),
+                arg.trusted_proxies)  # Other port: default
+    assertEqual(zeitgitter.server.configured_trust('/run/z.sock'),
+                arg.trusted_proxies)
+    servers = zeitgitter.server.create_servers()
+    try:
+        for (server, peer, expected) in zip(servers,
+                                            ('127.0.0.1', 'fd00::1'),
+                                            ('198.51.100.7', 'fd00::1')):
+            handler = zeitgitter.microbench.ParsingHandler(
+                b'X-Forwarded-For: 198.51.100.7\r\n\r\n',
+                client=peer, trusted_nets=server.trusted_nets)
+            assertEqual(handler.address_string(), expected)
+        assertEqual(servers[1].trusted_unix, False)
+    finally:
+        for server in servers:
+            server.server_close()
+    try:
+        zeitgitter.config.parse_args(args=[
+            '--country', '', '--owner', '', '--contact', '',
+            '--own-url', 'https://hagrid.snakeoil',
+            '--listen-address', '::1;trust=none'])
+        raise AssertionError("Unknown listener option accepted")
+    except SystemExit:
+        pass
+
+
+def get(sock, path):
+    sock.sendall(bytes('GET %s HTTP/1.0\r\n\r\n' % path, 'ASCII'))
+    with sock.makefile('rb') as f:
+        return int(f.readline().split()[1])
+
+
+def get_unix(path, url):
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        return get(sock, url)
+
+
+def get_tcp(port, url):
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        return get(sock, url)
+
+
+def test_unix_listener():
+    url = '/?request=get-public-key-v1'
+    with tempfile.TemporaryDirectory() as tmp, \
+            zeitgitter.bench.throwaway_gnupg_home() as home:
+        path = Path(tmp, 'zeitgitterd.sock')
+        with zeitgitter.bench.BenchServer(home, ['--listen-unix',
+                                                 path.as_posix()]) as server:
+            assertEqual(path.stat().st_mode & 0o777, 0o660)
+            assertEqual(get_unix(path.as_posix(), url), 200)
+            assertEqual(get_tcp(server.port, url), 200)
+            # Metrics are not available through the proxy
+            assertEqual(get_unix(path.as_posix(), '/metrics'), 403)
+            # Both sockets are handed over on a restart
+            server.proc.send_signal(signal.SIGUSR2)
+            time.sleep(0.5)
+            assertEqual(get_unix(path.as_posix(), url), 200)
+            assertEqual(get_tcp(server.port, url), 200)
+            assertEqual(server.proc.poll(), None)
+        assertEqual(path.exists(), False)
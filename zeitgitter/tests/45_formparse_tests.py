@@ -0,0 +1,130 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+
+# Test request body parsing
+
+import io
+
+import zeitgitter.formparse
+from zeitgitter.formparse import FormError
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+COMMIT = '1dd8a3e2b11ef6e77d7e0e8bc0cbb4bc2a13ae7a'
+EXPECTED = {'request': ['stamp-tag-v1'], 'commit': [COMMIT],
+            'tagname': ['v1.2.3']}
+
+
+def parse(ctype, body, length=None):
+    headers = {'Content-Length': str(len(body) if length is None else length)}
+    if ctype is not None:
+        headers['Content-Type'] = ctype
+    return zeitgitter.formparse.parse(headers, io.BytesIO(body))
+
+
+def rejected(ctype, body, length=None):
+    try:
+        parse(ctype, body, length)
+    except FormError as e:
+        return e.status
+    raise AssertionError("Accepted %r" % body)
+
+
+def multipart(fields, boundary='d74496d66958873e'):
+    return bytes(''.join('--%s\r\nContent-Disposition: form-data; name="%s"'
+                         '\r\n\r\n%s\r\n' % (boundary, k, v)
+                         for (k, v) in fields)
+                 + '--%s--\r\n' % boundary, 'UTF-8')
+
+
+def test_parse_header():
+    assertEqual(zeitgitter.formparse.parse_header(
+        'Multipart/Form-Data; boundary="a \\"b\\"; c"; x=y '),
+        ('multipart/form-data', {'boundary': 'a "b"; c', 'x': 'y'}))
+    assertEqual(zeitgitter.formparse.parse_header('text/plain'),
+                ('text/plain', {}))
+
+
+def test_urlencoded():
+    ctype = 'application/x-www-form-urlencoded'
+    assertEqual(parse(ctype, bytes('request=stamp-tag-v1&commit=%s'
+                                   '&tagname=v1%%2E2.3&' % COMMIT, 'ASCII')),
+                EXPECTED)
+    assertEqual(parse(ctype, b'commit=a&commit=b&parent=&x=%C3%A4+'),
+                {'commit': ['a', 'b'], 'x': ['ä ']})
+    assertEqual(rejected(ctype, b'request'), 400)
+    assertEqual(rejected(ctype, b'=x'), 400)
+    assertEqual(rejected(ctype, b'x=%FF'), 400)
+    assertEqual(rejected(ctype, b'x=\xff'), 400)
+
+
+def test_multipart():
+    ctype = 'multipart/form-data; boundary=d74496d66958873e'
+    fields = [(k, v[0]) for (k, v) in EXPECTED.items()]
+    assertEqual(parse(ctype, multipart(fields)), EXPECTED)
+    # With preamble and a quoted boundary
+    assertEqual(parse('multipart/form-data; boundary="x y"',
+                      b'ignored\r\n' + multipart(fields, 'x y')), EXPECTED)
+    assertEqual(rejected('multipart/form-data', multipart(fields)), 400)
+    assertEqual(rejected(ctype, multipart(fields)[:-8]), 400)
+    assertEqual(rejected(ctype, multipart(fields).replace(b'name=', b'x=')),
+                400)
+    assertEqual(rejected(ctype, b'--d74496d66958873e\r\nno headers'), 400)
+
+
+def test_json():
+    ctype = 'application/json; charset=UTF-8'
+    assertEqual(parse(ctype, bytes('{"request":"stamp-tag-v1","commit":"%s",'
+                                   '"tagname":"v1.2.3"}' % COMMIT, 'ASCII')),
+                EXPECTED)
+    assertEqual(parse(ctype, b'{"commit":["a","b"],"parent":[]}'),
+                {'commit': ['a', 'b']})
+    assertEqual(rejected(ctype, b'["request"]'), 400)
+    assertEqual(rejected(ctype, b'{"commit":1}'), 400)
+    assertEqual(rejected(ctype, b'{"commit":'), 400)
+
+
+def test_limits():
+    ctype = 'application/x-www-form-urlencoded'
+    assertEqual(rejected(None, b'request=x'), 415)
+    assertEqual(rejected('text/plain', b'request=x'), 415)
+    assertEqual(rejected(ctype, b'request=x', 'many'), 411)
+    assertEqual(rejected(ctype, b'request=x', -1), 413)
+    assertEqual(rejected(ctype, b'x=' + b'y' * 1000), 413)
+    # Body shorter than announced
+    assertEqual(rejected(ctype, b'request=x', 20), 400)
+    # Nothing beyond `Content-Length` is read
+    rfile = io.BytesIO(b'request=xGET / HTTP/1.1\r\n')
+    assertEqual(zeitgitter.formparse.parse(
+        {'Content-Type': ctype, 'Content-Length': '9'}, rfile),
+        {'request': ['x']})
+    assertEqual(rfile.read(), b'GET / HTTP/1.1\r\n')
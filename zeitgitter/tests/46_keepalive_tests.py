@@ -0,0 +1,164 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test persistent (keep-alive) connections
+
+import socket
+import time
+
+import zeitgitter.bench
+
+server = None
+home = None
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    global server, home
+    home = zeitgitter.bench.throwaway_gnupg_home()
+    server = zeitgitter.bench.BenchServer(
+        home.__enter__(), ['--keep-alive-timeout', '1s',
+                           '--keep-alive-max-requests', '3'])
+    server.__enter__()
+
+
+def teardown_module():
+    server.__exit__(None, None, None)
+    home.__exit__(None, None, None)
+
+
+class Connection:
+    def __init__(self):
+        self.sock = socket.create_connection(('127.0.0.1', server.port))
+        self.sock.settimeout(5)
+        self.file = self.sock.makefile('rb')
+
+    def send(self, request):
+        self.sock.sendall(bytes(request, 'ASCII'))
+
+    def response(self, head=False):
+        """Status, headers (lowercase) and body of the next response"""
+        status = int(self.file.readline().split()[1])
+        headers = {}
+        while True:
+            line = str(self.file.readline(), 'ASCII').strip()
+            if line == '':
+                break
+            (name, value) = line.split(':', 1)
+            headers[name.lower()] = value.strip()
+        length = 0 if head else int(headers.get('content-length', '0'))
+        return (status, headers, self.file.read(length))
+
+    def closed(self):
+        return self.file.read(1) == b''
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def get(path, method='GET', version='1.1'):
+    return '%s %s HTTP/%s\r\nHost: localhost\r\n\r\n' % (method, path, version)
+
+
+def test_head():
+    c = Connection()
+    c.send(get('/', 'HEAD'))
+    (status, headers, body) = c.response(head=True)
+    assertEqual(status, 200)
+    assertEqual(int(headers['content-length']) > 0, True)
+    # No body: The next response follows immediately
+    c.send(get('/?request=get-public-key-v1', 'HEAD'))
+    (status, headers, body) = c.response(head=True)
+    assertEqual(status, 200)
+    c.send(get('/nonexistent.html', 'HEAD'))
+    assertEqual(c.response(head=True)[0], 404)
+    c.close()
+
+
+def test_pipelining_and_max_requests():
+    c = Connection()
+    c.send(get('/') + get('/?request=get-public-key-v1') + get('/'))
+    (status, headers, body) = c.response()
+    assertEqual((status, 'connection' in headers), (200, False))
+    (status, headers, pubkey) = c.response()
+    assertEqual((status, 'connection' in headers), (200, False))
+    assertEqual(pubkey.startswith(b'-----BEGIN PGP PUBLIC KEY BLOCK-----'),
+                True)
+    # `--keep-alive-max-requests` reached
+    (status, headers, body) = c.response()
+    assertEqual((status, headers['connection']), (200, 'close'))
+    assertEqual(c.closed(), True)
+    c.close()
+
+
+def test_idle_timeout():
+    c = Connection()
+    c.send(get('/'))
+    assertEqual(c.response()[0], 200)
+    start = time.time()
+    assertEqual(c.closed(), True)
+    assertEqual(0.5 < time.time() - start < 3, True)
+    c.close()
+
+
+def test_http10():
+    c = Connection()
+    c.send(get('/', version='1.0'))
+    assertEqual(c.response()[0], 200)
+    assertEqual(c.closed(), True)
+    c.close()
+    c = Connection()
+    c.send('GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+    (status, headers, body) = c.response()
+    assertEqual((status, headers['connection']), (200, 'keep-alive'))
+    c.send(get('/'))
+    assertEqual(c.response()[0], 200)
+    c.close()
+
+
+def test_unread_body():
+    c = Connection()
+    c.send('GET / HTTP/1.1\r\nContent-Length: 30\r\n\r\n')
+    (status, headers, body) = c.response()
+    assertEqual((status, headers['connection']), (200, 'close'))
+    assertEqual(c.closed(), True)
+    c.close()
+
+
+def test_metrics():
+    c = Connection()
+    c.send(get('/metrics'))
+    metrics = str(c.response()[2], 'UTF-8')
+    c.close()
+    for reason in ('client', 'idle-timeout', 'max-requests', 'error'):
+        assertEqual('zeitgitter_connections_closed_total{reason="%s"}'
+                    % reason in metrics, True)
+    assertEqual('zeitgitter_connection_requests_count' in metrics, True)
@@ -0,0 +1,176 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test serving static files: sendfile, ranges, and modification times
+
+import argparse
+import io
+import os
+import socket
+import tempfile
+from pathlib import Path
+
+import zeitgitter.bench
+import zeitgitter.config
+import zeitgitter.server
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def assertRaises(exception, fn, *args):
+    try:
+        fn(*args)
+    except exception:
+        return
+    raise AssertionError("%s not raised" % exception.__name__)
+
+
+def test_parse_range():
+    parse_range = zeitgitter.server.parse_range
+    assertEqual(parse_range(None, 100), None)
+    assertEqual(parse_range('bytes=0-9', 100), (0, 10))
+    assertEqual(parse_range('bytes=90-', 100), (90, 100))
+    assertEqual(parse_range('bytes=90-200', 100), (90, 100))
+    assertEqual(parse_range('bytes=-10', 100), (90, 100))
+    assertEqual(parse_range('bytes=-200', 100), (0, 100))
+    # Multiple ranges and other units are ignored
+    assertEqual(parse_range('bytes=0-9,20-29', 100), None)
+    assertEqual(parse_range('lines=0-9', 100), None)
+    assertEqual(parse_range('bytes=-', 100), None)
+    assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+    assertRaises(ValueError, parse_range, 'bytes=9-0', 100)
+    assertRaises(ValueError, parse_range, 'bytes=-0', 100)
+    assertRaises(ValueError, parse_range, 'bytes=-5', 0)
+
+
+def test_static_file_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp, 'file.txt')
+        path.write_bytes(b'ZEITGITTER_DOMAIN')
+        f = zeitgitter.server.static_file(path)
+        assertEqual(zeitgitter.server.static_file(path) is f, True)
+        assertEqual(f.is_templated([b'ZEITGITTER_DOMAIN']), True)
+        # Replaced files are opened again; the old one remains readable
+        Path(tmp, 'new.txt').write_bytes(b'plain text')
+        os.rename(Path(tmp, 'new.txt'), path)
+        g = zeitgitter.server.static_file(path)
+        assertEqual(g is f, False)
+        assertEqual(g.is_templated([b'ZEITGITTER_DOMAIN']), False)
+        assertEqual((f.read(), g.read()), (b'ZEITGITTER_DOMAIN', b'plain text'))
+        path.unlink()
+        assertRaises(OSError, zeitgitter.server.static_file, path)
+
+
+def test_send_body_file_fallback():
+    # Not a socket (e.g., TLS): copied through `wfile`
+    handler = zeitgitter.server.FlatFileRequestHandler.__new__(
+        zeitgitter.server.FlatFileRequestHandler)
+    handler.connection = None
+    handler.wfile = io.BytesIO()
+    with tempfile.TemporaryFile() as f:
+        f.write(bytes(range(256)) * 1000)
+        handler.send_body_file(f, 1000, 100000)
+    assertEqual(handler.wfile.getvalue(),
+                (bytes(range(256)) * 1000)[1000:101000])
+
+
+
+def test_send_file_write_error():
+    # A client going away mid-response is not answered with a 404
+    handler = zeitgitter.server.FlatFileRequestHandler.__new__(
+        zeitgitter.server.FlatFileRequestHandler)
+    errors = []
+    handler.send_bodyerr = lambda status, title, body: errors.append(status)
+
+    def send_static(content_type, f):
+        raise BrokenPipeError("Client went away")
+
+    handler.send_static = send_static
+    saved = getattr(zeitgitter.config, 'arg', None)
+    with tempfile.TemporaryDirectory() as webroot:
+        Path(webroot, 'file.txt').write_bytes(b'plain text')
+        zeitgitter.config.arg = argparse.Namespace(webroot=webroot)
+        try:
+            assertRaises(BrokenPipeError, handler.send_file,
+                         'text/plain', 'file.txt')
+            assertEqual(errors, [])
+            handler.send_file('text/plain', 'missing.txt')
+            assertEqual(errors, [404])
+        finally:
+            zeitgitter.config.arg = saved
+
+
+def request(port, headers=''):
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(bytes('GET /big.log HTTP/1.0\r\n%s\r\n' % headers,
+                           'ASCII'))
+        with sock.makefile('rb') as f:
+            status = int(f.readline().split()[1])
+            response = {}
+            while True:
+                line = str(f.readline(), 'ASCII').strip()
+                if line == '':
+                    break
+                (name, value) = line.split(':', 1)
+                response[name.lower()] = value.strip()
+            return (status, response, f.read())
+
+
+def test_static_serving():
+    contents = os.urandom(300000)
+    with tempfile.TemporaryDirectory() as webroot, \
+            zeitgitter.bench.throwaway_gnupg_home() as home:
+        Path(webroot, 'big.log').write_bytes(contents)
+        with zeitgitter.bench.BenchServer(home, ['--webroot', webroot]) \
+                as server:
+            (status, headers, body) = request(server.port)
+            assertEqual((status, body), (200, contents))
+            assertEqual(headers['accept-ranges'], 'bytes')
+            modified = headers['last-modified']
+            (status, headers, body) = request(
+                server.port, 'Range: bytes=1000-1999\r\n')
+            assertEqual((status, headers['content-range'], body),
+                        (206, 'bytes 1000-1999/300000', contents[1000:2000]))
+            (status, headers, body) = request(
+                server.port, 'Range: bytes=300000-\r\n')
+            assertEqual((status, headers['content-range'], body),
+                        (416, 'bytes */300000', b''))
+            # Changed since: full file instead of the range
+            (status, headers, body) = request(
+                server.port, 'Range: bytes=0-9\r\nIf-Range: %s\r\n'
+                % 'Thu, 01 Jan 1970 00:00:00 GMT')
+            assertEqual((status, len(body)), (200, 300000))
+            (status, headers, body) = request(
+                server.port, 'If-Modified-Since: %s\r\n' % modified)
+            assertEqual((status, body), (304, b''))
+            # Replaced: served anew
+            Path(webroot, 'big.log').write_bytes(b'short')
+            os.utime(Path(webroot, 'big.log'), (1e9, 1e9))
+            (status, headers, body) = request(server.port)
+            assertEqual((status, body), (200, b'short'))
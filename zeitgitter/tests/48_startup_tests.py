@@ -0,0 +1,96 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test the startup shortcuts: cached key information, lazy imports, timings
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import zeitgitter.config
+import zeitgitter.stamper
+import zeitgitter.startup
+
+GNUPG_HOME = Path(os.path.dirname(os.path.realpath(__file__)), 'gnupg')
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def test_key_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        home = Path(tmp, 'gnupg').as_posix()
+        shutil.copytree(GNUPG_HOME, home,
+                        ignore=shutil.ignore_patterns("S.*", "*~"))
+        repo = Path(tmp, 'repo')
+        Path(repo, '.git').mkdir(parents=True)
+        zeitgitter.config.get_args(args=[
+            '--gnupg-home', home,
+            '--country', '', '--owner', '', '--contact', '',
+            '--keyid', '353DFEC512FA47C7',
+            '--own-url', 'https://hagrid.snakeoil',
+            '--repository', repo.as_posix()])
+        cached_key = zeitgitter.stamper.cached_key
+        assertEqual(cached_key('353DFEC512FA47C7', home, repo), None)
+        stamper = zeitgitter.stamper.Stamper()
+        zeitgitter.stamper.cache_key('353DFEC512FA47C7', home, repo, stamper)
+        key = cached_key('353DFEC512FA47C7', home, repo)
+        assertEqual((key['keyid'], key['fullid'], key['pubkey']),
+                    (stamper.keyid, stamper.fullid, stamper.pubkey))
+        cached = zeitgitter.stamper.Stamper(key)
+        assertEqual((cached.fullid, cached.get_public_key()),
+                    (stamper.fullid, stamper.get_public_key()))
+        # Other setting, other GnuPG home, or changed keyring: not used
+        assertEqual(cached_key(None, home, repo), None)
+        assertEqual(cached_key('353DFEC512FA47C7', GNUPG_HOME.as_posix(),
+                               repo), None)
+        os.utime(Path(home, 'pubring.kbx'), (1e9, 1e9))
+        assertEqual(cached_key('353DFEC512FA47C7', home, repo), None)
+        Path(repo, '.git', zeitgitter.stamper.KEY_CACHE).write_text('[')
+        assertEqual(cached_key('353DFEC512FA47C7', home, repo), None)
+
+
+def test_lazy_imports():
+    loaded = subprocess.run(
+        [sys.executable, '-c', 'import sys, zeitgitter.server;'
+         ' print(" ".join(sorted(sys.modules)))'],
+        check=True, capture_output=True, text=True).stdout.split()
+    for module in ('pygit2', 'imaplib', 'smtplib', 'zeitgitter.mail'):
+        assertEqual(module in loaded, False)
+
+
+def test_report():
+    zeitgitter.startup.phases[:] = [('imports', 0.25), ('key', 0.5)]
+    assertEqual(zeitgitter.startup.report(),
+                "Startup timings:\n"
+                "  imports   0.250 s\n"
+                "  key       0.500 s\n"
+                "  total     0.750 s")
@@ -0,0 +1,108 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test the calibration of signing concurrency
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import zeitgitter.calibrate
+import zeitgitter.config
+import zeitgitter.stamper
+
+GNUPG_HOME = Path(os.path.dirname(os.path.realpath(__file__)), 'gnupg')
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def test_levels():
+    levels = zeitgitter.calibrate.levels
+    assertEqual(levels(1, 1), [(1, 1)])
+    assertEqual(levels(4, 8), [(1, 1), (2, 2), (4, 4), (8, 4)])
+    assertEqual(levels(2, 6), [(1, 1), (2, 2), (4, 2), (6, 2)])
+
+
+def results(*points):
+    return [{'throughput': t, 'latency': l} for (t, l) in points]
+
+
+def test_knee():
+    knee = zeitgitter.calibrate.knee
+    assertEqual(knee(results((100, 0.01))), 0)
+    # Scales, then flattens out
+    assertEqual(knee(results((100, 0.01), (190, 0.011), (350, 0.012),
+                             (360, 0.02))), 2)
+    # No gain at all
+    assertEqual(knee(results((100, 0.01), (105, 0.019))), 0)
+    # Gains, but too slow
+    assertEqual(knee(results((100, 0.01), (190, 0.011), (250, 0.03))), 1)
+
+
+def test_calibrate():
+    with tempfile.TemporaryDirectory() as tmp:
+        home = Path(tmp, 'gnupg').as_posix()
+        shutil.copytree(GNUPG_HOME, home,
+                        ignore=shutil.ignore_patterns("S.*", "*~"))
+        repo = Path(tmp, 'repo')
+        Path(repo, '.git').mkdir(parents=True)
+        zeitgitter.config.get_args(args=[
+            '--gnupg-home', home,
+            '--country', '', '--owner', '', '--contact', '',
+            '--keyid', '353DFEC512FA47C7',
+            '--own-url', 'https://hagrid.snakeoil',
+            '--repository', repo.as_posix(),
+            '--calibrate-signing',
+            '--number-of-gpg-agents', '2',
+            '--max-parallel-signatures', '2'])
+        stamper = zeitgitter.stamper.Stamper()
+        stamper.start_multi_threaded()
+        zeitgitter.calibrate.setup(stamper, duration=0.1)
+        path = Path(repo, '.git', zeitgitter.calibrate.RESULT)
+        env = zeitgitter.calibrate.environment(stamper, 2, 2)
+        stored = zeitgitter.calibrate.load(path, env)
+        arg = zeitgitter.config.arg
+        assertEqual((arg.number_of_gpg_agents, arg.max_parallel_signatures),
+                    (stored['agents'], stored['parallel']))
+        assertEqual(stored['levels'][0]['parallel'], 1)
+        assertEqual(stamper.max_threads, stored['agents'])
+        # Reused as long as the environment is the same
+        arg.number_of_gpg_agents = arg.max_parallel_signatures = 2
+        zeitgitter.calibrate.save(path, dict(stored, agents=2, parallel=1))
+        zeitgitter.calibrate.setup(stamper, duration=0.1)
+        assertEqual((arg.number_of_gpg_agents, arg.max_parallel_signatures),
+                    (2, 1))
+        # Reloading keeps the calibrated values
+        zeitgitter.config.reload()
+        assertEqual((arg.number_of_gpg_agents, arg.max_parallel_signatures),
+                    (2, 1))
+        assertEqual(zeitgitter.calibrate.load(
+            path, zeitgitter.calibrate.environment(stamper, 4, 2)), None)
+        zeitgitter.config.calibrated = None
@@ -0,0 +1,153 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Test deduplication of identical stamping requests
+
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import zeitgitter.config
+import zeitgitter.metrics
+import zeitgitter.stamper
+
+GNUPG_HOME = Path(os.path.dirname(os.path.realpath(__file__)), 'gnupg')
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+class Counting:
+    """Returns b'result <n>' on the n-th call, after `gate` is set"""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.gate.wait()
+        return b'result %d' % self.calls
+
+
+def test_disabled():
+    dedup = zeitgitter.stamper.Deduplicator(None)
+    fn = Counting()
+    assertEqual((dedup.run('a', fn), dedup.run('a', fn)),
+                (b'result 1', b'result 2'))
+
+
+def test_cache():
+    dedup = zeitgitter.stamper.Deduplicator(0.2, max_entries=2)
+    fn = Counting()
+    assertEqual(dedup.run('a', fn), b'result 1')
+    assertEqual(dedup.run('a', fn), b'result 1')
+    assertEqual(dedup.run('b', fn), b'result 2')
+    assertEqual(dedup.run('a', fn), b'result 1')
+    # Least recently used out
+    assertEqual(dedup.run('c', fn), b'result 3')
+    assertEqual(dedup.run('b', fn), b'result 4')
+    assertEqual(dedup.run('a', fn), b'result 5')
+    time.sleep(0.3)
+    assertEqual(dedup.run('a', fn), b'result 6')
+    # Failures (429, 406) are not cached
+    for failure in (None, 406):
+        assertEqual(dedup.run('d', lambda: failure), failure)
+        assertEqual(dedup.run('d', lambda: b'ok'), b'ok')
+        del dedup.cache['d']
+    dedup.reconfigure(0)
+    assertEqual(len(dedup.cache), 0)
+
+
+def test_singleflight():
+    dedup = zeitgitter.stamper.Deduplicator(0)
+    fn = Counting()
+    fn.gate.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        dedup.run('a', fn))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    fn.gate.set()
+    for thread in threads:
+        thread.join()
+    assertEqual((fn.calls, results), (1, [b'result 1'] * 5))
+    # Not cached with a window of 0
+    assertEqual(dedup.run('a', fn), b'result 2')
+
+
+def test_singleflight_error():
+    dedup = zeitgitter.stamper.Deduplicator(10)
+    gate = threading.Event()
+    errors = []
+
+    def fail():
+        gate.wait()
+        raise OSError("fsync failed")
+
+    def run():
+        try:
+            dedup.run('a', fail)
+        except OSError as e:
+            errors.append(str(e))
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    gate.set()
+    for thread in threads:
+        thread.join()
+    assertEqual(errors, ["fsync failed"] * 3)
+    assertEqual(dedup.run('a', lambda: b'ok'), b'ok')
+
+
+def test_stamper():
+    with tempfile.TemporaryDirectory() as repo:
+        zeitgitter.config.get_args(args=[
+            '--gnupg-home', GNUPG_HOME.as_posix(),
+            '--country', '', '--owner', '', '--contact', '',
+            '--keyid', '353DFEC512FA47C7',
+            '--own-url', 'https://hagrid.snakeoil',
+            '--repository', repo,
+            '--dedup-window', '1m'])
+        stamper = zeitgitter.stamper.Stamper()
+        hits = zeitgitter.metrics.dedup.child('hit').value
+        tag = stamper.stamp_tag('1' * 40, 'v1')
+        assertEqual(stamper.stamp_tag('1' * 40, 'v1'), tag)
+        assertEqual(stamper.stamp_tag('1' * 40, 'v2') == tag, False)
+        branch = stamper.stamp_branch('1' * 40, None, '2' * 40)
+        assertEqual(stamper.stamp_branch('1' * 40, None, '2' * 40), branch)
+        assertEqual(stamper.stamp_tag('1' * 40, 'v1!'), 406)
+        assertEqual(zeitgitter.metrics.dedup.child('hit').value - hits, 2)
+        # Every commit logged at least once, repeats only once
+        assertEqual(Path(repo, 'hashes.work').read_text(),
+                    ('1' * 40 + '\n') * 3)
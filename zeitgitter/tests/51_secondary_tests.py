@@ -0,0 +1,157 @@
+#!/usr/bin/python3 -tt
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+# Test signing with a secondary key, in parallel
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import zeitgitter.config
+import zeitgitter.faults
+import zeitgitter.stamper
+
+GNUPG_HOME = Path(os.path.dirname(os.path.realpath(__file__)), 'gnupg')
+
+
+def assertEqual(a, b):
+    if type(a) != type(b):
+        raise AssertionError(
+            "Assertion failed: Type mismatch %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+    elif a != b:
+        raise AssertionError(
+            "Assertion failed: Value mismatch: %r (%s) != %r (%s)"
+            % (a, type(a), b, type(b)))
+
+
+def setup_module():
+    global stamper, tmpdir, home, secondary
+    tmpdir = tempfile.TemporaryDirectory()
+    home = Path(tmpdir.name, 'gnupg')
+    shutil.copytree(GNUPG_HOME, home,
+                    ignore=shutil.ignore_patterns("S.*", "*~"))
+    # Created before ZEITGITTER_FAKE_TIME, to be able to sign then
+    subprocess.run(['gpg', '--homedir', home, '--batch', '--passphrase', '',
+                    '--faked-system-time', '1551100000!',
+                    '--quick-gen-key', 'Secondary <secondary@hagrid.snakeoil>',
+                    'ed25519', 'sign', 'never'],
+                   check=True, capture_output=True)
+    secondary = subprocess.run(
+        ['gpg', '--homedir', home, '--with-colons', '--list-secret-keys',
+         'secondary@hagrid.snakeoil'],
+        check=True, capture_output=True, text=True).stdout
+    secondary = [line.split(':')[9] for line in secondary.split('\n')
+                 if line.startswith('fpr:')][0]
+    zeitgitter.config.get_args(args=[
+        '--gnupg-home', str(home),
+        '--country', '', '--owner', '', '--contact', '',
+        '--keyid', '353DFEC512FA47C7',
+        '--keyid-secondary', secondary,
+        '--number-of-gpg-agents-secondary', '2',
+        '--own-url', 'https://hagrid.snakeoil',
+        '--repository', tmpdir.name])
+    stamper = zeitgitter.stamper.Stamper()
+    os.environ['ZEITGITTER_FAKE_TIME'] = '1551155115'
+
+
+def teardown_module():
+    del os.environ['ZEITGITTER_FAKE_TIME']
+    zeitgitter.config.arg.fault_injection = {}
+    for agent in Path(tmpdir.name).glob('gnupg*'):
+        subprocess.run(['gpgconf', '--homedir', agent, '--kill', 'gpg-agent'])
+    tmpdir.cleanup()
+
+
+def verified(data, sig):
+    """The fingerprints of the keys with good signatures"""
+    Path(tmpdir.name, 'data').write_bytes(data)
+    Path(tmpdir.name, 'data.asc').write_bytes(sig)
+    status = subprocess.run(
+        ['gpg', '--homedir', home, '--status-fd', '1', '--verify',
+         Path(tmpdir.name, 'data.asc'), Path(tmpdir.name, 'data')],
+        capture_output=True, text=True).stdout
+    return sorted(line.split(' ')[2] for line in status.split('\n')
+                  if line.startswith('[GNUPG:] VALIDSIG '))
+
+
+def test_armor():
+    assertEqual(zeitgitter.stamper.crc24(b''), 0xB704CE)
+    sig = stamper.gpg().sign('data', keyid=stamper.keyid, binary=False,
+                             detach=True).data
+    # Same as GnuPG's armor, including the checksum
+    assertEqual(zeitgitter.stamper.armor(zeitgitter.stamper.dearmor(sig)),
+                sig)
+
+
+def test_tag():
+    tag = stamper.stamp_tag('1' * 40, 'v1')
+    (data, sig) = tag.split(b'-----BEGIN PGP SIGNATURE-----')
+    assertEqual(sig.count(b'-----END PGP SIGNATURE-----'), 1)
+    assertEqual(verified(data, b'-----BEGIN PGP SIGNATURE-----' + sig),
+                sorted(['CA4AFAB26C58B209599C8025353DFEC512FA47C7',
+                        secondary]))
+
+
+def test_branch():
+    branch = stamper.stamp_branch('1' * 40, None, '2' * 40)
+    (data, rest) = branch.split(b'gpgsig ')
+    (sig, trailer) = rest.split(b'-----END PGP SIGNATURE-----\n')
+    sig = (sig + b'-----END PGP SIGNATURE-----\n').replace(b'\n ', b'\n')
+    assertEqual(verified(data + trailer, sig),
+                sorted(['CA4AFAB26C58B209599C8025353DFEC512FA47C7',
+                        secondary]))
+
+
+def test_public_key():
+    pubkey = stamper.get_public_key()
+    assertEqual(pubkey.count('-----BEGIN PGP PUBLIC KEY BLOCK-----'), 1)
+    with tempfile.TemporaryDirectory() as empty:
+        imported = subprocess.run(['gpg', '--homedir', empty, '--import'],
+                                  input=pubkey, capture_output=True,
+                                  text=True)
+        subprocess.run(['gpgconf', '--homedir', empty, '--kill', 'all'])
+    assert 'processed: 2' in imported.stderr
+
+
+def test_parallel():
+    stamper.stamp_tag('3' * 40, 'warm')  # Start the agents
+    zeitgitter.config.arg.fault_injection = zeitgitter.faults.parse(
+        'sign=0.5s')
+    try:
+        start = time.time()
+        assert stamper.stamp_tag('4' * 40, 'v4') is not None
+        # Both delayed, but not one after the other
+        assert 0.5 <= time.time() - start < 0.9
+    finally:
+        zeitgitter.config.arg.fault_injection = {}
+
+
+def test_secondary_failure():
+    sign = stamper.secondary.sign
+    stamper.secondary.sign = lambda now, data: None
+    try:
+        assertEqual(stamper.stamp_tag('5' * 40, 'v5'), None)
+    finally:
+        stamper.secondary.sign = sign
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+#
+# zeitgitterd — Independent GIT Timestamping, HTTPS server
+#
+# Copyright (C) 2019-2023 Marcel Waldvogel
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Per-request latency breakdown
+#
+# A `Trace` is started for every request (if tracing is enabled at all, see
+# `--trace-sample-rate` and `--trace-slow-threshold`) and made available to
+# the code handling it through a context variable. `span()` records how long
+# each stage took. When the request is done, sampled or slow requests are
+# logged as a single JSON line by the `trace` logger.
+
+import contextlib
+import contextvars
+import json
+import logging as _logging
+import random
+import time
+
+import zeitgitter.config
+
+logging = _logging.getLogger('trace')
+
+current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.spans = []
+        self.attrs = {}
+
+
+def enabled():
+    arg = zeitgitter.config.arg
+    return arg.trace_sample_rate > 0 or arg.trace_slow_threshold is not None
+
+
+def start():
+    """Start tracing the current request, if enabled. Returns a token for
+    `finish()`."""
+    if not enabled():
+        return None
+    sampled = random.random() < zeitgitter.config.arg.trace_sample_rate
+    return current.set(Trace(sampled))
+
+
+def finish(token):
+    """Log the trace, if sampled or slow, and stop tracing"""
+    if token is None:
+        return
+    trace = current.get()
+    current.reset(token)
+    duration = time.perf_counter() - trace.start
+    threshold = zeitgitter.config.arg.trace_slow_threshold
+    slow = threshold is not None and duration >= threshold
+    if trace.sampled or slow:
+        record = dict(trace.attrs)
+        record['duration'] = round(duration, 6)
+        record['slow'] = slow
+        record['spans'] = [{'name': n, 'start': round(s, 6),
+                            'duration': round(d, 6)}
+                           for (n, s, d) in trace.spans]
+        logging.info(json.dumps(record))
+
+
+def annotate(**attrs):
+    """Add attributes (e.g., request type, status) to the current trace"""
+    trace = current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+@contextlib.contextmanager
+def span(name):
+    trace = current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        trace.spans.append((name, start - trace.start, end - start))
+
+
+@contextlib.contextmanager
+def acquire(lock, name):
+    """Acquire `lock` (recording the wait as span `name`), then release it
+    when leaving"""
+    with span(name):
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()